@@ -3,7 +3,27 @@ from math import log
 import argparse
 from time import time
 import os.path
+import mmap
+import struct
+from array import array
 from operator import itemgetter
+from bisect import bisect_left
+from collections import OrderedDict
+from multiprocessing import Pool
+from os import cpu_count
+import math
+import re
+import pickle
+import threading
+import queue
+import zlib
+#Compressed input and output files (.gz and .zst) are opened with openFile() from maple/io.py, shared with createMapleFile.py.
+from maple.io import openFile, isCompressedFile
+#NumPy is optional: if available (and not running under PyPy), long runs of O entries are merged in batches in mergeVectors().
+try:
+	import numpy
+except ImportError:
+	numpy=None
 
 #©EMBL-European Bioinformatics Institute, 2021-2023
 #Developd by Nicola De Maio, with contributions from Myrthe Willemsen.
@@ -34,6 +54,7 @@ parser = argparse.ArgumentParser(description='Estimate a tree from a diff format
 #important options
 parser.add_argument('--input',default="/Users/demaio/Desktop/GISAID-hCoV-19-phylogeny-2021-03-12/phylogenetic_inference/2021-03-31_unmasked_differences_reduced.txt_consensus-based.txt", help='Input MAPLE file name; should contain first the reference genome and then the difference of all samples with respet to the reference.')
 parser.add_argument('--reference',default="", help='Optional input reference file name. By default it assumes instead that the reference is part of the MAPLE format input.')
+parser.add_argument('--convertToBinary',default="", help='Instead of running an inference, convert the input MAPLE file into a binary alignment file with this name. Binary alignment files can then be used with option --input and are faster to read.')
 parser.add_argument("--model", help="Which substitution model should be used. Allowed models so far are JC, GTR (default) or UNREST.", default="GTR")
 parser.add_argument('--output',default="/Users/demaio/Desktop/GISAID-hCoV-19-phylogeny-2021-03-12/phylogenetic_inference/MAPLE", help='Output path and identifier to be used for newick output file.')
 parser.add_argument('--inputTree',default="", help='Input newick tree file name; this is optional, and is used for online inference (or for Robinson-Foulds distance calculation if option --inputRFtrees is also used).')
@@ -41,11 +62,17 @@ parser.add_argument('--inputRates',default="", help='Name of input containing pr
 parser.add_argument("--largeUpdate", help="When using option --inputTree to do online inference, by default the tree is only updated locally where the new sequences are inserted. Use this option instead to perform a thorough update of the phylogeny.", action="store_true")
 parser.add_argument('--inputRFtrees',default="", help='file name with input newick trees to be compared with the input tree in option --inputTree to calculate Robinson-Foulds distances; this option will turn off the normal MAPLE estimation - only RF distances will be calculated. Each newick tree contained in this file will be compared to the single tree specified with option --inputTree .')
 parser.add_argument("--overwrite", help="Overwrite previous results if already present.", action="store_true")
+parser.add_argument("--lowMemory", help="Only keep a limited number (see --lowMemoryCacheSize) of the genome lists describing the likelihoods from above each node, recalculating the others when needed. Reduces memory demand at the cost of computation.", action="store_true")
+parser.add_argument("--lowMemoryCacheSize", help="Number of upward genome lists kept in memory with option --lowMemory.",  type=int, default=100000)
+parser.add_argument("--streamInput", help="Don't keep the diffs of all input samples in memory: index the input alignment file and read the diffs of each sample from it only when the sample is placed. Reduces memory demand for very large alignments.", action="store_true")
 parser.add_argument("--fast", help="Set parameters so to run tree inference faster; this will be less accurate in cases of high complexity, for example with recombination, sequencing errors, etc. It will overrule user choices for options --thresholdLogLK , --thresholdLogLKtopology , --allowedFails , --allowedFailsTopology .", action="store_true")
 parser.add_argument("--rateVariation", help="Estimate and use rate variation: the model assumes one rate per site, and the rates are assumed independently (no rate categories). This might cause overfitting if the dataset is not large enough, but in any case one would probably only use MAPLE for large enough datasets.", action="store_true")
 parser.add_argument("--estimateMAT", help="Estimate mutation events on the final tree, and write them on the nexus tree.", action="store_true")
 parser.add_argument("--doNotImproveTopology", help="Do not perform SPR moves, despite searching for them; this is useful if one wants to analyse a tree and calculate branch supports without changing the input tree.", action="store_true")
 parser.add_argument("--saveInitialTreeEvery",help="Every these many samples placed (default 50,000) save the current tree to file. This way if there is any problem, the building of the initial tree can be restarted from the last saved tree.",  type=int, default=50000)
+parser.add_argument("--saveCheckpoints", help="Save the state of the inference (tree with its genome lists, model parameters and progress) to binary file <output>_checkpoint.bin every time a partial initial tree is saved (see --saveInitialTreeEvery) and at the start of each round and subround of topological improvement, so that an interrupted inference can be restarted with option --resumeFrom.", action="store_true")
+parser.add_argument("--checkpointEveryMinutes",help="During the traversals of the tree of the topological search, write a checkpoint (see --saveCheckpoints) every these many minutes, including which nodes still need to be traversed, so that --resumeFrom can continue the same traversal. By default (0) no such checkpoints are written.",  type=float, default=0.0)
+parser.add_argument("--resumeFrom",default="", help="Resume an interrupted inference from a checkpoint file written with option --saveCheckpoints. The same input files and options as in the interrupted run should be used.")
 parser.add_argument("--doNotPlaceNewSamples", help="Given an input tree, skip the placement of samples on the tree (in case the input alignment contained more samples than on the tree), so keep only the samples originally already on the tree.", action="store_true")
 parser.add_argument("--doNotReroot", help="Skip rooting optimization.", action="store_true")
 parser.add_argument("--noLocalRef", help="Do not use local references (this will usually take longer to run).", action="store_true")
@@ -63,6 +90,7 @@ parser.add_argument("--allowedFailsTopology",help="Maximum number of times one c
 parser.add_argument("--numTopologyImprovements",help="Number of times we traverse the tree looking for deep (and slow) topological improvements. Default is 1, select 0 to skip deep topological search. values >1 are not recommended.",  type=int, default=1)
 parser.add_argument("--thresholdTopologyPlacement",help="Don't try to re-place nodes that have current appending logLK cost above this threshold.",  type=float, default=-0.1)
 parser.add_argument("--updateSubstMatrixEveryThisSamples",help="How many new samples to place before each update of the substitution rate matrix.",  type=int, default=25)
+parser.add_argument("--mutationIndexPlacement", help="Keep an index of the mutations of the mutation-annotated tree (the mutation lists of its local references), and start the placement search of each new sample from above the clade whose mutations are all carried by the sample, with strict stop rules, instead of from the root. Faster on large trees with many local references, but placements outside of that clade are not considered.", action="store_true")
 parser.add_argument("--nonStrictStopRules", help="If specified, then during the initial placement stage, a slower, non-strict rule for stopping the placement search is applied: the search is stopped if enough many consencutive LK worsening are observed, AND if LK is below the considered threshold.", action="store_true")
 parser.add_argument("--strictTopologyStopRules", help="If specified, then during the topological improvement stage, a faster, strict rule for stopping the SPR search is applied: the search is stopped if enough many consencutive LK worsening are observed, OR if LK is below the considered threshold.", action="store_true")
 parser.add_argument("--thresholdDiffForUpdate",help="Consider the probability of a new partial changed if the difference between old and new is above this threshold.",  type=float, default=0.00001)
@@ -91,6 +119,8 @@ parser.add_argument("--nonBinaryTree", help="Write output tree with multifurcati
 parser.add_argument("--writeTreesToFileEveryTheseSteps", help="By default, don't write intermediate trees to file. If however a positive integer is specified with this option, intermediate trees will be written to file every this many topological changes.",  type=int, default=0)
 parser.add_argument("--writeLKsToFileEveryTheseSteps", help="By default, don't write likelihoods of intermediate trees to file. If however a positive integer is specified with this option, likelihoods of intermediate trees will be written to file every this many topological changes.",  type=int, default=0)
 parser.add_argument("--noSubroundTrees", help="Do not write to file subround treees.", action="store_true")
+parser.add_argument("--writeMAT", help="Also write the final tree as a binary mutation-annotated tree file (with extension .mat), with its branch lengths, sample names and mutations (including those inferred with --estimateMAT), which is faster to load than a newick tree. It can be given to option --inputTree for online inference.", action="store_true")
+parser.add_argument("--compressOutput",default="", choices=["","gz","zst"], help="Write the output trees, metadata, estimated errors and lineage assignments compressed in the given format (gz for gzip or zst for zstandard), adding the corresponding extension to the file names. Input files with extension .gz or .zst are always decompressed on the fly.")
 #error model options
 parser.add_argument("--estimateErrorRate", help="Estimate a single error rate for the whole genome. Input value is used as starting value", action="store_true")
 parser.add_argument("--estimateSiteSpecificErrorRate", help="Estimate a separate error rate for each genome genome. Input value is used as starting value", action="store_true")
@@ -110,142 +140,189 @@ parser.add_argument("--minMutProb", help="Minimum mutation probability to be wri
 parser.add_argument("--keepInputIQtreeSupports", help="Assumes the input tree is from IQTREE, reads the support values on the tree branches, and prints the same values in the output nexus tree.", action="store_true")
 #TODO HorseNotZebra modifiers option
 parser.add_argument("--HnZ", help="By default (0), don't use modifiers. If 1, use the topological HorseNotZebra modifier; if 2, use the abundance HnZ modifier.",  type=int, default=0)
-args = parser.parse_args()
-
-onlyNambiguities=args.onlyNambiguities
-thresholdProb=args.thresholdProb
-debugging=args.debugging
-inputFile=args.input
-outputFile=args.output
-refFile=args.reference
-allowedFails=args.allowedFails
-allowedFailsTopology=args.allowedFailsTopology
-model=args.model
-thresholdLogLK=args.thresholdLogLK
-thresholdLogLKtopology=args.thresholdLogLKtopology
-overwrite=args.overwrite
-binaryTree=(not args.nonBinaryTree)
-numTopologyImprovements=args.numTopologyImprovements
-thresholdTopologyPlacement=args.thresholdTopologyPlacement
-updateSubstMatrixEveryThisSamples=args.updateSubstMatrixEveryThisSamples
-strictStopRules=(not args.nonStrictStopRules)
-strictTopologyStopRules=args.strictTopologyStopRules
-thresholdDiffForUpdate=args.thresholdDiffForUpdate
-thresholdFoldChangeUpdate=args.thresholdFoldChangeUpdate
-thresholdLogLKconsecutivePlacement=args.thresholdLogLKconsecutivePlacement
-thresholdLogLKTopologySubRoundImprovement=args.thresholdLogLKTopologySubRoundImprovement
-calculateLKfinalTree=True
-maxNumDescendantsForMATClade=args.maxNumDescendantsForMATClade
-minNumNon4=args.minNumNon4
-saveInitialTreeEvery=args.saveInitialTreeEvery
-doNotPlaceNewSamples=args.doNotPlaceNewSamples
-doNotReroot=args.doNotReroot
-noSubroundTrees=args.noSubroundTrees
-useLocalReference= (not args.noLocalRef)
-
-numCores=args.numCores
-parallelize=False
-if numCores>1:
-	parallelize=True
-	from multiprocessing import Pool
-	from os import cpu_count
-	numAvailCores=cpu_count()
-	print('Number of CPUs available: '+str(numAvailCores))
-	if numCores>numAvailCores:
-		numCores=numAvailCores
-	print('Number of CPUs that will be used: '+str(numCores))
-
-thresholdLogLKoptimization=args.thresholdLogLKoptimization
-thresholdLogLKoptimizationTopology=args.thresholdLogLKoptimizationTopology
-minBLenSensitivity=args.minBLenSensitivity
-
-example=False
-runFast=args.fast
-if runFast:
-	thresholdLogLK=14.0
-	allowedFails=4
-	allowedFailsTopology=3
-	thresholdLogLKtopology=7.0
-	thresholdTopologyPlacement=-1.0
-	minBLenSensitivity=0.001
-
-fastTopologyInitialSearch=(not args.noFastTopologyInitialSearch)
-strictTopologyStopRulesInitial=True
-allowedFailsTopologyInitial=2
-thresholdLogLKtopologyInitial=6.0
-thresholdTopologyPlacementInitial=-0.1
-minNumSamplesForRateVar=args.minNumSamplesForRateVar
-minNumSamplesForErrorModel=args.minNumSamplesForErrorModel
-
-defaultBLen=args.defaultBLen
-normalizeInputBLen=args.normalizeInputBLen
-multipleInputRFTrees=args.multipleInputRFTrees
-
-inputTree=args.inputTree
-inputRates=args.inputRates
-inputRFtrees=args.inputRFtrees
-largeUpdate=args.largeUpdate
-
-assignmentFile=args.assignmentFile
-assignmentFileCSV=args.assignmentFileCSV
-inputNexusTree=args.inputNexusTree
-maxReplacements=args.maxReplacements
-writeTreesToFileEveryTheseSteps=args.writeTreesToFileEveryTheseSteps
-writeLKsToFileEveryTheseSteps=args.writeLKsToFileEveryTheseSteps
-reRoot=args.reRoot
-
-mutMatrixGlobal=None
-estimateErrorRate=args.estimateErrorRate
-estimateSiteSpecificErrorRate = args.estimateSiteSpecificErrorRate
-errorRateInitial = args.errorRateInitial
-errorRateFixed = args.errorRateFixed
-errorRateSiteSpecificFile = args.errorRateSiteSpecificFile
-estimateErrors=args.estimateErrors
-if estimateErrors and (not estimateSiteSpecificErrorRate) and (not errorRateSiteSpecificFile):
-	print("Since option --estimateErrors has been selected, I am switching on --estimateSiteSpecificErrorRate so to allow estimation of site-specific error probabilities.")
-	estimateSiteSpecificErrorRate=True
-minErrorProb=args.minErrorProb
-errorRateGlobal=0.0
-usingErrorRate=False
-errorRateSiteSpecific=False
-rateVariation=args.rateVariation
-useRateVariation=False
-mutMatrices=None
-
-aBayesPlus=args.aBayesPlus
-sprta=args.SPRTA
-aBayesPlus=aBayesPlus or sprta
-networkOutput=args.networkOutput
-minBranchSupport=args.minBranchSupport
-supportFor0Branches=args.supportFor0Branches
-if supportFor0Branches:
-	supportForIdenticalSequences=True
-else:
-	supportForIdenticalSequences=False
-estimateMAT=args.estimateMAT
-minMutProb=args.minMutProb
-doNotImproveTopology=args.doNotImproveTopology
-keepInputIQtreeSupports=args.keepInputIQtreeSupports
-aBayesPlusOn=False
-if aBayesPlus:
-	import math
+
+
+#Options of a MAPLE run. Attributes have the same names and default values as the command line options above,
+# so that the same run can be set up from Python, e.g. Config(input="alignment.maple",output="results/MAPLE",fast=True),
+# or from a command line with Config.fromArgs().
+#A Config object only holds option values: it takes effect when passed to setUpConfig(), and the inference functions never read it directly.
+class Config(object):
+	def __init__(self,**options):
+		self.__dict__.update(vars(parser.parse_args([])))
+		for option in options:
+			if not hasattr(self,option):
+				print("Unknown MAPLE option "+option+" .")
+				raise Exception("exit")
+			setattr(self,option,options[option])
+	def __repr__(self):
+		return "Config object"
+	@classmethod
+	def fromArgs(cls,argv=None):
+		return cls(**vars(parser.parse_args(argv)))
+
+
+#Set the module-level options used throughout the inference from a Config object.
+#The options are process-global: calling setUpConfig() again replaces the options of any run already set up in the same process,
+# so two configurations cannot be used at the same time (use separate processes for that).
+#This needs to be called before setUpReference(), which rescales some of the thresholds by the genome length.
+def setUpConfig(config):
+	global onlyNambiguities, thresholdProb, debugging, inputFile, outputFile, refFile, convertToBinary, allowedFails, allowedFailsTopology
+	global model, thresholdLogLK, thresholdLogLKtopology, overwrite, streamInput, lowMemory, lowMemoryCacheSize, binaryTree, numTopologyImprovements, thresholdTopologyPlacement, updateSubstMatrixEveryThisSamples
+	global mutationIndexPlacement, strictStopRules, strictTopologyStopRules, thresholdDiffForUpdate, thresholdFoldChangeUpdate, thresholdLogLKconsecutivePlacement, thresholdLogLKTopologySubRoundImprovement, calculateLKfinalTree, maxNumDescendantsForMATClade
+	global minNumNon4, saveInitialTreeEvery, saveCheckpoints, checkpointEveryMinutes, resumeFrom, doNotPlaceNewSamples, doNotReroot, noSubroundTrees, writeMAT, compressOutput, useLocalReference, numCores, parallelize
+	global numAvailCores, thresholdLogLKoptimization, thresholdLogLKoptimizationTopology, minBLenSensitivity, example, runFast, fastTopologyInitialSearch, strictTopologyStopRulesInitial
+	global allowedFailsTopologyInitial, thresholdLogLKtopologyInitial, thresholdTopologyPlacementInitial, minNumSamplesForRateVar, minNumSamplesForErrorModel, defaultBLen, normalizeInputBLen, multipleInputRFTrees
+	global inputTree, inputRates, inputRFtrees, largeUpdate, assignmentFile, assignmentFileCSV, inputNexusTree, maxReplacements
+	global writeTreesToFileEveryTheseSteps, writeLKsToFileEveryTheseSteps, reRoot, estimateErrorRate, estimateSiteSpecificErrorRate, errorRateInitial, errorRateFixed, errorRateSiteSpecificFile
+	global estimateErrors, minErrorProb, rateVariation, aBayesPlus, sprta, networkOutput, minBranchSupport, supportFor0Branches
+	global supportForIdenticalSequences, estimateMAT, minMutProb, doNotImproveTopology, keepInputIQtreeSupports, aBayesPlusOn, useFixedThresholdLogLKoptimizationTopology, HnZ
+	global HnZvector, performLineageAssignment, thresholdProb2, thresholdProb4
+	onlyNambiguities=config.onlyNambiguities
+	thresholdProb=config.thresholdProb
+	debugging=config.debugging
+	inputFile=config.input
+	outputFile=config.output
+	refFile=config.reference
+	convertToBinary=config.convertToBinary
+	allowedFails=config.allowedFails
+	allowedFailsTopology=config.allowedFailsTopology
+	model=config.model
+	thresholdLogLK=config.thresholdLogLK
+	thresholdLogLKtopology=config.thresholdLogLKtopology
+	overwrite=config.overwrite
+	streamInput=config.streamInput
+	lowMemory=config.lowMemory
+	lowMemoryCacheSize=config.lowMemoryCacheSize
+	binaryTree=(not config.nonBinaryTree)
+	numTopologyImprovements=config.numTopologyImprovements
+	thresholdTopologyPlacement=config.thresholdTopologyPlacement
+	updateSubstMatrixEveryThisSamples=config.updateSubstMatrixEveryThisSamples
+	strictStopRules=(not config.nonStrictStopRules)
+	mutationIndexPlacement=config.mutationIndexPlacement
+	strictTopologyStopRules=config.strictTopologyStopRules
+	thresholdDiffForUpdate=config.thresholdDiffForUpdate
+	thresholdFoldChangeUpdate=config.thresholdFoldChangeUpdate
+	thresholdLogLKconsecutivePlacement=config.thresholdLogLKconsecutivePlacement
+	thresholdLogLKTopologySubRoundImprovement=config.thresholdLogLKTopologySubRoundImprovement
+	calculateLKfinalTree=True
+	maxNumDescendantsForMATClade=config.maxNumDescendantsForMATClade
+	minNumNon4=config.minNumNon4
+	saveInitialTreeEvery=config.saveInitialTreeEvery
+	saveCheckpoints=config.saveCheckpoints
+	checkpointEveryMinutes=config.checkpointEveryMinutes
+	resumeFrom=config.resumeFrom
+	doNotPlaceNewSamples=config.doNotPlaceNewSamples
+	doNotReroot=config.doNotReroot
+	noSubroundTrees=config.noSubroundTrees
+	writeMAT=config.writeMAT
+	compressOutput=config.compressOutput
+	useLocalReference= (not config.noLocalRef)
+
+	numCores=config.numCores
+	parallelize=False
+	if numCores>1:
+		parallelize=True
+		numAvailCores=cpu_count()
+		print('Number of CPUs available: '+str(numAvailCores))
+		if numCores>numAvailCores:
+			numCores=numAvailCores
+		print('Number of CPUs that will be used: '+str(numCores))
+
+	thresholdLogLKoptimization=config.thresholdLogLKoptimization
+	thresholdLogLKoptimizationTopology=config.thresholdLogLKoptimizationTopology
+	minBLenSensitivity=config.minBLenSensitivity
+
+	example=False
+	runFast=config.fast
+	if runFast:
+		thresholdLogLK=14.0
+		allowedFails=4
+		allowedFailsTopology=3
+		thresholdLogLKtopology=7.0
+		thresholdTopologyPlacement=-1.0
+		minBLenSensitivity=0.001
+
+	fastTopologyInitialSearch=(not config.noFastTopologyInitialSearch)
+	strictTopologyStopRulesInitial=True
+	allowedFailsTopologyInitial=2
+	thresholdLogLKtopologyInitial=6.0
+	thresholdTopologyPlacementInitial=-0.1
+	minNumSamplesForRateVar=config.minNumSamplesForRateVar
+	minNumSamplesForErrorModel=config.minNumSamplesForErrorModel
+
+	defaultBLen=config.defaultBLen
+	normalizeInputBLen=config.normalizeInputBLen
+	multipleInputRFTrees=config.multipleInputRFTrees
+
+	inputTree=config.inputTree
+	inputRates=config.inputRates
+	inputRFtrees=config.inputRFtrees
+	largeUpdate=config.largeUpdate
+
+	assignmentFile=config.assignmentFile
+	assignmentFileCSV=config.assignmentFileCSV
+	inputNexusTree=config.inputNexusTree
+	maxReplacements=config.maxReplacements
+	writeTreesToFileEveryTheseSteps=config.writeTreesToFileEveryTheseSteps
+	writeLKsToFileEveryTheseSteps=config.writeLKsToFileEveryTheseSteps
+	reRoot=config.reRoot
+
+	estimateErrorRate=config.estimateErrorRate
+	estimateSiteSpecificErrorRate = config.estimateSiteSpecificErrorRate
+	errorRateInitial = config.errorRateInitial
+	errorRateFixed = config.errorRateFixed
+	errorRateSiteSpecificFile = config.errorRateSiteSpecificFile
+	estimateErrors=config.estimateErrors
+	if estimateErrors and (not estimateSiteSpecificErrorRate) and (not errorRateSiteSpecificFile):
+		print("Since option --estimateErrors has been selected, I am switching on --estimateSiteSpecificErrorRate so to allow estimation of site-specific error probabilities.")
+		estimateSiteSpecificErrorRate=True
+	minErrorProb=config.minErrorProb
+	rateVariation=config.rateVariation
+
+	aBayesPlus=config.aBayesPlus
+	sprta=config.SPRTA
+	aBayesPlus=aBayesPlus or sprta
+	networkOutput=config.networkOutput
+	minBranchSupport=config.minBranchSupport
+	supportFor0Branches=config.supportFor0Branches
+	if supportFor0Branches:
+		supportForIdenticalSequences=True
+	else:
+		supportForIdenticalSequences=False
+	estimateMAT=config.estimateMAT
+	minMutProb=config.minMutProb
+	doNotImproveTopology=config.doNotImproveTopology
+	keepInputIQtreeSupports=config.keepInputIQtreeSupports
+	aBayesPlusOn=False
+
+	useFixedThresholdLogLKoptimizationTopology=config.useFixedThresholdLogLKoptimizationTopology
+
+	#TODO HnZ check and HnZvector definition and update 
+	HnZ=config.HnZ
+	if HnZ>2 or HnZ<0:
+		print("Option --HnZ only allows values 0 (no HnZ), 1 (topological HnZ) or 2 (abundance HnZ).")
+		raise Exception("exit")
+	if HnZ==1:
+		HnZvector=[0,0,0]
+	elif HnZ==2:
+		HnZvector=[0,0,2*log(2)]
+
+	performLineageAssignment=False
+	if assignmentFile!="" or assignmentFileCSV!="":
+		performLineageAssignment=True
+	#stricter thresholds than the input one for probabilities.
+	thresholdProb2=thresholdProb*thresholdProb
+	thresholdProb4=thresholdProb2*thresholdProb2
+
+#start with the default options, so that the functions of this module can also be used without calling setUpConfig() first.
+setUpConfig(Config())
 
 warnedBLen=[False]
 warnedTotDiv=[False]
 sumChildLKs=[0.0]
 numChildLKs=[0]
-useFixedThresholdLogLKoptimizationTopology=args.useFixedThresholdLogLKoptimizationTopology
 totDivFromRef=[0.0]
 
-#TODO HnZ check and HnZvector definition and update 
-HnZ=args.HnZ
-if HnZ>2 or HnZ<0:
-	print("Option --HnZ only allows values 0 (no HnZ), 1 (topological HnZ) or 2 (abundance HnZ).")
-	exit()
-if HnZ==1:
-	HnZvector=[0,0,0]
-elif HnZ==2:
-	HnZvector=[0,0,2*log(2)]
 def updateHnZvector(n):
 	currentN=len(HnZvector)
 	while  currentN<=n:
@@ -264,23 +341,35 @@ def getHnZ(n):
 
 	
 
+#Node attributes are stored as one sequence per attribute, indexed by node.
+#Numeric attributes use typed arrays (branch lengths as doubles, counters as ints, dirty flags as bytes) instead of lists of Python objects, to save memory on large trees.
+#up is a list since the root has no parent (None), and children a list of lists since the tree can be non-binary.
+#Attributes that are only used by some options (branch supports, lineages, etc) are not created here but are declared in __slots__.
 class Tree(object):
+	__slots__=("dist","replacements","children","mutations","up","dirty","name","minorSequences","probVect","probVectUpRight","probVectUpLeft","probVectTotUp","nDesc","nDesc0",
+		"IQsupport","Ns","alternativePlacements","coreNum","errors","exploredChildren","featureDicts","features","isRef","maxSoFar","minSoFar","mutationsInf","nDescendants",
+		"rootSupport","support","supportTo","allLineages","lineage","lineages","mostAncestralLineages","upwardCache","mutationIndex")
 	def __init__(self):
-		self.dist = []
-		self.replacements=[]
+		self.dist = array("d")
+		self.replacements=array("i")
 		self.children = []
 		self.mutations=[]
 		self.up=[]
-		self.dirty=[]
+		self.dirty=bytearray()
 		self.name=[]
 		self.minorSequences=[]
 		self.probVect=[]
 		self.probVectUpRight=[]
 		self.probVectUpLeft=[]
 		self.probVectTotUp=[]
-		self.nDesc=[]
+		if lowMemory:
+			self.upwardCache=UpwardGenomeListCache(self,lowMemoryCacheSize)
+			self.probVectUpRight=UpwardGenomeListStore(self.upwardCache,0)
+			self.probVectUpLeft=UpwardGenomeListStore(self.upwardCache,1)
+			self.probVectTotUp=UpwardGenomeListStore(self.upwardCache,2)
+		self.nDesc=array("i")
 		#TODO number of branches descending from node after collapsing 0-length branches
-		self.nDesc0=[]
+		self.nDesc0=array("i")
 	def __repr__(self):
 		return "Tree object"
 	def addNode(self,dirtiness=True):
@@ -300,6 +389,30 @@ class Tree(object):
 		#TODO make sure this si updated correctly throughout
 		if HnZ:
 			self.nDesc0.append(1)
+	#add numNodes new nodes at once, as done by numNodes calls of addNode().
+	def addNodes(self,numNodes,dirtiness=True):
+		self.up.extend([None]*numNodes)
+		self.children.extend([[] for i in range(numNodes)])
+		self.dirty.extend(bytes([dirtiness])*numNodes)
+		self.name.extend([""]*numNodes)
+		self.minorSequences.extend([[] for i in range(numNodes)])
+		self.mutations.extend([[] for i in range(numNodes)])
+		self.replacements.extend(array("i",[0])*numNodes)
+		self.dist.extend(array("d",[0.0])*numNodes)
+		if lowMemory:
+			for i in range(numNodes):
+				self.probVect.append(None)
+				self.probVectUpRight.append(None)
+				self.probVectUpLeft.append(None)
+				self.probVectTotUp.append(None)
+		else:
+			self.probVect.extend([None]*numNodes)
+			self.probVectUpRight.extend([None]*numNodes)
+			self.probVectUpLeft.extend([None]*numNodes)
+			self.probVectTotUp.extend([None]*numNodes)
+		self.nDesc.extend(array("i",[0])*numNodes)
+		if HnZ:
+			self.nDesc0.extend(array("i",[1])*numNodes)
 
 #IMPORTANT definitions of genome list entries structure.
 #The first element of a genome list entry represnts its type: 0="A", 1="C", 2="G", 3="T", 4="R", 5="N", 6="O"
@@ -316,6 +429,248 @@ class Tree(object):
 #when this additional branch length is also present, for example if the entry is (1, 234, 0.0001, 0.0002) then this means that a "C" was observed at genome position 234, and the observation
 #is separated from the root by a distance of 0.0001, while a distance of 0.0002 separates the root from the current node (or position along a branch) considered.
 
+#Least-recently-used cache of the upward genome lists (probVectUpRight, probVectUpLeft and probVectTotUp) of a tree, used with option --lowMemory.
+#Genome lists not in the cache are recalculated from the parent node (and, if needed, recursively from its ancestors) when requested.
+class UpwardGenomeListCache(object):
+	def __init__(self,tree,capacity):
+		self.tree=tree
+		self.capacity=capacity
+		self.genomeLists=OrderedDict()
+		self.hits=0
+		self.misses=0
+
+	def __repr__(self):
+		return "UpwardGenomeListCache object"
+
+	def put(self,key,genomeList):
+		if genomeList==None:
+			self.genomeLists.pop(key,None)
+			return
+		self.genomeLists[key]=genomeList
+		self.genomeLists.move_to_end(key)
+		if len(self.genomeLists)>self.capacity:
+			self.genomeLists.popitem(last=False)
+
+	#whether the upward genome list is currently stored, without recalculating it.
+	def contains(self,kind,node):
+		return (kind,node) in self.genomeLists
+
+	#remove the upward genome lists of a node, e.g. when they need to be recalculated after a change of its reference.
+	def forget(self,node):
+		for kind in range(3):
+			self.genomeLists.pop((kind,node),None)
+
+	#kind is 0 for probVectUpRight, 1 for probVectUpLeft and 2 for probVectTotUp.
+	def get(self,kind,node):
+		key=(kind,node)
+		if key in self.genomeLists:
+			self.hits+=1
+			self.genomeLists.move_to_end(key)
+			return self.genomeLists[key]
+		self.misses+=1
+		#find the closest ancestor whose upward genome list is available, then recalculate the missing ones going down from it.
+		up=self.tree.up
+		children=self.tree.children
+		path=[key]
+		vectUpUp=None
+		while True:
+			kind,node=path[-1]
+			if (kind!=2 and len(children[node])!=2) or (kind==2 and not self.tree.dist[node]) or up[node]==None:
+				break
+			parent=up[node]
+			if node==children[parent][0]:
+				parentKey=(0,parent)
+			else:
+				parentKey=(1,parent)
+			if parentKey in self.genomeLists:
+				vectUpUp=self.genomeLists[parentKey]
+				break
+			path.append(parentKey)
+		for key in reversed(path):
+			vectUpUp=self.calculate(key[0],key[1],vectUpUp)
+			self.put(key,vectUpUp)
+		return vectUpUp
+
+	#calculate an upward genome list given the one coming from the parent node.
+	def calculate(self,kind,node,vectUpUp):
+		tree=self.tree
+		children=tree.children
+		minorSequences=tree.minorSequences
+		mutations=tree.mutations
+		dist=tree.dist
+		if kind==2:
+			if tree.up[node]==None or (not dist[node]) or vectUpUp==None:
+				return None
+			if mutations[node]:
+				vectUpUp=passGenomeListThroughBranch(vectUpUp,mutations[node])
+			isTip=(len(children[node])==0 and len(minorSequences[node])==0)
+			newVect=mergeVectors(vectUpUp,dist[node]/2,False,tree.probVect[node],dist[node]/2,isTip,isUpDown=True)
+		else:
+			if len(children[node])!=2:
+				return None
+			child=children[node][1-kind]
+			childVect=tree.probVect[child]
+			if mutations[child]:
+				childVect=passGenomeListThroughBranch(childVect,mutations[child],dirIsUp=True)
+			isTipChild=(len(children[child])==0 and len(minorSequences[child])==0)
+			if tree.up[node]==None:
+				newVect=rootVector(childVect,dist[child],isTipChild,tree,node)
+			else:
+				if vectUpUp==None:
+					return None
+				if mutations[node]:
+					vectUpUp=passGenomeListThroughBranch(vectUpUp,mutations[node])
+				newVect=mergeVectors(vectUpUp,dist[node],False,childVect,dist[child],isTipChild,isUpDown=True)
+		if newVect!=None:
+			shorten(newVect)
+		return newVect
+
+
+#Node-indexed view of one kind of upward genome lists, stored in an UpwardGenomeListCache.
+class UpwardGenomeListStore(object):
+	def __init__(self,cache,kind):
+		self.cache=cache
+		self.kind=kind
+		self.numNodes=0
+
+	def __repr__(self):
+		return "UpwardGenomeListStore object"
+
+	def __len__(self):
+		return self.numNodes
+
+	def append(self,genomeList):
+		self.cache.put((self.kind,self.numNodes),genomeList)
+		self.numNodes+=1
+
+	def __getitem__(self,node):
+		if node<0:
+			node+=self.numNodes
+		return self.cache.get(self.kind,node)
+
+	def __setitem__(self,node,genomeList):
+		if node<0:
+			node+=self.numNodes
+		self.cache.put((self.kind,node),genomeList)
+
+#Compact store of the sample names in the tree (namesInTree), indexed by the integer ids in tree.name.
+#Names are kept UTF-8 encoded in a single bytearray, with their end offsets in an array, and are decoded only when accessed
+# (typically when writing output files), so no string object per name is kept in memory.
+#An open-addressing hash table (an array of ids, probed linearly from the crc32 of the encoded name) gives the id of a name,
+# so that the store is also used instead of a name->id dictionary (e.g. namesInTreeDict in readNewick()).
+class NameStore(object):
+	def __init__(self,names=()):
+		self.blob=bytearray()
+		self.offsets=array("q",[0])
+		self.table=array("q",[-1])*16
+		for name in names:
+			self.append(name)
+
+	def __repr__(self):
+		return "NameStore object"
+
+	def __len__(self):
+		return len(self.offsets)-1
+
+	def __getitem__(self,nameId):
+		return self.blob[self.offsets[nameId]:self.offsets[nameId+1]].decode()
+
+	def __iter__(self):
+		blob=self.blob
+		offsets=self.offsets
+		for nameId in range(len(offsets)-1):
+			yield blob[offsets[nameId]:offsets[nameId+1]].decode()
+
+	def __contains__(self,name):
+		return self.nameId(name)!=None
+
+	#slot of the hash table containing the id of the encoded name, or the empty slot where it would be inserted.
+	def findSlot(self,encodedName):
+		blob=self.blob
+		offsets=self.offsets
+		table=self.table
+		mask=len(table)-1
+		slot=zlib.crc32(encodedName)&mask
+		while table[slot]!=-1 and blob[offsets[table[slot]]:offsets[table[slot]+1]]!=encodedName:
+			slot=(slot+1)&mask
+		return slot
+
+	#id of a name, or None if the name is not in the store.
+	def nameId(self,name):
+		nameId=self.table[self.findSlot(name.encode())]
+		if nameId==-1:
+			return None
+		return nameId
+
+	#add a name at the end of the store and return its id; as in a dictionary, the id of a repeated name becomes that of its last occurrence.
+	def append(self,name):
+		encodedName=name.encode()
+		nameId=len(self.offsets)-1
+		self.blob+=encodedName
+		self.offsets.append(len(self.blob))
+		if 2*(nameId+1)>len(self.table):
+			self.rebuildTable(nameId)
+		self.table[self.findSlot(encodedName)]=nameId
+		return nameId
+
+	#rebuild the hash table for the first numNames names, e.g. after it has become too full or after setting blob and offsets directly.
+	def rebuildTable(self,numNames):
+		size=16
+		while size<2*(numNames+1):
+			size*=2
+		self.table=array("q",[-1])*size
+		for nameId in range(numNames):
+			self.table[self.findSlot(bytes(self.blob[self.offsets[nameId]:self.offsets[nameId+1]]))]=nameId
+
+	#approximate memory used by the store, in bytes.
+	def nbytes(self):
+		return len(self.blob)+8*(len(self.offsets)+len(self.table))
+
+
+#Writes the blocks of text given to write() to a file from a background thread, so that compressing and writing large outputs
+# (trees and metadata) overlaps with the tree traversals generating them. At most maxQueuedBlocks blocks wait to be written.
+class BackgroundFileWriter(object):
+	def __init__(self,file,maxQueuedBlocks=16):
+		self.file=file
+		self.blocks=queue.Queue(maxQueuedBlocks)
+		self.error=None
+		self.thread=threading.Thread(target=self.writeBlocks,daemon=True)
+		self.thread.start()
+
+	def writeBlocks(self):
+		while True:
+			block=self.blocks.get()
+			if block==None:
+				break
+			if self.error==None:
+				try:
+					self.file.write(block)
+				except Exception as e:
+					self.error=e
+
+	def write(self,block):
+		if self.error!=None:
+			raise self.error
+		self.blocks.put(block)
+
+	def close(self):
+		if self.thread!=None:
+			self.blocks.put(None)
+			self.thread.join()
+			self.thread=None
+			self.file.close()
+		if self.error!=None:
+			raise self.error
+
+	def __repr__(self):
+		return "BackgroundFileWriter object"
+
+#name of an output file, with the extension of the compression format chosen with option --compressOutput.
+def outputFileName(fileName):
+	if compressOutput!="":
+		return fileName+"."+compressOutput
+	return fileName
+
 # readNewick() now also reads IQTREE branch supports if keepInputIQtreeSupports==True
 # different types of branch support in IQTREE:
 # )63:
@@ -325,120 +680,112 @@ class Tree(object):
 # )/0.999:
 # )75.4/67.3:
 
+#tokens of a newick string: comments in square brackets, single structure characters, branch lengths (including the leading ":") and names (or, after a ")", supports).
+newickTokens=re.compile(r"\[[^\]]*\]|[(),;]|:[^,);]*|[^(),;:\[]+")
+
+#number of nodes described by a newick string: one per "(" and "," plus the root.
+def countNewickNodes(nwString):
+	if "[" in nwString:
+		nwString=re.sub(r"\[[^\]]*\]","",nwString)
+	end=nwString.find(";")
+	if end<0:
+		end=len(nwString)
+	return nwString.count("(",0,end)+nwString.count(",",0,end)+1
+
 #function to read input newick string
+#The string is split into tokens by a compiled regular expression, and the nodes of the tree are allocated at once before parsing;
+# node indices are assigned in the order in which their "(" or "," appears in the string.
 def readNewick(nwFile,multipleTrees=False,dirtiness=True,createDict=False,inputDictNames=None,keepNames=False):
-	phyloFile=open(nwFile)
+	phyloFile=openFile(nwFile)
 	trees=[]
 	line=phyloFile.readline()
 	if inputDictNames==None and (not keepNames):
-		namesInTree=[]
-	if createDict:
-		namesInTreeDict={}
-	sampleNum=0
+		namesInTree=NameStore()
 	while line!="":
 		while line=="\n":
 			line=phyloFile.readline()
 		if line=="":
 			break
+		nwString=line.replace("\n","")
+		line=None
+		numNodes=countNewickNodes(nwString)
 		tree=Tree()
-		tree.addNode(dirtiness=dirtiness)
+		tree.addNodes(numNodes,dirtiness=dirtiness)
 		if keepInputIQtreeSupports:
-			tree.IQsupport=[0.0]
-		nwString=line.replace("\n","")
-		index=0
-		nodeIndex=len(tree.name)-1
+			tree.IQsupport=[None]*numNodes
+			tree.IQsupport[0]=0.0
+		up=tree.up
+		children=tree.children
+		names=tree.name
+		dist=tree.dist
+		nodeIndex=0
+		nextNode=1
 		name=""
 		distStr=""
+		afterClade=False
 		finished=False
-		while index<len(nwString):
-			if nwString[index]=="(":
-				tree.children[nodeIndex].append(len(tree.up))
-				tree.addNode(dirtiness=dirtiness)
-				if keepInputIQtreeSupports:
-					tree.IQsupport.append(None)
-				tree.up[-1]=nodeIndex
-				nodeIndex=len(tree.up)-1
-				index+=1
-			elif nwString[index]==";":
-				trees.append((tree,nodeIndex))
-				finished=True
-				break
-			elif nwString[index]=="[":
-				while nwString[index]!="]":
-					index+=1
-				index+=1
-			elif nwString[index]==":":
-				index+=1
-				while nwString[index]!="," and nwString[index]!=")" and nwString[index]!=";":
-					distStr+=nwString[index]
-					index+=1
-			elif nwString[index]==",":
+		for token in newickTokens.finditer(nwString):
+			token=token.group()
+			char=token[0]
+			if char=="(":
+				children[nodeIndex].append(nextNode)
+				up[nextNode]=nodeIndex
+				nodeIndex=nextNode
+				nextNode+=1
+				afterClade=False
+			elif char=="," or char==")":
 				if name!="":
 					if keepNames:
-						tree.name[nodeIndex]=name
+						names[nodeIndex]=name
 					elif inputDictNames==None:
-						tree.name[nodeIndex]=sampleNum
-						if createDict:
-							namesInTreeDict[name]=sampleNum
-						sampleNum+=1
-						namesInTree.append(name)
+						names[nodeIndex]=namesInTree.append(name)
 					else:
-						tree.name[nodeIndex]=inputDictNames[name]
+						names[nodeIndex]=inputDictNames.nameId(name)
+						if names[nodeIndex]==None:
+							print("Error, sample "+name+" in the newick string in file "+nwFile+" is not in the first input tree.")
+							raise Exception("exit")
 					name=""
 				if distStr!="":
-					tree.dist[nodeIndex]=float(distStr)*normalizeInputBLen
-					if tree.dist[nodeIndex]<0.0:
+					dist[nodeIndex]=float(distStr)*normalizeInputBLen
+					if char=="," and dist[nodeIndex]<0.0:
 						print("Warning: negative branch length in the input tree: "+distStr+" ; converting it to positive.")
-						tree.dist[nodeIndex]=abs(tree.dist[nodeIndex])
-					distStr=""
-				else:
-					tree.dist[nodeIndex]=defaultBLen
-				nodeIndex=tree.up[nodeIndex]
-				tree.children[nodeIndex].append(len(tree.up))
-				tree.addNode(dirtiness=dirtiness)
-				if keepInputIQtreeSupports:
-					tree.IQsupport.append(None)
-				tree.up[-1]=nodeIndex
-				nodeIndex=len(tree.up)-1
-				index+=1
-			elif nwString[index]==")":
-				if name!="":
-					if keepNames:
-						tree.name[nodeIndex]=name
-					elif inputDictNames==None:
-						tree.name[nodeIndex]=sampleNum
-						if createDict:
-							namesInTreeDict[name]=sampleNum
-						sampleNum+=1
-						namesInTree.append(name)
-					else:
-						tree.name[nodeIndex]=inputDictNames[name]
-					name=""
-				if distStr!="":
-					tree.dist[nodeIndex]=float(distStr)*normalizeInputBLen
+						dist[nodeIndex]=abs(dist[nodeIndex])
 					distStr=""
 				else:
-					tree.dist[nodeIndex]=defaultBLen
-				if keepInputIQtreeSupports:
-					suppStr=""
-					index+=1
-					while nwString[index]!=":" and nwString[index]!=")" and nwString[index]!=";":
-						suppStr+=nwString[index]
-						index+=1
-					if suppStr!="":
-						suppVal=float(suppStr.split("/")[-1])
-						if suppVal>1:
-							suppVal=suppVal/100.0
-						tree.IQsupport[tree.up[nodeIndex]]=suppVal
+					dist[nodeIndex]=defaultBLen
+				nodeIndex=up[nodeIndex]
+				if char==",":
+					children[nodeIndex].append(nextNode)
+					up[nextNode]=nodeIndex
+					nodeIndex=nextNode
+					nextNode+=1
+					afterClade=False
 				else:
-					index+=1
-				nodeIndex=tree.up[nodeIndex]
+					afterClade=True
+			elif char==";":
+				trees.append((tree,nodeIndex))
+				finished=True
+				break
+			elif char==":":
+				distStr+=token[1:]
+				afterClade=False
+			elif char=="[":
+				pass
+			elif afterClade and keepInputIQtreeSupports:
+				suppVal=float(token.split("/")[-1])
+				if suppVal>1:
+					suppVal=suppVal/100.0
+				tree.IQsupport[nodeIndex]=suppVal
+				afterClade=False
 			else:
-				name+=nwString[index]
-				index+=1
+				name+=token
 		if not finished:
 			print("Error, final character ; not found in newick string in file "+nwFile+".")
 			raise Exception("exit")
+		if nextNode<numNodes:
+			print("Error, could not parse the newick string in file "+nwFile+".")
+			raise Exception("exit")
+		nwString=None
 
 		if not multipleTrees:
 			break
@@ -448,7 +795,8 @@ def readNewick(nwFile,multipleTrees=False,dirtiness=True,createDict=False,inputD
 	if keepNames:
 		return trees
 	elif createDict:
-		return trees, namesInTree, namesInTreeDict
+		#the NameStore of the names in the tree also maps the names to their ids.
+		return trees, namesInTree, namesInTree
 	elif inputDictNames==None:
 		return trees, namesInTree
 	else:
@@ -513,7 +861,7 @@ def assignNodeFeatures(featureDicts,nodeIndex,annotationString):
 #function to read input nexus file
 def readNexus(nxFile,dirtiness=True):
 	print("Reading Nexus file "+nxFile)
-	phyloFile=open(nxFile)
+	phyloFile=openFile(nxFile)
 	line=phyloFile.readline()
 	while line!="begin trees;\n":
 		line=phyloFile.readline()
@@ -825,6 +1173,7 @@ def reRootTree(tree,root,sample,reRootAtInternalNode=False):
 				newMutations=flipMutations(oldMutations)
 				oldMutations=mutations[currentNode]
 				mutations[currentNode]=newMutations
+				indexNodeMutations(tree,currentNode)
 			oldBLen=dist[currentNode]
 			oldPNode=up[currentNode]
 			dist[currentNode]=currentBLen
@@ -848,6 +1197,8 @@ def reRootTree(tree,root,sample,reRootAtInternalNode=False):
 			newMutations=flipMutations(oldMutations)
 			mutations[children[currentNode][1-numChild]]=mergeMutationLists(newMutations,mutations[children[currentNode][1-numChild]])
 			mutations[newRoot]=rootMuts
+			indexNodeMutations(tree,children[currentNode][1-numChild])
+			indexNodeMutations(tree,newRoot)
 		children[currentChild][numChildChild]=children[currentNode][1-numChild]
 		up[children[currentNode][1-numChild]]=currentChild
 		dist[children[currentNode][1-numChild]]+=currentBLen
@@ -1158,13 +1509,10 @@ def RobinsonFouldsWithDay1985(tree,t2,leafNameDict,nodeTable,leafCount,numBranch
 	return numDiffs, float(numDiffs)/(normalization), leafCount, foundBranches, missedBranches, (numBranches-foundBranches), RFL
 
 
-performLineageAssignment=False
-if assignmentFile!="" or assignmentFileCSV!="":
-	performLineageAssignment=True
 
 
 #generate the string corresponding to a node, taking into account support measures and other possible node features.
-def stringForNode(tree,nextNode,nameNode,distB,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=None):
+def stringForNode(tree,nextNode,nameNode,distB,estimateMAT=False,networkOutput=False,aBayesPlusOn=False,namesInTree=None):
 	children=tree.children
 	up=tree.up
 	name=tree.name
@@ -1361,10 +1709,42 @@ def stringForNode(tree,nextNode,nameNode,distB,estimateMAT=estimateMAT,networkOu
 	return finalString
 
 
+#number of pieces of newick string collected before they are written to file by createNewick().
+newickChunkSize=100000
+
 #create newick string of a given tree (input node is assumed to be the root) - with option "binary" the generated tree is binary (polytomies are represented with branches of length 0).
-def createNewick(tree,node,binary=True,namesInTree=None,includeMinorSeqs=True,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn):
-	nextNode=node
+#If an output file is given, the newick string is written to it in chunks during the tree traversal instead of being returned;
+# if also plainFile is given, the newick string without the annotations of options estimateMAT, networkOutput and aBayesPlusOn is written to it within the same traversal.
+def createNewick(tree,node,binary=True,namesInTree=None,includeMinorSeqs=True,estimateMAT=False,networkOutput=False,aBayesPlusOn=False,file=None,plainFile=None):
 	stringList=[]
+	plainList=None
+	if file!=None and plainFile!=None:
+		plainList=[]
+	#add a piece of the newick string (plainString is the corresponding piece of the plain newick string, if different).
+	def add(string,plainString=None):
+		stringList.append(string)
+		if plainList!=None:
+			if plainString==None:
+				plainList.append(string)
+			else:
+				plainList.append(plainString)
+		if file!=None and len(stringList)>=newickChunkSize:
+			file.write("".join(stringList))
+			stringList.clear()
+			if plainList!=None:
+				plainFile.write("".join(plainList))
+				plainList.clear()
+	#the annotations of a node are only added to the plain newick string where they would be without estimateMAT, networkOutput and aBayesPlusOn
+	# (that is, with lineage assignment or for minor sequences, when inPlainTree is True).
+	def addNodeString(nextNode,nameNode,distB,inPlainTree=True):
+		plainString=None
+		if plainList!=None and (estimateMAT or networkOutput or aBayesPlusOn):
+			if inPlainTree:
+				plainString=stringForNode(tree,nextNode,nameNode,distB,namesInTree=namesInTree)
+			else:
+				plainString=""
+		add(stringForNode(tree,nextNode,nameNode,distB,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree),plainString)
+	nextNode=node
 	direction=0
 	numLeaves=0
 	up=tree.up
@@ -1376,27 +1756,27 @@ def createNewick(tree,node,binary=True,namesInTree=None,includeMinorSeqs=True,es
 		if children[nextNode]:
 			if direction==0:
 				if dist[nextNode] or binary or up[nextNode]==None:
-					stringList.append("(")
+					add("(")
 				nextNode=children[nextNode][0]
 			elif direction==1:
-				stringList.append(",")
+				add(",")
 				nextNode=children[nextNode][1]
 				direction=0
 			else:
 				if dist[nextNode] or binary or up[nextNode]==None:
 					if namesInTree==None:
-						stringList.append(")"+name[nextNode])
+						add(")"+name[nextNode])
 					else:
 						if name[nextNode]=="":
-							stringList.append(")")
+							add(")")
 						else:
-							stringList.append(")"+namesInTree[name[nextNode]])
+							add(")"+namesInTree[name[nextNode]])
 					if aBayesPlusOn or estimateMAT or performLineageAssignment:
-						stringList.append(stringForNode(tree,nextNode,"",dist[nextNode],estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+						addNodeString(nextNode,"",dist[nextNode],inPlainTree=performLineageAssignment)
 					if dist[nextNode]:
-						stringList.append(":"+str(dist[nextNode]))
+						add(":"+str(dist[nextNode]))
 					else:
-						stringList.append(":"+str(0.0))
+						add(":"+str(0.0))
 				if up[nextNode]!=None:
 					if children[up[nextNode]][0]==nextNode:
 						direction=1
@@ -1408,100 +1788,105 @@ def createNewick(tree,node,binary=True,namesInTree=None,includeMinorSeqs=True,es
 			if len(minorSequences[nextNode])>0 and includeMinorSeqs:
 				if binary:
 					for i in minorSequences[nextNode]:
-						stringList.append("(")
+						add("(")
 					if supportForIdenticalSequences or performLineageAssignment:
 						if namesInTree==None:
-							stringList.append(stringForNode(tree,nextNode,name[nextNode],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,name[nextNode],0.0)
 						else:
-							stringList.append(stringForNode(tree,nextNode,namesInTree[name[nextNode]],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,namesInTree[name[nextNode]],0.0)
 					else:
 						if namesInTree==None:
-							stringList.append(name[nextNode])
+							add(name[nextNode])
 						else:
 							if name[nextNode]!="":
-								stringList.append(namesInTree[name[nextNode]])
-					stringList.append(":")
+								add(namesInTree[name[nextNode]])
+					add(":")
 					for s2 in minorSequences[nextNode][:-1]:
-						stringList.append("0.0,")
+						add("0.0,")
 						if supportForIdenticalSequences or performLineageAssignment:
 							if namesInTree==None:
-								stringList.append(stringForNode(tree,nextNode,s2,0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+								addNodeString(nextNode,s2,0.0)
 							else:
-								stringList.append(stringForNode(tree,nextNode,namesInTree[s2],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+								addNodeString(nextNode,namesInTree[s2],0.0)
 						else:
 							if namesInTree==None:
-								stringList.append(s2)
+								add(s2)
 							else:
-								stringList.append(namesInTree[s2])
-						stringList.append(":0.0):")
-					stringList.append("0.0,")
+								add(namesInTree[s2])
+						add(":0.0):")
+					add("0.0,")
 					if supportForIdenticalSequences or performLineageAssignment:
 						if namesInTree==None:
-							stringList.append(stringForNode(tree,nextNode,minorSequences[nextNode][-1],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,minorSequences[nextNode][-1],0.0)
 						else:
-							stringList.append(stringForNode(tree,nextNode,namesInTree[minorSequences[nextNode][-1]],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,namesInTree[minorSequences[nextNode][-1]],0.0)
 					else:
 						if namesInTree==None:
-							stringList.append(minorSequences[nextNode][-1])
+							add(minorSequences[nextNode][-1])
 						else:
-							stringList.append(namesInTree[minorSequences[nextNode][-1]])
+							add(namesInTree[minorSequences[nextNode][-1]])
 					if namesInTree==None:
-						stringList.append(":0.0)"+name[nextNode]+"_MinorSeqsClade")
+						add(":0.0)"+name[nextNode]+"_MinorSeqsClade")
 					else:
-						stringList.append(":0.0)"+namesInTree[name[nextNode]]+"_MinorSeqsClade")
+						add(":0.0)"+namesInTree[name[nextNode]]+"_MinorSeqsClade")
 				else:
 					if dist[nextNode] or up[nextNode]==None:
-						stringList.append("(")
+						add("(")
 					if supportForIdenticalSequences or performLineageAssignment:
 						if namesInTree==None:
-							stringList.append(stringForNode(tree,nextNode,name[nextNode],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,name[nextNode],0.0)
 						else:
-							stringList.append(stringForNode(tree,nextNode,namesInTree[name[nextNode]],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+							addNodeString(nextNode,namesInTree[name[nextNode]],0.0)
 					else:
 						if namesInTree==None:
-							stringList.append(name[nextNode])
+							add(name[nextNode])
 						else:
 							if name[nextNode]!="":
-								stringList.append(namesInTree[name[nextNode]])
-					stringList.append(":0.0")
+								add(namesInTree[name[nextNode]])
+					add(":0.0")
 					for s2 in minorSequences[nextNode]:
-						stringList.append(",")
+						add(",")
 						if supportForIdenticalSequences or performLineageAssignment:
 							if namesInTree==None:
-								stringList.append(stringForNode(tree,nextNode,s2,0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+								addNodeString(nextNode,s2,0.0)
 							else:
-								stringList.append(stringForNode(tree,nextNode,namesInTree[s2],0.0,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+								addNodeString(nextNode,namesInTree[s2],0.0)
 						else:
 							if namesInTree==None:
-								stringList.append(s2)
+								add(s2)
 							else:
-								stringList.append(namesInTree[s2])
-						stringList.append(":0.0")
+								add(namesInTree[s2])
+						add(":0.0")
 					if dist[nextNode] or up[nextNode]==None:
 						if namesInTree==None:
-							stringList.append(")"+name[nextNode]+"_MinorSeqsClade")
+							add(")"+name[nextNode]+"_MinorSeqsClade")
 						else:
-							stringList.append(")"+namesInTree[name[nextNode]]+"_MinorSeqsClade")
+							add(")"+namesInTree[name[nextNode]]+"_MinorSeqsClade")
 			else:
 				if namesInTree==None:
-					stringList.append(name[nextNode])
+					add(name[nextNode])
 				else:
 					if name[nextNode]!="":
-						stringList.append(namesInTree[name[nextNode]])
+						add(namesInTree[name[nextNode]])
 			if aBayesPlusOn or estimateMAT or performLineageAssignment:
-				stringList.append(stringForNode(tree,nextNode,"",dist[nextNode],estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,namesInTree=namesInTree))
+				addNodeString(nextNode,"",dist[nextNode],inPlainTree=performLineageAssignment)
 			if dist[nextNode]:
-				stringList.append(":"+str(dist[nextNode]))
+				add(":"+str(dist[nextNode]))
 			else:
-				stringList.append(":"+str(0.0))
+				add(":"+str(0.0))
 			if up[nextNode]!=None:
 				if children[up[nextNode]][0]==nextNode:
 					direction=1
 				else:
 					direction=2
 			nextNode=up[nextNode]
-	stringList.append(";")
+	add(";")
 	print("created newick string for tree with "+str(numLeaves)+" leaves.")
+	if file!=None:
+		file.write("".join(stringList))
+		if plainList!=None:
+			plainFile.write("".join(plainList))
+		return None
 	return "".join(stringList)
 
 
@@ -1539,7 +1924,8 @@ def countTips(tree,node):
 
 
 #write all taxa names to file - used for writing nexus files in BEAST fashion.
-def writeTaxaNames(file,tree,node):
+#If namesInTree is given, node names are ids in namesInTree, and are only decoded here.
+def writeTaxaNames(file,tree,node,namesInTree=None):
 	nextNode=node
 	direction=0
 	numSamples=0
@@ -1562,9 +1948,14 @@ def writeTaxaNames(file,tree,node):
 						direction=2
 				nextNode=up[nextNode]
 		else:
-			file.write("	"+name[nextNode]+"\n")
-			for samName in minorSequences[nextNode]:
-				file.write("	"+samName+"\n")
+			if namesInTree==None:
+				file.write("	"+name[nextNode]+"\n")
+				for samName in minorSequences[nextNode]:
+					file.write("	"+samName+"\n")
+			else:
+				file.write("	"+namesInTree[name[nextNode]]+"\n")
+				for samName in minorSequences[nextNode]:
+					file.write("	"+namesInTree[samName]+"\n")
 			if up[nextNode]!=None:
 				if children[up[nextNode]][0]==nextNode:
 					direction=1
@@ -1674,32 +2065,8 @@ def calculateNDesc0(tree,root,checkExisting=False):
 		print("number of internal node problems: "+str(numProblems))
 
 topologyChanges=[0]
-if writeTreesToFileEveryTheseSteps>0:
-	lineSplit=outputFile.split("/")
-	lineSplit[-1]=""
-	outFolder="/".join(lineSplit)
-	if not os.path.isdir(outFolder):
-		print("Path to output file "+outFolder+" does not exist, quitting MAPLE. Use option --output to specify a valid output file path and output file name.")
-		raise Exception("exit")
-	if os.path.isfile(outputFile+"_intermediateTrees.tree")  and (not overwrite):
-		print("File "+outputFile+"_intermediateTrees.tree already exists, quitting MAPLE. Use option --overwrite if you want to overwrite previous inference.")
-		raise Exception("exit")
-	intermediateTreesFile=open(outputFile+"_intermediateTrees.tree","w")
-if writeLKsToFileEveryTheseSteps>0:
-	lineSplit=outputFile.split("/")
-	lineSplit[-1]=""
-	outFolder="/".join(lineSplit)
-	if not os.path.isdir(outFolder):
-		print("Path to output file "+outFolder+" does not exist, quitting MAPLE. Use option --output to specify a valid output file path and output file name.")
-		raise Exception("exit")
-	if os.path.isfile(outputFile+"_intermediateLKs.txt")  and (not overwrite):
-		print("File "+outputFile+"_intermediateLKs.txt already exists, quitting MAPLE. Use option --overwrite if you want to overwrite previous inference.")
-		raise Exception("exit")
-	intermediateLKsFile=open(outputFile+"_intermediateLKs.txt","w")
-
-
-#run Robinson-Foulds distance calculations
-if inputRFtrees!="":
+#run Robinson-Foulds distance calculations between the tree in option --inputTree and the trees in option --inputRFtrees
+def compareTreesRF():
 	if not os.path.isfile(inputTree):
 		print("Input tree in newick format "+inputTree+" not found, quitting MAPLE RF distance calculation. Use option --inputTree to specify a valid input newick tree file.")
 		raise Exception("exit")
@@ -1729,12 +2096,12 @@ if inputRFtrees!="":
 		file.write(str(numDiffs)+"\t"+str(normalisedRF)+"\t"+str(leafCount)+"\t"+str(foundBranches)+"\t"+str(missedBranches)+"\t"+str(notFoundBranches)+"\t"+str(RFL)+"\n")
 	print("Comparison ended")
 	file.close()
-	raise Exception("exit")
+	return
 
 
 #run lineage assignment of samples in input tree following the input references
 #beacuse this is run on an input tree, we don't need to consider minorSequences.
-if performLineageAssignment:
+def assignLineages():
 	if assignmentFile!="" and assignmentFileCSV!="":
 		print("Please only use one between options --assignmentFile and --assignmentFileCSV .")
 		raise Exception("exit")
@@ -1753,8 +2120,8 @@ if performLineageAssignment:
 	if not os.path.isdir(outFolder):
 		print("Path to output file "+outFolder+" does not exist, quitting MAPLE lineage assignment. Use option --output to specify a valid output file path and output file name.")
 		raise Exception("exit")
-	if os.path.isfile(outputFile+"_lineageAssignments.csv")  and (not overwrite):
-		print("File "+outputFile+"_lineageAssignments.csv already exists, quitting MAPLE lineage assignment. Use option --overwrite if you want to overwirte previous inference.")
+	if os.path.isfile(outputFileName(outputFile+"_lineageAssignments.csv"))  and (not overwrite):
+		print("File "+outputFileName(outputFile+"_lineageAssignments.csv")+" already exists, quitting MAPLE lineage assignment. Use option --overwrite if you want to overwirte previous inference.")
 		raise Exception("exit")
 	print("Reading input tree")
 	if os.path.isfile(inputNexusTree):
@@ -1768,7 +2135,7 @@ if performLineageAssignment:
 	giveInternalNodeNames(tree1,rootIndex1,replaceNames=False)
 	print("Input tree read")
 	if assignmentFileCSV!="":
-		referencesFile=open(assignmentFileCSV)
+		referencesFile=openFile(assignmentFileCSV)
 		line=referencesFile.readline()
 		references={}
 		while line!="":
@@ -1777,7 +2144,7 @@ if performLineageAssignment:
 				references[linelist[0]]=linelist[1].replace("\n","")
 			line=referencesFile.readline()
 	else:
-		referencesFile=open(assignmentFile)
+		referencesFile=openFile(assignmentFile)
 		line=referencesFile.readline()
 		references={}
 		while line!="":
@@ -1786,7 +2153,7 @@ if performLineageAssignment:
 				references[name]=name
 			line=referencesFile.readline()
 	print("Input lineage definition read")
-	file=open(outputFile+"_lineageAssignments.csv","w")
+	file=openFile(outputFileName(outputFile+"_lineageAssignments.csv"),"w")
 
 	node=rootIndex1
 	direction=0 #0=from parent, 1+ from children
@@ -2014,49 +2381,18 @@ if performLineageAssignment:
 		print("Finished second tree pass for lineage assignment with uncertainty")
 	print("Lineage assignment completed")
 	file.close()
-	newickString=createNewick(tree1,rootIndex1,binary=binaryTree,namesInTree=None)
-	file=open(outputFile+"_nexusTree.tree","w")
+	file=openFile(outputFileName(outputFile+"_nexusTree.tree"),"w")
 	file.write("#NEXUS\nbegin taxa;\n	dimensions ntax="+str(countTips(tree1,rootIndex1))+";\n	taxlabels\n")
 	writeTaxaNames(file,tree1,rootIndex1)
 	file.write(";\nend;\n\nbegin trees;\n	tree TREE1 = [&R] ")
-	file.write(newickString)
+	createNewick(tree1,rootIndex1,binary=binaryTree,namesInTree=None,estimateMAT=estimateMAT,networkOutput=networkOutput,file=file)
 	file.write("\nend;\n")
 	file.close()
 	print("Output nexus tree with lineage assignments created.")
-	exit()
+	return
 
-	
-minimumCarryOver=sys.float_info.min*(1e50)
 
-if os.path.isfile(outputFile+"_tree.tree")  and (not overwrite):
-	print("File "+outputFile+"_tree.tree already exists, quitting MAPLE tree inference. Use option --overwrite if you want to overwirte previous inference.")
-	raise Exception("exit")
-if not os.path.isfile(inputFile):
-	print("Input file in Maple format "+inputFile+" not found, quitting MAPLE tree inference. Use option --input to specify a valid input file.")
-	raise Exception("exit")
-if refFile!="" and (not os.path.isfile(refFile)):
-	print("Input reference fasta file "+refFile+" not found, quitting MAPLE tree inference. Use option --reference to specify a valid input reference file.")
-	raise Exception("exit")
-lineSplit=outputFile.split("/")
-lineSplit[-1]=""
-outFolder="/".join(lineSplit)
-if not os.path.isdir(outFolder):
-	print("Path to output file "+outFolder+" does not exist, quitting MAPLE tree inference. Use option --output to specify a valid output file path and output file name.")
-	raise Exception("exit")
-if inputTree!="":
-	if not os.path.isfile(inputTree):
-		print("Input tree in newick format "+inputTree+" not found, quitting MAPLE. Use option --inputTree to specify a valid input newick tree file.")
-		raise Exception("exit")
-	trees, namesInTree, namesInTreeDict=readNewick(inputTree,dirtiness=largeUpdate,createDict=True)
-	tree1,rootIndex1=trees[0]
-	print("Read input newick tree")
-	makeTreeBinary(tree1,rootIndex1)
-	#TODO
-	if HnZ:
-		calculateNDesc0(tree1,rootIndex1)
-else:
-	namesInTree=[]
-	namesInTreeDict={}
+minimumCarryOver=sys.float_info.min*(1e50)
 
 alleles={"A":0,"C":1,"G":2,"T":3}
 allelesList=["A","C","G","T"]
@@ -2069,7 +2405,7 @@ ambiguities={"y":[0.0,0.5,0.0,0.5],"r":[0.5,0.0,0.5,0.0],"w":[0.5,0.0,0.0,0.5],"
 
 #collect reference
 def collectReference(fileName):
-	file=open(fileName)
+	file=openFile(fileName)
 	line=file.readline()
 	ref=""
 	while line!="":
@@ -2080,9 +2416,100 @@ def collectReference(fileName):
 	return ref
 
 
-#Read input file
-def readConciseAlignment(fileName,extractReference=True,ref=""): #extractNames=False
-	fileI=open(fileName)
+#Index of the samples in an input MAPLE file: instead of keeping the diffs of all samples in memory, only their byte range in the file is kept,
+# and the diffs of a sample are parsed again from the (memory-mapped) file when they are requested with data[name].
+#It is created with readConciseAlignment(fileName,streaming=True), which also stores the numbers used by distancesFromRefPunishNs() to sort the samples.
+#Setting data[name]=None forgets the sample, as for the dictionary normally returned by readConciseAlignment().
+class ConciseAlignmentIndex(object):
+	def __init__(self,fileName):
+		self.fileName=fileName
+		self.offsets={}
+		self.diffCounts={}
+		self.inMemory={}
+		self.file=open(fileName,"rb")
+		self.position=0
+		self.lineStart=0
+		self.mmap=None
+
+	def __repr__(self):
+		return "ConciseAlignmentIndex object"
+
+	#read the next line of the file during the first pass, keeping track of where it starts.
+	def readline(self):
+		line=self.file.readline()
+		self.lineStart=self.position
+		self.position+=len(line)
+		return line.decode()
+
+	#end of the first pass: the file is then only accessed through mmap.
+	def close(self):
+		if self.position>0:
+			self.mmap=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+		self.file.close()
+
+	def addSample(self,name,start,end,diffs,lRef):
+		self.offsets[name]=(start,end)
+		self.diffCounts[name]=countDiffsFromRef(diffs,lRef)
+
+	def __getitem__(self,name):
+		if name in self.inMemory:
+			return self.inMemory[name]
+		start,end=self.offsets[name]
+		seqList=[]
+		for line in self.mmap[start:end].decode().split("\n"):
+			linelist=line.split()
+			if len(linelist)>2:
+				seqList.append((linelist[0].lower(),int(linelist[1]),int(linelist[2])))
+			elif linelist:
+				seqList.append((linelist[0].lower(),int(linelist[1])))
+		return seqList
+
+	def __setitem__(self,name,diffs):
+		if diffs==None:
+			self.offsets.pop(name,None)
+			self.inMemory.pop(name,None)
+		else:
+			self.inMemory[name]=diffs
+
+	def __contains__(self,name):
+		return (name in self.offsets) or (name in self.inMemory)
+
+	def __len__(self):
+		return len(self.keys())
+
+	def keys(self):
+		return list(self.offsets.keys())+[name for name in self.inMemory if not (name in self.offsets)]
+
+	def clear(self):
+		self.offsets.clear()
+		self.diffCounts.clear()
+		self.inMemory.clear()
+		if self.mmap!=None:
+			self.mmap.close()
+			self.mmap=None
+
+
+#Read input file.
+#With streaming=True the diffs are not kept in memory, and a ConciseAlignmentIndex is returned instead of a dictionary.
+#Binary alignment files (see writeBinaryAlignment()) are recognized automatically and read through mmap.
+def readConciseAlignment(fileName,extractReference=True,ref="",streaming=False): #extractNames=False
+	if isBinaryAlignment(fileName):
+		binaryRef, data=readBinaryAlignment(fileName)
+		if extractReference:
+			return binaryRef, data
+		if binaryRef!=ref:
+			print("The reference genome in binary alignment file "+fileName+" is different from the input reference.")
+			raise Exception("exit")
+		return data
+	if streaming and isCompressedFile(fileName):
+		print("Warning: compressed input file "+fileName+" cannot be indexed for option --streamInput, so it will be read into memory.")
+		streaming=False
+	if streaming:
+		data=ConciseAlignmentIndex(fileName)
+		fileI=data
+	else:
+		data={}
+		fileI=openFile(fileName)
 	line=fileI.readline()
 	if extractReference:
 		line=fileI.readline()
@@ -2092,11 +2519,11 @@ def readConciseAlignment(fileName,extractReference=True,ref=""): #extractNames=F
 			line=fileI.readline()
 		ref=ref.lower()
 	nSeqs=0
-	data={}
 	while line!="" and line!="\n":
 		seqList=[]
 		name=line.replace(">","").replace("\n","")
 		line=fileI.readline()
+		start=fileI.lineStart if streaming else 0
 		pos=0
 		while line!="" and line!="\n" and line[0]!=">":
 			linelist=line.split()
@@ -2123,7 +2550,10 @@ def readConciseAlignment(fileName,extractReference=True,ref=""): #extractNames=F
 				else:
 					pos=entry[1]+entry[2]-1
 			line=fileI.readline()
-		data[name]=seqList
+		if streaming:
+			data.addSample(name,start,fileI.lineStart,seqList,len(ref))
+		else:
+			data[name]=seqList
 		nSeqs+=1
 	fileI.close()
 	print(str(nSeqs)+" sequences in diff file.")
@@ -2133,50 +2563,347 @@ def readConciseAlignment(fileName,extractReference=True,ref=""): #extractNames=F
 		return data
 
 
-if refFile=="":
-	ref, data=readConciseAlignment(inputFile) #extractNames=extractNamesFlag
-else:
-	ref=collectReference(refFile)
-	data=readConciseAlignment(inputFile, extractReference=False, ref=ref) #,extractNames=extractNamesFlag
-		
-lRef=len(ref)
-globalTotRate=-float(lRef)
-print("Length of reference genome: "+str(lRef))
-logLRef=log(lRef)
-thresholdLogLKoptimizationTopology*=logLRef
-thresholdLogLKoptimization*=logLRef
-thresholdLogLKtopology*=logLRef
-thresholdLogLK*=logLRef
-thresholdLogLKtopologyInitial*=logLRef
-effectivelyNon0BLen=1.0/(10*lRef)
-
-#vector to count how many bases of each type are cumulatively in the reference genome up to a certain position
-cumulativeBases=[[0,0,0,0]]
-for i in range(lRef):
-	cumulativeBases.append(list(cumulativeBases[i]))
-	if (ref[i] in allelesList) or (ref[i] in allelesListLow):
-		cumulativeBases[i+1][allelesUpOrLow[ref[i]]]+=1
-rootFreqs=[0.0,0.0,0.0,0.0]
-rootFreqsLog=[0.0,0.0,0.0,0.0]
-for i in range(4):
-	rootFreqs[i]=cumulativeBases[-1][i]/float(lRef)
-	rootFreqsLog[i]=log(rootFreqs[i])
-refIndeces=[]
-for i in range(lRef):
-	if (ref[i] in allelesList) or (ref[i] in allelesListLow):
-		refIndeces.append(allelesLow[ref[i]])
+#Binary alignment format, faster to load than the text MAPLE format and allowing to access any sample by name.
+#After a header (magic string, version, reference length, number of samples, total number of diff entries) the file contains, each section padded to 8 bytes:
+# the reference; the offsets of the sample names and the names; the offset of the first entry of each sample;
+# the number of differences and informative positions of each sample (as used by distancesFromRefPunishNs());
+# and then for all entries of all samples, their type character, their position, and their length (0 for entries spanning only one position).
+#Arrays are stored in little-endian order.
+binaryAlignmentMagic=b"MAPLEBIN"
+binaryAlignmentHeader=struct.Struct("<8sIIIQ")
+
+def padTo8(file,position):
+	if position%8:
+		file.write(bytes(8-(position%8)))
+		position+=8-(position%8)
+	return position
+
+#write (already read) alignment data into a binary alignment file.
+def writeBinaryAlignment(fileName,ref,data):
+	if sys.byteorder!="little":
+		print("Binary alignment files are only supported on little-endian machines.")
+		raise Exception("exit")
+	names=list(data.keys())
+	nameOffsets=array("Q",[0])
+	nameBytes=bytearray()
+	entryOffsets=array("Q",[0])
+	diffNums=array("I")
+	comparisonNums=array("I")
+	types=bytearray()
+	positions=array("I")
+	lengths=array("I")
+	for name in names:
+		nameBytes+=name.encode()
+		nameOffsets.append(len(nameBytes))
+		diffs=data[name]
+		for entry in diffs:
+			types.append(ord(entry[0]))
+			positions.append(entry[1])
+			if len(entry)>2:
+				lengths.append(entry[2])
+			else:
+				lengths.append(0)
+		entryOffsets.append(len(types))
+		diffNum,comparisons=countDiffsFromRef(diffs,len(ref))
+		diffNums.append(diffNum)
+		comparisonNums.append(comparisons)
+	file=open(fileName,"wb")
+	position=file.write(binaryAlignmentHeader.pack(binaryAlignmentMagic,1,len(ref),len(names),len(types)))
+	for section in (ref.encode(),nameOffsets,nameBytes,entryOffsets,diffNums,comparisonNums,types,positions,lengths):
+		position+=file.write(section)
+		position=padTo8(file,position)
+	file.close()
+	print("Binary alignment with "+str(len(names))+" sequences written to file "+fileName)
+
+def isBinaryAlignment(fileName):
+	file=openFile(fileName,"rb")
+	magic=file.read(len(binaryAlignmentMagic))
+	file.close()
+	if magic==binaryAlignmentMagic and isCompressedFile(fileName):
+		print("Binary alignment file "+fileName+" is read through mmap, so it needs to be decompressed before use.")
+		raise Exception("exit")
+	return magic==binaryAlignmentMagic
+
+#Binary alignment file opened with mmap: only the names are read when opening it, while the entries of a sample are read from the file when requested with data[name].
+class BinaryAlignment(ConciseAlignmentIndex):
+	def __init__(self,fileName):
+		if sys.byteorder!="little":
+			print("Binary alignment files are only supported on little-endian machines.")
+			raise Exception("exit")
+		self.fileName=fileName
+		self.inMemory={}
+		file=open(fileName,"rb")
+		self.mmap=mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+		file.close()
+		self.view=memoryview(self.mmap)
+		magic,version,lRef,nSamples,nEntries=binaryAlignmentHeader.unpack_from(self.mmap,0)
+		if magic!=binaryAlignmentMagic or version!=1:
+			print("File "+fileName+" is not a binary alignment file of a supported version.")
+			raise Exception("exit")
+		self.position=binaryAlignmentHeader.size
+		self.ref=bytes(self.nextSection(lRef)).decode()
+		nameOffsets=self.nextSection(8*(nSamples+1)).cast("Q")
+		nameBytes=self.nextSection(nameOffsets[-1])
+		self.entryOffsets=self.nextSection(8*(nSamples+1)).cast("Q")
+		diffNums=self.nextSection(4*nSamples).cast("I")
+		comparisonNums=self.nextSection(4*nSamples).cast("I")
+		self.types=self.nextSection(nEntries)
+		self.positions=self.nextSection(4*nEntries).cast("I")
+		self.lengths=self.nextSection(4*nEntries).cast("I")
+		self.offsets={}
+		self.diffCounts={}
+		for i in range(nSamples):
+			name=bytes(nameBytes[nameOffsets[i]:nameOffsets[i+1]]).decode()
+			self.offsets[name]=i
+			self.diffCounts[name]=(diffNums[i],comparisonNums[i])
+
+	def __repr__(self):
+		return "BinaryAlignment object"
+
+	#memoryview of the next section of the file, skipping the padding at its end.
+	def nextSection(self,size):
+		section=self.view[self.position:self.position+size]
+		self.position+=size
+		if self.position%8:
+			self.position+=8-(self.position%8)
+		return section
+
+	def __getitem__(self,name):
+		if name in self.inMemory:
+			return self.inMemory[name]
+		i=self.offsets[name]
+		start=self.entryOffsets[i]
+		end=self.entryOffsets[i+1]
+		types=bytes(self.types[start:end]).decode()
+		positions=self.positions[start:end].tolist()
+		lengths=self.lengths[start:end].tolist()
+		seqList=[]
+		for j in range(end-start):
+			if lengths[j]:
+				seqList.append((types[j],positions[j],lengths[j]))
+			else:
+				seqList.append((types[j],positions[j]))
+		return seqList
+
+	def clear(self):
+		self.offsets.clear()
+		self.diffCounts.clear()
+		self.inMemory.clear()
+		if self.mmap!=None:
+			self.entryOffsets=None
+			self.types=None
+			self.positions=None
+			self.lengths=None
+			self.view=None
+			self.mmap.close()
+			self.mmap=None
+
+#read a binary alignment file, returning the reference and the samples.
+def readBinaryAlignment(fileName):
+	data=BinaryAlignment(fileName)
+	print(str(len(data.offsets))+" sequences in binary alignment file.")
+	return data.ref, data
+
+#convert the input MAPLE file into a binary alignment file.
+def convertToBinaryAlignment(inputFile,refFile,outputFile):
+	if refFile=="":
+		ref, data=readConciseAlignment(inputFile)
 	else:
-		refIndeces.append(0)
-if model=="JC":
-	rootFreqs=[0.25,0.25,0.25,0.25]
-	rootFreqsLog=[log(0.25),log(0.25),log(0.25),log(0.25)]
-oneMutBLen=1.0/lRef
-minBLenSensitivity*=oneMutBLen
+		ref=collectReference(refFile)
+		data=readConciseAlignment(inputFile, extractReference=False, ref=ref)
+	writeBinaryAlignment(outputFile,ref,data)
+
+
+#Binary mutation-annotated tree (MAT) format, written with option --writeMAT and readable with option --inputTree instead of a newick tree.
+#After a header (magic string, version, reference length, 1 if inferred mutations are included and 0 otherwise, number of nodes, number of names,
+# number of MAT mutations, number of inferred mutations) the file contains, each section padded to 8 bytes:
+# the reference; the offsets of the names and the names (as in namesInTree); for each node, in preorder starting from the root,
+# the index of its parent (-1 for the root), its branch length and the id of its name (-1 if it has none);
+# the offset of the first minor sequence of each node and the name ids of all minor sequences;
+# the offset of the first MAT mutation (tree.mutations) of each node and, for all of them, their position, reference and new nucleotide;
+# the offset of the first inferred mutation (tree.mutationsInf, with option --estimateMAT) of each node and, for all of them,
+# their position, original and new nucleotide and probability.
+#Arrays are stored in little-endian order.
+matMagic=b"MAPLEMAT"
+matHeader=struct.Struct("<8sIIIQQQQ")
+
+#write the tree below node into a binary MAT file.
+def writeMATfile(fileName,tree,node,namesInTree):
+	if sys.byteorder!="little":
+		print("Binary MAT files are only supported on little-endian machines.")
+		raise Exception("exit")
+	children=tree.children
+	name=tree.name
+	dist=tree.dist
+	minorSequences=tree.minorSequences
+	mutations=tree.mutations
+	hasMutationsInf=hasattr(tree, 'mutationsInf')
+	if hasMutationsInf:
+		mutationsInf=tree.mutationsInf
+	if type(namesInTree)!=NameStore:
+		namesInTree=NameStore(namesInTree)
+	parents=array("q")
+	dists=array("d")
+	nameIds=array("q")
+	minorOffsets=array("Q",[0])
+	minorIds=array("q")
+	mutOffsets=array("Q",[0])
+	mutPositions=array("I")
+	mutFrom=bytearray()
+	mutTo=bytearray()
+	infOffsets=array("Q",[0])
+	infPositions=array("I")
+	infFrom=bytearray()
+	infTo=bytearray()
+	infProbs=array("d")
+	nextNodes=[(node,-1)]
+	while nextNodes:
+		nextNode,parent=nextNodes.pop()
+		newIndex=len(parents)
+		parents.append(parent)
+		dists.append(dist[nextNode])
+		if isinstance(name[nextNode], int):
+			nameIds.append(name[nextNode])
+		else:
+			nameIds.append(-1)
+		minorIds.extend(minorSequences[nextNode])
+		minorOffsets.append(len(minorIds))
+		for mutation in mutations[nextNode]:
+			mutPositions.append(mutation[0])
+			mutFrom.append(mutation[1])
+			mutTo.append(mutation[2])
+		mutOffsets.append(len(mutPositions))
+		if hasMutationsInf:
+			for mutation in mutationsInf[nextNode]:
+				infFrom.append(mutation[0])
+				infPositions.append(mutation[1])
+				infTo.append(mutation[2])
+				infProbs.append(mutation[3])
+		infOffsets.append(len(infPositions))
+		for c in reversed(children[nextNode]):
+			nextNodes.append((c,newIndex))
+	file=openFile(fileName,"wb")
+	position=file.write(matHeader.pack(matMagic,1,len(ref),int(hasMutationsInf),len(parents),len(namesInTree),len(mutPositions),len(infPositions)))
+	for section in (ref.encode(),namesInTree.offsets,namesInTree.blob,parents,dists,nameIds,minorOffsets,minorIds,mutOffsets,mutPositions,mutFrom,mutTo,infOffsets,infPositions,infFrom,infTo,infProbs):
+		position+=file.write(section)
+		position=padTo8(file,position)
+	file.close()
+	print("Binary MAT with "+str(len(parents))+" nodes written to file "+fileName)
+
+def isMATfile(fileName):
+	file=openFile(fileName,"rb")
+	magic=file.read(len(matMagic))
+	file.close()
+	return magic==matMagic
+
+#read a binary MAT file, returning the tree, its root, the NameStore with the names in the tree (the ids in tree.name and tree.minorSequences) and the reference.
+def readMATfile(fileName,dirtiness=True):
+	if sys.byteorder!="little":
+		print("Binary MAT files are only supported on little-endian machines.")
+		raise Exception("exit")
+	file=openFile(fileName,"rb")
+	view=memoryview(file.read())
+	file.close()
+	magic,version,lRefMAT,hasMutationsInf,numNodes,numNames,numMutations,numMutationsInf=matHeader.unpack_from(view,0)
+	if magic!=matMagic or version!=1:
+		print("File "+fileName+" is not a binary MAT file of a supported version.")
+		raise Exception("exit")
+	position=[matHeader.size]
+	#next section of the file, skipping the padding at its end.
+	def nextSection(size,typecode=None):
+		section=view[position[0]:position[0]+size]
+		position[0]+=size
+		if position[0]%8:
+			position[0]+=8-(position[0]%8)
+		if typecode!=None:
+			return section.cast(typecode)
+		return section
+	reference=bytes(nextSection(lRefMAT)).decode()
+	namesInTree=NameStore()
+	namesInTree.offsets=array("q",nextSection(8*(numNames+1),"q"))
+	namesInTree.blob=bytearray(nextSection(namesInTree.offsets[-1]))
+	namesInTree.rebuildTable(numNames)
+	parents=nextSection(8*numNodes,"q").tolist()
+	dists=nextSection(8*numNodes,"d")
+	nameIds=nextSection(8*numNodes,"q").tolist()
+	minorOffsets=nextSection(8*(numNodes+1),"Q").tolist()
+	minorIds=nextSection(8*minorOffsets[-1],"q").tolist()
+	mutOffsets=nextSection(8*(numNodes+1),"Q").tolist()
+	mutPositions=nextSection(4*numMutations,"I").tolist()
+	mutFrom=nextSection(numMutations).tolist()
+	mutTo=nextSection(numMutations).tolist()
+	infOffsets=nextSection(8*(numNodes+1),"Q").tolist()
+	infPositions=nextSection(4*numMutationsInf,"I").tolist()
+	infFrom=nextSection(numMutationsInf).tolist()
+	infTo=nextSection(numMutationsInf).tolist()
+	infProbs=nextSection(8*numMutationsInf,"d").tolist()
+	tree=Tree()
+	tree.addNodes(numNodes,dirtiness=dirtiness)
+	up=tree.up
+	children=tree.children
+	name=tree.name
+	minorSequences=tree.minorSequences
+	mutations=tree.mutations
+	tree.dist=array("d",dists)
+	if hasMutationsInf:
+		tree.mutationsInf=[[] for i in range(numNodes)]
+		mutationsInf=tree.mutationsInf
+	for node in range(numNodes):
+		if parents[node]!=-1:
+			up[node]=parents[node]
+			children[parents[node]].append(node)
+		if nameIds[node]!=-1:
+			name[node]=nameIds[node]
+		if minorOffsets[node]<minorOffsets[node+1]:
+			minorSequences[node]=minorIds[minorOffsets[node]:minorOffsets[node+1]]
+		for i in range(mutOffsets[node],mutOffsets[node+1]):
+			mutations[node].append((mutPositions[i],mutFrom[i],mutTo[i]))
+		if hasMutationsInf:
+			for i in range(infOffsets[node],infOffsets[node+1]):
+				mutationsInf[node].append((infFrom[i],infPositions[i],infTo[i],infProbs[i]))
+	return tree, 0, namesInTree, reference
+
 
 range4=range(4)
-#stricter thresholds than the input one for probabilities.
-thresholdProb2=thresholdProb*thresholdProb
-thresholdProb4=thresholdProb2*thresholdProb2
+
+#Set up the quantities that depend on the reference genome (genome length, base composition, likelihood thresholds in units of mutations).
+#The reference can be extracted from the input alignment with readConciseAlignment() or read with collectReference().
+def setUpReference(reference):
+	global ref, lRef, globalTotRate, logLRef, thresholdLogLKoptimizationTopology, thresholdLogLKoptimization, thresholdLogLKtopology, thresholdLogLK
+	global thresholdLogLKtopologyInitial, effectivelyNon0BLen, cumulativeBases, rootFreqs, rootFreqsLog, refIndeces, oneMutBLen, minBLenSensitivity
+	ref=reference
+	lRef=len(ref)
+	globalTotRate=-float(lRef)
+	logLRef=log(lRef)
+	thresholdLogLKoptimizationTopology*=logLRef
+	thresholdLogLKoptimization*=logLRef
+	thresholdLogLKtopology*=logLRef
+	thresholdLogLK*=logLRef
+	thresholdLogLKtopologyInitial*=logLRef
+	effectivelyNon0BLen=1.0/(10*lRef)
+
+	#vector to count how many bases of each type are cumulatively in the reference genome up to a certain position
+	cumulativeBases=[[0,0,0,0]]
+	for i in range(lRef):
+		cumulativeBases.append(list(cumulativeBases[i]))
+		if (ref[i] in allelesList) or (ref[i] in allelesListLow):
+			cumulativeBases[i+1][allelesUpOrLow[ref[i]]]+=1
+	rootFreqs=[0.0,0.0,0.0,0.0]
+	rootFreqsLog=[0.0,0.0,0.0,0.0]
+	for i in range(4):
+		rootFreqs[i]=cumulativeBases[-1][i]/float(lRef)
+		rootFreqsLog[i]=log(rootFreqs[i])
+	refIndeces=[]
+	for i in range(lRef):
+		if (ref[i] in allelesList) or (ref[i] in allelesListLow):
+			refIndeces.append(allelesLow[ref[i]])
+		else:
+			refIndeces.append(0)
+	if model=="JC":
+		rootFreqs=[0.25,0.25,0.25,0.25]
+		rootFreqsLog=[log(0.25),log(0.25),log(0.25),log(0.25)]
+	oneMutBLen=1.0/lRef
+	minBLenSensitivity*=oneMutBLen
 
 
 #if probability mass is concentrated in one nucleotide, simplify the entry from "O" to another type.
@@ -2242,12 +2969,92 @@ def shorten(vec):
 	return
 
 
+#last genome position covered by entry i of a genome list (0 for i=-1), found from the closest R or N entry before it.
+def genomeListEntryEnd(probVect,i):
+	j=i
+	while j>=0 and probVect[j][0]!=4 and probVect[j][0]!=5:
+		j-=1
+	if j<0:
+		return i+1
+	return probVect[j][1]+i-j
+
+#index of the entry of a genome list covering genome position pos, searching from entry lo onwards.
+#Bisects the entries, computing their end positions with genomeListEntryEnd(): each step costs the number of entries back to the closest R or N entry,
+# which is small for the genome lists of internal nodes, where runs of nucleotide and O entries are short.
+def genomeListEntryAt(probVect,pos,lo=0):
+	hi=len(probVect)-1
+	while lo<hi:
+		mid=(lo+hi)//2
+		if genomeListEntryEnd(probVect,mid)<pos:
+			lo=mid+1
+		else:
+			hi=mid
+	return lo
+
+#when passing a genome list through a branch with few mutations compared to the length of the list, the entries affected by the mutations are found by bisection
+# and the new genome list is made of slices of the old one and the modified entries, instead of going through all entries.
+minEntriesPerMutationForSeeking=12
+
+#Same as passGenomeListThroughBranch(), but seeking the entries affected by each mutation.
+#The unchanged entries are shared with probVect, and probVect itself is returned if no entry is affected (all mutations are within N entries).
+def passGenomeListThroughBranchBySeeking(probVect, mutations, dirIsUp=False):
+	lMut=len(mutations)
+	indexMAT, indexEntry, copiedUpTo = 0, 0, 0
+	newProbVect=None
+	while indexMAT<lMut:
+		indexEntry=genomeListEntryAt(probVect,mutations[indexMAT][0],indexEntry)
+		entry=probVect[indexEntry]
+		if entry[0]==5:
+			#entries of type N are not affected by mutations
+			indexMAT+=1
+			continue
+		if newProbVect==None:
+			newProbVect=probVect[:indexEntry]
+		else:
+			newProbVect+=probVect[copiedUpTo:indexEntry]
+		if entry[0]==4:
+			lastPos=genomeListEntryEnd(probVect,indexEntry-1)
+			while indexMAT<lMut and mutations[indexMAT][0]<=entry[1]:
+				if mutations[indexMAT][0]>lastPos+1:
+					lastPos=mutations[indexMAT][0]-1
+					newProbVect.append((4,lastPos)+entry[2:])
+				lastPos+=1
+				if dirIsUp:
+					newProbVect.append((mutations[indexMAT][2],mutations[indexMAT][1])+entry[2:])
+				else:
+					newProbVect.append((mutations[indexMAT][1],mutations[indexMAT][2])+entry[2:])
+				indexMAT+=1
+			if lastPos<entry[1]:
+				newProbVect.append(entry)
+		else:
+			if dirIsUp:
+				newEl=mutations[indexMAT][1]
+			else:
+				newEl=mutations[indexMAT][2]
+			if entry[0]==6:
+				newProbVect.append((6,newEl)+entry[2:])
+			elif entry[0]==newEl:
+				newProbVect.append((4,mutations[indexMAT][0])+entry[2:])
+			else:
+				newProbVect.append((entry[0],newEl)+entry[2:])
+			indexMAT+=1
+		indexEntry+=1
+		copiedUpTo=indexEntry
+	if newProbVect==None:
+		return probVect
+	newProbVect+=probVect[copiedUpTo:]
+	return newProbVect
+
 # Create a modified genome list, or modify an existing one, by taking into consideration the direction of the move, and the mutations on the MAT on a specific branch to traverse
+#If there are few mutations compared to the length of probVect, only the entries affected by the mutations are visited (see passGenomeListThroughBranchBySeeking()).
 def passGenomeListThroughBranch(probVect, mutations, dirIsUp=False): #, modifyCurrentList=False
 	lMut=len(mutations)
+	if lMut*minEntriesPerMutationForSeeking<len(probVect):
+		return passGenomeListThroughBranchBySeeking(probVect, mutations, dirIsUp)
 	indexMAT, indexEntry, lastPos = 0, 0, 0
 	#if not modifyCurrentList:
 	newProbVect=[]
+	changed=False
 	entry=probVect[indexEntry]
 	newEl, nucToPass = -1, -1
 	while True:
@@ -2283,6 +3090,7 @@ def passGenomeListThroughBranch(probVect, mutations, dirIsUp=False): #, modifyCu
 						newEl=mutations[indexMAT][2]
 				
 				indexMAT+=1
+				changed=True
 
 				if len(entry)==2:
 					newEntry=(nucToPass,newEl)
@@ -2328,6 +3136,7 @@ def passGenomeListThroughBranch(probVect, mutations, dirIsUp=False): #, modifyCu
 					newEl=mutations[indexMAT][2]
 				
 				indexMAT+=1
+				changed=True
 
 				if len(entry)==2:
 					newEntry=(nucToPass,newEl)
@@ -2356,6 +3165,7 @@ def passGenomeListThroughBranch(probVect, mutations, dirIsUp=False): #, modifyCu
 				else:
 					newEl=mutations[indexMAT][2]
 				indexMAT+=1
+				changed=True
 
 				if len(entry)==3:
 					newEntry=(6,newEl,entry[2])
@@ -2371,6 +3181,9 @@ def passGenomeListThroughBranch(probVect, mutations, dirIsUp=False): #, modifyCu
 			indexEntry+=1
 			entry=probVect[indexEntry]
 
+	#share the genome list if no entry has been changed, as when there are no mutations on the branch
+	if not changed:
+		return probVect
 	return newProbVect
 
 
@@ -2599,6 +3412,7 @@ def updateSubMatrix(pseudoMutCounts,model,oldMutMatrix): #,mutMatrixBLen,mutMatr
 		for i in range4:
 			for j in range4:
 				oldMutMatrix[i][j]=mutMatrix[i][j]
+		clearTransitionVectorCache()
 		#the matrix has changed significantly, return True so that cumulative rates can be updated as well.
 		return True
 	else:
@@ -2608,25 +3422,35 @@ def updateSubMatrix(pseudoMutCounts,model,oldMutMatrix): #,mutMatrixBLen,mutMatr
 #Initialize the mutation rate matrix
 #If a fixed rate matrix is needed for SARS-CoV-2, this is the nucleotide mutation rate matrix from De Maio et al 2021 (now obsolete)
 #mutMatrix=[[0.0,0.039,0.310,0.123],[0.140,0.0,0.022,3.028],[0.747,0.113,0.0,2.953],[0.056,0.261,0.036,0.0]]
-pseudoMutCounts=[[0.0,1.0,5.0,2.0],[2.0,0.0,1.0,40.0],[5.0,2.0,0.0,20.0],[2.0,3.0,1.0,0.0]]
-if model=="JC":
-	mutMatrixGlobal=[[-1.0,1.0/3,1.0/3,1.0/3],[1.0/3,-1.0,1.0/3,1.0/3],[1.0/3,1.0/3,-1.0,1.0/3],[1.0/3,1.0/3,1.0/3,-1.0]]
-else:
-	mutMatrixGlobal=[[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0]]
-	updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal)
+#Set up the initial substitution model (and reset rate variation and error model) for a new inference; needs setUpReference() to be called first.
+def setUpSubstitutionModel():
+	global pseudoMutCounts, mutMatrixGlobal, nonMutRates, cumulativeRate, mutMatrices, useRateVariation
+	global errorRateGlobal, usingErrorRate, errorRateSiteSpecific
+	pseudoMutCounts=[[0.0,1.0,5.0,2.0],[2.0,0.0,1.0,40.0],[5.0,2.0,0.0,20.0],[2.0,3.0,1.0,0.0]]
+	clearTransitionVectorCache()
+	if model=="JC":
+		mutMatrixGlobal=[[-1.0,1.0/3,1.0/3,1.0/3],[1.0/3,-1.0,1.0/3,1.0/3],[1.0/3,1.0/3,-1.0,1.0/3],[1.0/3,1.0/3,1.0/3,-1.0]]
+	else:
+		mutMatrixGlobal=[[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0],[0.0,0.0,0.0,0.0]]
+		updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal)
 
-nonMutRates=[0,0,0,0]
-for i in range4:
-	nonMutRates[i]=mutMatrixGlobal[i][i]
+	nonMutRates=[0,0,0,0]
+	for i in range4:
+		nonMutRates[i]=mutMatrixGlobal[i][i]
 
-cumulativeRate=[0.0]
-for i in range(lRef):
-	ind=refIndeces[i]
-	cumulativeRate.append(cumulativeRate[-1]+nonMutRates[ind])
+	cumulativeRate=[0.0]
+	for i in range(lRef):
+		ind=refIndeces[i]
+		cumulativeRate.append(cumulativeRate[-1]+nonMutRates[ind])
+	mutMatrices=None
+	useRateVariation=False
+	errorRateGlobal=0.0
+	usingErrorRate=False
+	errorRateSiteSpecific=False
 
 
 # Helps the likelihoods as they change by moving along a branch
-def getPartialVec(i12, totLen, mutMatrix, errorRate, vect=None, upNode=False, flag=False):
+def calculatePartialVec(i12, totLen, mutMatrix, errorRate, vect=None, upNode=False, flag=False):
 	"""
 	When merging a non O entry with an O entry, we need to iterate through the partial likelihood
 	vector stored in the O entry. Since the non O entry currently does not have an array 
@@ -2703,6 +3527,35 @@ def getPartialVec(i12, totLen, mutMatrix, errorRate, vect=None, upNode=False, fl
 	return calculatePartialHelper(totLen,upNode,mutMatrix,newVect)
 
 
+#The partial likelihood vectors of entries other than O only depend on the nucleotide, the branch length, the substitution matrix, the direction
+# and (for entries accounting for errors) the error rate, and the same branch lengths recur very often, so getPartialVec() caches them.
+#The cache holds up to transitionVectorCacheSize vectors (the oldest are removed first), and is emptied by clearTransitionVectorCache()
+# whenever the substitution or error model changes. Substitution matrices are identified by their id, and are kept referenced by the cache so that ids are not reused.
+transitionVectorCache={}
+transitionVectorCacheSize=65536
+
+def clearTransitionVectorCache():
+	transitionVectorCache.clear()
+
+#return the partial likelihood vector of an entry after propagating it along a branch (see calculatePartialVec()), using the cache for entries other than O.
+#The returned vector is a new list that the caller can modify.
+def getPartialVec(i12, totLen, mutMatrix, errorRate, vect=None, upNode=False, flag=False):
+	if i12==6:
+		return calculatePartialVec(i12, totLen, mutMatrix, errorRate, vect=vect, upNode=upNode, flag=flag)
+	if usingErrorRate and flag:
+		key=(i12,totLen,id(mutMatrix),False,errorRate)
+	else:
+		key=(i12,totLen,id(mutMatrix),upNode,None)
+	cached=transitionVectorCache.get(key)
+	if cached!=None:
+		return list(cached[1])
+	newVect=calculatePartialVec(i12, totLen, mutMatrix, errorRate, upNode=upNode, flag=flag)
+	if len(transitionVectorCache)>=transitionVectorCacheSize:
+		del transitionVectorCache[next(iter(transitionVectorCache))]
+	transitionVectorCache[key]=(mutMatrix,newVect)
+	return list(newVect)
+
+
 numRefs=[0]
 # this function is called only for input trees, when probVect lists are in the tree already but the other genome lists are not there yet.
 #Initialize the MAT references and re-define the probVect's accordingly.
@@ -2997,6 +3850,7 @@ def traverseTreeToUpdateMutationList(tree,appendedNode,node):
 		newNode=nodeList.pop()
 		if mutations[newNode]:
 			mutations[appendedNode] = mergeMutationLists(mutations[newNode],mutations[appendedNode],downward=True)
+	indexNodeMutations(tree,appendedNode)
 	return
 
 
@@ -3011,6 +3865,11 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 	entry2=probVect2[indexEntry2]
 	totSum, cumErrorRate, refNucToPass, flag1, flag2, i, j ,i1, i2, newPos = 0.0, 0.0, -1, False, False, 0, 0, 0, 0, 0
 	newVec, newVec2 = [], []
+	#merges involving O entries are collected in oMerges and done together at the end by mergeOEntries();
+	# oLen1 and oLen2 are the branch lengths along which the O vectors still need to be propagated.
+	batchOMerges=useBatchedOMerges and (not returnLK)
+	oMerges=[]
+	oLen1, oLen2 = 0.0, 0.0
 
 	if not (usingErrorRate and errorRateSiteSpecific): 
 		errorRate=errorRateGlobal
@@ -3254,7 +4113,7 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 				else:
 					new_entry=(entry1[0],entry1[1])
 					
-				if returnLK:
+				if returnLK and entry1[0]!=4: #R/R contributions have already been accounted for above
 					if useRateVariation:
 						cumulPartLk+=mutMatrices[pos][entry1[0]][entry1[0]]*(totLen1+totLen2)
 					else:
@@ -3376,6 +4235,8 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 							newVec=[0.0,0.0,0.0,0.0]
 							newVec[i1]=1.0
 					#entry 1 is type O 
+					elif batchOMerges and not useRateVariation:
+						newVec, oLen1 = entry1[-1], totLen1
 					else:
 						if totLen1:
 							newVec=getPartialVec(6, totLen1, mutMatrix, 0, vect=entry1[-1],upNode=isUpDown)
@@ -3386,7 +4247,9 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 						i2=refNucToPass
 					else:
 						i2=entry2[0]
-					if i2==6: #entry2 is O
+					if i2==6 and batchOMerges and not useRateVariation:
+						newVec2, oLen2 = entry2[-1], totLen2
+					elif i2==6: #entry2 is O
 						if totLen2:
 							newVec2=getPartialVec(6, totLen2, mutMatrix, 0, vect=entry2[-1])
 						else:
@@ -3397,7 +4260,13 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 						else:
 							newVec2 = [0.0,0.0,0.0,0.0]
 							newVec2[i2]=1.0
-					new_entry,totSum = calculateNewEntry(newVec,newVec2,refNucToPass,newPos)
+					if batchOMerges:
+						#the new entry is filled in by mergeOEntries() at the end
+						oMerges.append((len(probVect),newVec,oLen1,newVec2,oLen2,refNucToPass,newPos))
+						oLen1, oLen2 = 0.0, 0.0
+						new_entry=None
+					else:
+						new_entry,totSum = calculateNewEntry(newVec,newVec2,refNucToPass,newPos)
 
 
 			
@@ -3435,8 +4304,94 @@ def mergeVectors(probVect1,bLen1,fromTip1,probVect2,bLen2,fromTip2,returnLK=Fals
 
 	if returnLK:
 		return probVect, cumulPartLk+log(totalFactor)
-	else:
-		return probVect
+	if oMerges:
+		if not mergeOEntries(probVect,oMerges,mutMatrix,isUpDown):
+			return None
+	return probVect
+
+
+#Merges involving O entries can make up most of the work of mergeVectors() for samples with many ambiguities and the nodes above them.
+#With batchOMerges, mergeVectors() collects them in a list of (index in the new genome list, vector 1, branch length 1, vector 2, branch length 2, reference nucleotide, next position)
+# and they are done here all at once with NumPy arrays, if there are at least minOMergesForBatching of them.
+# The vectors are first propagated along their branch lengths (if non-zero) with mutMatrix, then multiplied, normalized and simplified as in mergeVectors(),
+# performing the floating point operations in the same order so that the results are identical.
+#The new entries are written into probVect; returns False if the merge is not possible (some product vector is 0).
+useBatchedOMerges=(numpy!=None) and sys.implementation.name!="pypy"
+minOMergesForBatching=24
+
+def mergeOEntries(probVect,oMerges,mutMatrix,isUpDown):
+	if len(oMerges)<minOMergesForBatching:
+		for indexEntry, vec1, len1, vec2, len2, refNuc, newPos in oMerges:
+			if len1:
+				vec1=getPartialVec(6, len1, mutMatrix, 0, vect=vec1, upNode=isUpDown)
+			else:
+				vec1=list(vec1)
+			if len2:
+				vec2=getPartialVec(6, len2, mutMatrix, 0, vect=vec2)
+			for i in range4:
+				vec1[i]*=vec2[i]
+			totSum=sum(vec1)
+			if not totSum:
+				return False
+			for i in range4:
+				vec1[i]/=totSum
+			state=simplify(vec1,refNuc)
+			if state==6:
+				probVect[indexEntry]=(6,refNuc,vec1)
+			elif state==4:
+				probVect[indexEntry]=(4,newPos)
+			else:
+				probVect[indexEntry]=(state,refNuc)
+		return True
+
+	vects1=propagateOVectors(numpy.array([m[1] for m in oMerges],dtype=float),numpy.array([m[2] for m in oMerges],dtype=float),mutMatrix,isUpDown)
+	vects2=propagateOVectors(numpy.array([m[3] for m in oMerges],dtype=float),numpy.array([m[4] for m in oMerges],dtype=float),mutMatrix,False)
+	vects1*=vects2
+	totSums=vects1[:,0]+vects1[:,1]+vects1[:,2]+vects1[:,3]
+	if not totSums.all():
+		return False
+	vects1/=totSums[:,None]
+
+	#same as simplify()
+	maxIs=vects1.argmax(axis=1)
+	maxPs=vects1.max(axis=1)
+	if (maxPs<thresholdProb4).any():
+		print("Inside simplify(), all values in vector are too small - something wrong?")
+		print(list(vects1[numpy.flatnonzero(maxPs<thresholdProb4)[0]]))
+		raise Exception("exit")
+	numAs=(vects1>thresholdProb).sum(axis=1)
+
+	vects1=vects1.tolist()
+	maxIs=maxIs.tolist()
+	numAs=numAs.tolist()
+	for k, (indexEntry, vec1, len1, vec2, len2, refNuc, newPos) in enumerate(oMerges):
+		if numAs[k]!=1:
+			probVect[indexEntry]=(6,refNuc,vects1[k])
+		elif maxIs[k]==refNuc:
+			probVect[indexEntry]=(4,newPos)
+		else:
+			probVect[indexEntry]=(maxIs[k],refNuc)
+	return True
+
+
+#propagate the rows of vects (partial likelihood vectors of O entries) along the branch lengths in lens (where non-zero), as getPartialVec() does one vector at a time.
+def propagateOVectors(vects,lens,mutMatrix,upNode):
+	rows=numpy.flatnonzero(lens)
+	if not len(rows):
+		return vects
+	oldVects=vects[rows]
+	newVects=numpy.empty_like(oldVects)
+	for i in range4:
+		if upNode:
+			newVects[:,i]=mutMatrix[0][i]*oldVects[:,0]+mutMatrix[1][i]*oldVects[:,1]+mutMatrix[2][i]*oldVects[:,2]+mutMatrix[3][i]*oldVects[:,3]
+		else:
+			newVects[:,i]=mutMatrix[i][0]*oldVects[:,0]+mutMatrix[i][1]*oldVects[:,1]+mutMatrix[i][2]*oldVects[:,2]+mutMatrix[i][3]*oldVects[:,3]
+		newVects[:,i]*=lens[rows]
+		newVects[:,i]+=oldVects[:,i]
+	#if mutation probabilities dip below 0 then they are not related
+	newVects[(newVects<0).any(axis=1)]=0.25
+	vects[rows]=newVects
+	return vects
 
 
 #calculate the probability that results from combining a lower likelihood genome list of the root with root frequencies.
@@ -4098,11 +5053,11 @@ def updatePartials(tree,nodeList):
 							print("Strange: None vector from non-zero distances in updatePartials() from parent direction, child0.")
 							raise Exception("exit")
 				if not updatedBLen:
-					if madeChange or areVectorsDifferent(probVectUpRight[node],newUpRight):
+					if madeChange or upwardListMissing(tree,0,node) or areVectorsDifferent(probVectUpRight[node],newUpRight):
 						probVectUpRight[node]=newUpRight
 						shorten(probVectUpRight[node])
 						nodeList.append((children[node][0],2))
-					if madeChange or areVectorsDifferent(probVectUpLeft[node],newUpLeft):
+					if madeChange or upwardListMissing(tree,1,node) or areVectorsDifferent(probVectUpLeft[node],newUpLeft):
 						probVectUpLeft[node]=newUpLeft
 						shorten(probVectUpLeft[node])
 						nodeList.append((children[node][1],2))
@@ -4120,6 +5075,7 @@ def updatePartials(tree,nodeList):
 				probVectDown=passGenomeListThroughBranch(probVectDown,mutations[children[node][childNum]],dirIsUp=True)
 			isTip=(len(children[children[node][childNum]])==0 and len(minorSequences[children[node][childNum]])==0)
 			otherIsTip=(len(children[children[node][otherChildNum]])==0 and len(minorSequences[children[node][otherChildNum]])==0)
+			otherVectUpMissing=upwardListMissing(tree,1-childNum,node)
 			try:
 				if childNum:
 					otherVectUp=probVectUpRight[node]
@@ -4187,7 +5143,7 @@ def updatePartials(tree,nodeList):
 						print("Strange: None vector from non-zero distances in updatePartials() from child direction, newUpVect.")
 						raise Exception("exit")
 			if (not updatedBLen) and (otherVectUp!=None):
-				if madeChange or areVectorsDifferent(otherVectUp,newUpVect):
+				if madeChange or otherVectUpMissing or areVectorsDifferent(otherVectUp,newUpVect):
 					if childNum:
 						probVectUpRight[node]=newUpVect
 						shorten(probVectUpRight[node])
@@ -4203,6 +5159,12 @@ def updatePartials(tree,nodeList):
 						nodeList.append((up[node],childNumUp))
 
 
+#With option --lowMemory, an upward genome list that is not in the cache would be recalculated from the already updated genome lists when read,
+# and so would look unchanged; updatePartials() then treats it as changed, so that the genome lists below it are updated too.
+def upwardListMissing(tree,kind,node):
+	return lowMemory and (not tree.upwardCache.contains(kind,node))
+
+
 #Check if two genome lists represent the same partial likelihoods or not.
 #This is a less strict version used for debugging purposes.
 def areVectorsDifferentDebugging(probVect1,probVect2,threshold=0.00001):
@@ -4740,6 +5702,7 @@ def reCalculateAllGenomeLists(tree,root, checkExistingAreCorrect=False,countNode
 def updateMutMatrices(mutMatrix,siteRates=None):
 	global nonMutRates
 	global cumulativeRate
+	clearTransitionVectorCache()
 	for i in range4:
 		nonMutRates[i]=mutMatrix[i][i]
 	if siteRates!=None:
@@ -4761,6 +5724,7 @@ def updateMutMatrices(mutMatrix,siteRates=None):
 def updateErrorRates(errorRate,errorRates=None):
 	global rootFreqsLogErrorCumulative
 	global totError
+	clearTransitionVectorCache()
 	if errorRates!=None:
 		global cumulativeErrorRate
 		cumulativeErrorRate = [0]*(lRef+1) #creating cumulative error rates.
@@ -4780,58 +5744,55 @@ def updateErrorRates(errorRate,errorRates=None):
 		totError=-errorRate*lRef
 
 
-#reading input subst model to be used as initial values for parameter estimation and tree building.
-if inputRates!="":
-	if not os.path.isfile(inputRates):
-		print("Input rates file "+inputRates+" not found, quitting MAPLE. Use option --inputRates to specify a valid input rates file, identical in format to MAPLE's output file with model parameters.")
-		raise Exception("exit")
-	fileR=open(inputRates)
-	for i in range4:
-		line=fileR.readline()
-		linelist=line.split()
-		for j in range4:
-			mutMatrixGlobal[i][j]=float(linelist[j])
-	if rateVariation:
-		siteRates=[]
-		while line!="Site rates:\n":
-			line=fileR.readline()
-		for i in range(lRef):
-			line=fileR.readline()
-			linelist=line.split()
-			siteRates.append(float(linelist[1]))
-		useRateVariation=True
-		mutMatrices=[]
-		updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-	if estimateSiteSpecificErrorRate:
-		usingErrorRate=True
-		errorRates=[]
-		while line!="Site error rates:\n":
-			line=fileR.readline()
-		for i in range(lRef):
-			line=fileR.readline()
-			linelist=line.split()
-			errorRates.append(float(linelist[1]))
-		errorRateGlobal=sum(errorRates)/lRef
-		updateErrorRates(errorRateGlobal,errorRates=errorRates)
-	fileR.close()
-	print("Read input rates")
-
-
-#In case an input tree is given, calculate all genome lists, pseudocounts and rates, and then recalculate genome lists again according to the new rates.
-if inputTree!="":
-	#samplesAlreadyInTree=reCalculateAllGenomeLists(tree1,countPseudoCounts=True,pseudoMutCounts=pseudoMutCounts,data=data,firstSetUp=True,checkSamplesIntree=True)
-	if not inputRates:
-		reCalculateAllGenomeLists(tree1,rootIndex1,countPseudoCounts=True,pseudoMutCounts=pseudoMutCounts,data=data,names=namesInTree,firstSetUp=True)
-		if (model!="JC" and updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal)):
-			for i in range4:
-				nonMutRates[i]=mutMatrixGlobal[i][i]
-			for i in range(lRef):
-				cumulativeRate[i+1]=cumulativeRate[i]+nonMutRates[refIndeces[i]]
-		reCalculateAllGenomeLists(tree1,rootIndex1)
-	else:
-		reCalculateAllGenomeLists(tree1,rootIndex1,data=data,names=namesInTree,firstSetUp=True)
-	print("Genome list for initial tree and initial pseudocounts calculated.")
-
+#Substitution and error model state used by the likelihood functions.
+#For speed, the likelihood functions read this state from module-level variables; Model.current() collects the current state into an object
+# (for example to keep alternative models around or to save them), and model.use() makes it the current state again.
+class Model(object):
+	stateNames=("mutMatrixGlobal","nonMutRates","cumulativeRate","pseudoMutCounts","useRateVariation","siteRates","mutMatrices",
+		"usingErrorRate","errorRateSiteSpecific","errorRateGlobal","errorRates","cumulativeErrorRate","rootFreqsLogErrorCumulative","totError")
+	def __init__(self,**state):
+		for stateName in Model.stateNames:
+			setattr(self,stateName,state.get(stateName))
+	def __repr__(self):
+		return "Model object"
+	@classmethod
+	def current(cls):
+		moduleState=globals()
+		return cls(**{stateName: moduleState.get(stateName) for stateName in cls.stateNames})
+	def use(self):
+		moduleState=globals()
+		for stateName in Model.stateNames:
+			moduleState[stateName]=getattr(self,stateName)
+		clearTransitionVectorCache()
+
+
+
+#count the number of differences (diffNum) from the reference and the number of informative positions (comparisons) of a sample.
+def countDiffsFromRef(diffs,lRef):
+	pos=1
+	comparisons=0
+	diffNum=0
+	for m in diffs:
+		currPos=m[1]
+		if currPos>pos: #region identical to the reference
+			comparisons+=currPos-pos
+			pos=currPos
+		if m[0]=="n" or m[0]=="-":
+			if len(m)>2:
+				pos=currPos+m[2]
+			else:
+				pos=currPos+1
+			diffNum+=1
+		elif m[0] in allelesLow:
+			comparisons+=1
+			diffNum+=1
+			pos=currPos+1
+		else:
+			pos=currPos+1
+			diffNum+=1
+	if pos<=lRef:
+		comparisons+=lRef+1-pos
+	return diffNum, comparisons
 
 #Sort samples based on distance from reference, but punishing more isolated N's and ambiguity characters.
 #more ambiguous sequences are placed last this way - this is useful since ambiguous sequences are harder to place and are more likely to be less informative (and so be removed from the analysis altogether)
@@ -4844,30 +5805,14 @@ def distancesFromRefPunishNs(data,samples=None,samplesInInitialTree=set(),forget
 		rangeInd=samples
 	for diffIndex in rangeInd:
 		if (samples==None) or (not (diffIndex in samplesInInitialTree)):
-			diffs=data[diffIndex]
-			pos=1
-			comparisons=0
-			diffNum=0
-			for m in diffs:
-				currPos=m[1]
-				if currPos>pos: #region identical to the reference
-					comparisons+=currPos-pos
-					pos=currPos
-				if m[0]=="n" or m[0]=="-":
-					if len(m)>2:
-						pos=currPos+m[2]
-					else:
-						pos=currPos+1
-					diffNum+=1
-				elif m[0] in allelesLow:
-					comparisons+=1
-					diffNum+=1
-					pos=currPos+1
-				else:
-					pos=currPos+1
-					diffNum+=1
-			if pos<=lRef:
-				comparisons+=lRef+1-pos
+			#with a streamed input the counts have already been calculated while indexing the file, and the diffs are only read for warnings.
+			if isinstance(data,ConciseAlignmentIndex):
+				diffNum,comparisons=data.diffCounts[diffIndex]
+				if (not comparisons) or (((float(diffNum)/comparisons)>0.1) and (not warnedTotDiv[0])):
+					diffs=data[diffIndex]
+			else:
+				diffs=data[diffIndex]
+				diffNum,comparisons=countDiffsFromRef(diffs,lRef)
 			sampleDistances.append((diffNum*1000+lRef-comparisons,diffIndex))
 			if not comparisons:
 				print("\n WARNING!!!!!!!!!!!\n\n Sample number "+str(diffIndex+1)+" appears to be completely non-informative. It will still be included in the MAPLE analysis, but please consider removing it from the alignment.")
@@ -5268,39 +6213,248 @@ def appendProbNode(probVectP,probVectC,isTipC,bLen):
 				
 	
 	return Lkcost+log(totalFactor)
-				
 
 
+#Likelihood costs of appending genome lists probVectsC[k] to the candidate genome lists probVectsP[k] (usually the probVectTotUp of the candidate nodes), 
+# as returned by appendProbNode(), all in one call.
+#Only positions where one of the two genome lists is not R (nor N) contribute to the cost, so instead of walking through both genome lists position by position,
+# for each genome list C the positions of its entries other than R and N are found once (genomeListProfile()) and shared by all candidates appended to it,
+# and for each candidate only its own entries are walked through.
+#Profiles can be kept across calls in the dictionary profiles (indexed by the id of the genome list, which needs to be removed from it if the genome list is modified).
+#Contributions are multiplied in the same order as in appendProbNode(), so results are identical.
+#With error rates, or if C has R entries with branch lengths, candidates are scored with appendProbNode().
+def appendProbNodeToCandidates(probVectsP,probVectsC,isTipC,bLen,profiles=None):
+	if usingErrorRate:
+		return [appendProbNode(probVectP,probVectC,isTipC,bLen) for probVectP, probVectC in zip(probVectsP,probVectsC)]
+	if profiles==None:
+		profiles={}
+	LKdiffs=[]
+	for probVectP, probVectC in zip(probVectsP,probVectsC):
+		if id(probVectC) in profiles:
+			profile=profiles[id(probVectC)][1]
+		else:
+			profile=genomeListProfile(probVectC)
+			profiles[id(probVectC)]=(probVectC,profile)
+		if profile==None:
+			LKdiffs.append(appendProbNode(probVectP,probVectC,isTipC,bLen))
+		else:
+			LKdiffs.append(appendProbNodeWithProfile(probVectP,probVectC,profile,bLen))
+	return LKdiffs
 
-#number of samples that could have been placed as major of another sample but weren't due to sample placement order
-totalMissedMinors=[0]
-totalTimeFindingParent=[0.0]
-#function traversing the tree to find the best node in the tree where to re-append the given subtree (rooted at node.children[child]) to improve the topology of the current tree.
-# bestLKdiff is the best likelihood cost found for the current placement (after optimizing the branch length).
-# removedBLen is such branch length that optimizes the current placement - it will be used to place the subtree attached at other nodes of the tree.
-#TODO account for HnZ modifiers in SPR search
-def findBestParentTopology(tree,node,child,bestLKdiff,removedBLen,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,sequentialSearch=True):
-	timeStartParentTopology=time()
-	up=tree.up
-	children=tree.children
-	probVectUpRight=tree.probVectUpRight
-	probVectUpLeft=tree.probVectUpLeft
-	mutations=tree.mutations
-	minorSequences=tree.minorSequences
-	dist=tree.dist
-	probVect=tree.probVect
-	probVectTotUp=tree.probVectTotUp
-	name=tree.name
-	#TODO
-	nDesc0=tree.nDesc0
-	if HnZ:
-		originalParent0=node
-		while (dist[originalParent0]<=effectivelyNon0BLen) and up[originalParent0]!=None:
-			originalParent0=up[originalParent0]
-	bestNode=children[node][1-child]
-	bestNodes=[]
-	nodesToVisit=[]
-	removedPartialsRelative=probVect[children[node][child]]
+#positions and indices of the entries of a genome list other than R and N, and start and end positions of its N entries;
+# None if the genome list has R entries with branch lengths.
+def genomeListProfile(probVect):
+	eventPositions, eventIndices, nStarts, nEnds = [], [], [], []
+	pos=0
+	for indexEntry in range(len(probVect)):
+		entry=probVect[indexEntry]
+		if entry[0]==4:
+			if len(entry)>2:
+				return None
+			pos=entry[1]
+		elif entry[0]==5:
+			nStarts.append(pos)
+			nEnds.append(entry[1])
+			pos=entry[1]
+		else:
+			eventPositions.append(pos)
+			eventIndices.append(indexEntry)
+			pos+=1
+	return eventPositions, eventIndices, nStarts, nEnds
+
+#R entry standing for any R entry without branch lengths in appendProbNodeWithProfile()
+plainREntry=(4,0)
+
+#same as appendProbNode() without error rates, using the profile of probVectC from genomeListProfile().
+def appendProbNodeWithProfile(probVectP,probVectC,profile,bLen):
+	eventPositions, eventIndices, nStarts, nEnds = profile
+	numEvents=len(eventPositions)
+	numNs=len(nStarts)
+	Lkcost=bLen*globalTotRate
+	totalFactor=1.0
+	indexEvent, indexN, pos = 0, 0, 0
+	for parentEntry in probVectP:
+		if parentEntry[0]==4 or parentEntry[0]==5:
+			end=parentEntry[1]
+			while indexEvent<numEvents and eventPositions[indexEvent]<end:
+				if parentEntry[0]==4:
+					factor=appendEntryFactor(parentEntry,probVectC[eventIndices[indexEvent]],eventPositions[indexEvent],bLen)
+					if factor==None:
+						return float("-inf")
+					totalFactor*=factor
+					if totalFactor<=minimumCarryOver:
+						if totalFactor<sys.float_info.min:
+							if bLen:
+								print("In appendProbNode() strangely small probability")
+							return float("-inf")
+						Lkcost+=log(totalFactor)
+						totalFactor=1.0
+				indexEvent+=1
+			pos=end
+		else:
+			if indexEvent<numEvents and eventPositions[indexEvent]==pos:
+				childEntry=probVectC[eventIndices[indexEvent]]
+				indexEvent+=1
+				if childEntry[0]==parentEntry[0] and childEntry[0]!=6:
+					pos+=1
+					continue
+			else:
+				while indexN<numNs and nEnds[indexN]<=pos:
+					indexN+=1
+				if indexN<numNs and nStarts[indexN]<=pos:
+					pos+=1
+					continue
+				childEntry=plainREntry
+			factor=appendEntryFactor(parentEntry,childEntry,pos,bLen)
+			if factor==None:
+				return float("-inf")
+			totalFactor*=factor
+			if totalFactor<=minimumCarryOver:
+				if totalFactor<sys.float_info.min:
+					if bLen:
+						print("In appendProbNode() strangely small probability")
+					return float("-inf")
+				Lkcost+=log(totalFactor)
+				totalFactor=1.0
+			pos+=1
+	return Lkcost+log(totalFactor)
+
+#contribution to the appending likelihood (see appendProbNode(), without error rates) of a position where parentEntry and childEntry are of different types or of type O.
+#Returns None if appending is impossible (different nucleotides at distance 0).
+def appendEntryFactor(parentEntry,childEntry,pos,bLen):
+	errorRate=errorRateGlobal
+	if useRateVariation:
+		mutMatrix=mutMatrices[pos]
+	else:
+		mutMatrix=mutMatrixGlobal
+	contribLength=bLen
+	if parentEntry[0]<5:
+		if len(parentEntry)==3:
+			contribLength+=parentEntry[2]
+		elif len(parentEntry)==4:
+			contribLength+=parentEntry[3]
+	elif len(parentEntry)==4:
+		contribLength+=parentEntry[2]
+	if childEntry[0]<5:
+		if len(childEntry)==3:
+			contribLength+=childEntry[2]
+	elif len(childEntry)==4:
+		contribLength+=childEntry[2]
+
+	if parentEntry[0]!=6 and childEntry[0]!=6:
+		if parentEntry[0]==4:
+			i1=childEntry[1]
+			i2=childEntry[0]
+			if len(parentEntry)==4:
+				tot3=getPartialVec(i2, contribLength, mutMatrix, errorRate, flag=False)
+				tot2=getPartialVec(i1, parentEntry[2], mutMatrix, errorRate, flag=False)
+				tot=0.0
+				for i in range4:
+					tot+=tot3[i]*tot2[i]*rootFreqs[i]
+				return tot/rootFreqs[i1]
+		else:
+			i1=parentEntry[0]
+			if childEntry[0]==4:
+				i2=parentEntry[1]
+			else:
+				i2=childEntry[0]
+			if len(parentEntry)==4:
+				tot3=getPartialVec(i2, contribLength, mutMatrix, errorRate, flag=False)
+				tot2=getPartialVec(i1, parentEntry[2], mutMatrix, errorRate, flag=False)
+				tot=0.0
+				for j in range4:
+					tot+=rootFreqs[j]*tot3[j]*tot2[j]
+				return tot/rootFreqs[i1]
+		if contribLength:
+			return min(0.25,mutMatrix[i1][i2]*contribLength)
+		return None
+
+	#at least one of the entries is O
+	if parentEntry[0]==6 and childEntry[0]==6:
+		tot=0.0
+		if contribLength:
+			childMutationLikelihood=getPartialVec(6, contribLength, mutMatrix, None, vect=childEntry[-1])
+			for j in range4:
+				tot+=parentEntry[-1][j]*childMutationLikelihood[j]
+		else:
+			for j in range4:
+				tot+=parentEntry[-1][j]*childEntry[-1][j]
+		return tot
+	if parentEntry[0]==6:
+		if childEntry[0]==4:
+			childBase=parentEntry[1]
+		else:
+			childBase=childEntry[0]
+		if parentEntry[-1][childBase]>0.02:
+			return parentEntry[-1][childBase]
+		partialVecWithMutation=getPartialVec(childBase, contribLength, mutMatrix, None, flag=False)
+		tot=0.0
+		for j in range4:
+			tot+=parentEntry[-1][j]*partialVecWithMutation[j]
+		return tot
+	if parentEntry[0]==4:
+		base=childEntry[1]
+	else:
+		base=parentEntry[0]
+	if childEntry[-1][base]>0.02:
+		return childEntry[-1][base]
+	if len(parentEntry)==4:
+		tot2=getPartialVec(base, parentEntry[2], mutMatrix, errorRate, flag=False)
+		tot3=getPartialVec(6, contribLength, mutMatrix, None, vect=childEntry[-1])
+		tot=0.0
+		for i in range4:
+			tot+=tot3[i]*tot2[i]*rootFreqs[i]
+		return tot/rootFreqs[base]
+	if contribLength:
+		return getPartialVec(6, contribLength, mutMatrix, None, vect=childEntry[-1])[base]
+	return childEntry[-1][base]
+				
+
+
+
+#number of samples that could have been placed as major of another sample but weren't due to sample placement order
+totalMissedMinors=[0]
+totalTimeFindingParent=[0.0]
+#topology search options not specified in input are taken from the current run options (see setUpConfig() and setUpReference()).
+def topologySearchOptions(strictStopRules,allowedFails,thresholdLogLK,thresholdPlacement):
+	if strictStopRules==None:
+		strictStopRules=strictTopologyStopRules
+	if allowedFails==None:
+		allowedFails=allowedFailsTopology
+	if thresholdLogLK==None:
+		thresholdLogLK=thresholdLogLKtopology
+	if thresholdPlacement==None:
+		thresholdPlacement=thresholdTopologyPlacement
+	return strictStopRules, allowedFails, thresholdLogLK, thresholdPlacement
+
+
+#function traversing the tree to find the best node in the tree where to re-append the given subtree (rooted at node.children[child]) to improve the topology of the current tree.
+# bestLKdiff is the best likelihood cost found for the current placement (after optimizing the branch length).
+# removedBLen is such branch length that optimizes the current placement - it will be used to place the subtree attached at other nodes of the tree.
+#TODO account for HnZ modifiers in SPR search
+def findBestParentTopology(tree,node,child,bestLKdiff,removedBLen,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,sequentialSearch=True):
+	strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement=topologySearchOptions(strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,None)
+	timeStartParentTopology=time()
+	up=tree.up
+	children=tree.children
+	probVectUpRight=tree.probVectUpRight
+	probVectUpLeft=tree.probVectUpLeft
+	mutations=tree.mutations
+	minorSequences=tree.minorSequences
+	dist=tree.dist
+	probVect=tree.probVect
+	probVectTotUp=tree.probVectTotUp
+	name=tree.name
+	#TODO
+	nDesc0=tree.nDesc0
+	if HnZ:
+		originalParent0=node
+		while (dist[originalParent0]<=effectivelyNon0BLen) and up[originalParent0]!=None:
+			originalParent0=up[originalParent0]
+	bestNode=children[node][1-child]
+	bestNodes=[]
+	nodesToVisit=[]
+	removedPartialsRelative=probVect[children[node][child]]
 	lastLK, distance, direction, needsUpdating, failedPasses = 0.0, 0.0, 0, True, 0
 	if mutations[children[node][child]]:
 		removedPartialsRelative=passGenomeListThroughBranch(removedPartialsRelative,mutations[children[node][child]],dirIsUp=True)
@@ -5758,7 +6912,8 @@ def findBestParentTopology(tree,node,child,bestLKdiff,removedBLen,strictTopology
 
 
 #function traversing the tree to find the best new root.
-def findBestRoot(tree,root,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,aBayesPlusOn=aBayesPlusOn):
+def findBestRoot(tree,root,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,aBayesPlusOn=False):
+	strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement=topologySearchOptions(strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,None)
 	up=tree.up
 	children=tree.children
 	mutations=tree.mutations
@@ -5967,6 +7122,125 @@ def findBestRoot(tree,root,strictTopologyStopRules=strictTopologyStopRules,allow
 
 
 numMinorsFound=[0]
+
+#Inverted index of the mutations of the mutation-annotated tree (tree.mutationIndex, used with option --mutationIndexPlacement):
+# for each (position, nucleotide) the set of nodes with a mutation to that nucleotide at that position in their mutation list.
+#Nodes are added again with addNode() when their mutation list changes (see indexNodeMutations()); nodes that no longer have a mutation
+# are removed from its set when it is looked up.
+class MutationIndex(object):
+	def __init__(self,tree):
+		self.mutations=tree.mutations
+		self.nodes={}
+		for node in range(len(tree.mutations)):
+			if tree.mutations[node]:
+				self.addNode(node)
+	def __repr__(self):
+		return "MutationIndex object"
+	def addNode(self,node):
+		for mutation in self.mutations[node]:
+			key=(mutation[0],mutation[2])
+			if key in self.nodes:
+				self.nodes[key].add(node)
+			else:
+				self.nodes[key]={node}
+	#nodes with a mutation to nucleotide nuc at position pos.
+	def nodesWithMutation(self,pos,nuc):
+		nodes=self.nodes.get((pos,nuc))
+		if not nodes:
+			return []
+		found=[]
+		for node in list(nodes):
+			for mutation in self.mutations[node]:
+				if mutation[0]==pos and mutation[2]==nuc:
+					found.append(node)
+					break
+			else:
+				nodes.discard(node)
+		return found
+
+#update the mutation index of the tree (if there is one) after the mutation list of node has changed.
+def indexNodeMutations(tree,node):
+	if hasattr(tree,"mutationIndex") and tree.mutations[node]:
+		tree.mutationIndex.addNode(node)
+
+#Find the node from which to start the placement search of a new sample with genome list diffs (with respect to the reference at the root).
+#Nodes with mutations to the same nucleotides as the sample are looked up in the mutation index; among them, we choose the one with the most mutations
+# (including those of the references above it) matching the sample, and with no mutation contradicting it (positions where the sample is N or O are ignored).
+#The search starts from the parent of this node (or the first ancestor with a positive branch length), so that placements on the branch above the clade are also considered.
+#Returns root if no such node is found.
+def placementStartNode(tree,root,diffs):
+	up=tree.up
+	dist=tree.dist
+	mutations=tree.mutations
+	if not hasattr(tree,"mutationIndex"):
+		tree.mutationIndex=MutationIndex(tree)
+	#nucleotides of the sample at the positions where it differs from the reference, and its N stretches
+	alleles={}
+	nStarts, nEnds = [], []
+	pos=0
+	for entry in diffs:
+		if entry[0]==4:
+			pos=entry[1]
+		elif entry[0]==5:
+			nStarts.append(pos)
+			nEnds.append(entry[1])
+			pos=entry[1]
+		else:
+			pos+=1
+			alleles[pos]=entry[0]
+	def alleleAt(pos):
+		if pos in alleles:
+			if alleles[pos]==6:
+				return None
+			return alleles[pos]
+		i=bisect_left(nEnds,pos)
+		if i<len(nEnds) and nStarts[i]<pos:
+			return None
+		return refIndeces[pos-1]
+	#number of mutations on the path from the root to each node considered, or -1 if the sample does not carry all of them (ambiguous positions are not trusted)
+	scores={}
+	def pathScore(node):
+		path=[]
+		while node!=None and (node not in scores):
+			path.append(node)
+			node=up[node]
+		score=0
+		if node!=None:
+			score=scores[node]
+		while path:
+			node=path.pop()
+			if score>=0:
+				for mutation in mutations[node]:
+					if alleleAt(mutation[0])==mutation[2]:
+						score+=1
+					else:
+						score=-1
+						break
+			scores[node]=score
+		return score
+	bestNode, bestScore = None, 0
+	for pos in alleles:
+		if alleles[pos]<4:
+			for node in tree.mutationIndex.nodesWithMutation(pos,alleles[pos]):
+				score=pathScore(node)
+				if score>bestScore:
+					bestNode, bestScore = node, score
+	if bestNode==None:
+		return root
+	#start from above the outermost clade carrying mutations matched by the sample, so that the crawl can still reach the sister clades
+	startNode=bestNode
+	node=up[bestNode]
+	while node!=None:
+		if mutations[node]:
+			startNode=node
+		node=up[node]
+	startNode=up[startNode]
+	while startNode!=None and up[startNode]!=None and not dist[startNode]:
+		startNode=up[startNode]
+	if startNode==None or up[startNode]==None:
+		return root
+	return startNode
+
 #function to find the best node in the tree where to append the new sample; traverses the tree and tries to append the sample at each node and mid-branch nodes, 
 # but stops traversing when certain criteria are met.
 #TODO account for HnZ modifiers in placement search
@@ -5985,10 +7259,54 @@ def findBestParentForNewSample(tree,root,diffs,sample):
 	bestNodes=[]
 	bestNode=root
 	bestBranchLengths=(False,False,oneMutBLen)
-	if mutations[root]:
-		diffs=passGenomeListThroughBranch(diffs,mutations[root])
-	bestDiffs=diffs
-	if not children[root]: #check if the new leaf is strictly less informative than already placed leaf
+	#the placement likelihood costs of the children of a node are calculated together with appendProbNodeToCandidates() when they are added to nodesToVisit;
+	# the profiles of the genome lists of the new sample are kept in profiles, and removed when the genome lists are shortened.
+	nodesToVisit=[]
+	profiles={}
+	def addChildrenToVisit(node,LKdiff,failedPasses,diffs):
+		newNodes=[]
+		for c in children[node]:
+			diffsChild=diffs
+			if mutations[c]:
+				diffsChild=passGenomeListThroughBranch(diffs,mutations[c])
+			newNodes.append((c,diffsChild))
+		candidates=[newNode for newNode in newNodes if dist[newNode[0]]]
+		LKdiffs=appendProbNodeToCandidates([probVectTotUp[c] for c, diffsChild in candidates],[diffsChild for c, diffsChild in candidates],True,oneMutBLen,profiles=profiles)
+		for c, diffsChild in newNodes:
+			if dist[c]:
+				nodesToVisit.append((c,LKdiff,failedPasses,diffsChild,LKdiffs.pop(0)))
+			else:
+				nodesToVisit.append((c,LKdiff,failedPasses,diffsChild,None))
+
+	#with option --mutationIndexPlacement, start the search from the clade suggested by the mutation index, using strict stop rules
+	startNode=root
+	if mutationIndexPlacement:
+		startNode=placementStartNode(tree,root,diffs)
+	stopRulesStrict=strictStopRules or (startNode!=root)
+	if startNode!=root:
+		path=[]
+		node=startNode
+		while node!=None:
+			path.append(node)
+			node=up[node]
+		while path:
+			node=path.pop()
+			if mutations[node]:
+				diffs=passGenomeListThroughBranch(diffs,mutations[node])
+		shorten(diffs)
+		bestLKdiff=appendProbNodeToCandidates([probVectTotUp[startNode]],[diffs],True,oneMutBLen,profiles=profiles)[0]
+		#TODO
+		if HnZ:
+			bestLKdiff+=getHnZ(2) - getHnZ(1)
+		bestNode=startNode
+		bestNodes.append((startNode,bestLKdiff,diffs))
+		bestDiffs=diffs
+		addChildrenToVisit(startNode,bestLKdiff,0,diffs)
+	else:
+		if mutations[root]:
+			diffs=passGenomeListThroughBranch(diffs,mutations[root])
+		bestDiffs=diffs
+	if startNode==root and not children[root]: #check if the new leaf is strictly less informative than already placed leaf
 		#TODO do not collapse less informative sequences also in case of HnZ
 		if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate or supportFor0Branches or HnZ:
 			comparison=isMinorSequence(probVect[root],diffs,onlyFindIdentical=True)
@@ -6003,19 +7321,15 @@ def findBestParentForNewSample(tree,root,diffs,sample):
 			return root, 1.0, None, diffs
 		elif comparison==2:
 			totalMissedMinors[0]+=1
-	rootVect=rootVector(probVect[root],False,False,tree,root)
-	bestLKdiff=appendProbNode(rootVect,diffs,True,oneMutBLen)
-	#TODO
-	if HnZ:
-		bestLKdiff+=getHnZ(nDesc0[root]+1) - getHnZ(nDesc0[root])
-	nodesToVisit=[]
-	for child in children[root]:
-		diffsChild=diffs
-		if mutations[child]:
-			diffsChild=passGenomeListThroughBranch(diffs,mutations[child])
-		nodesToVisit.append((child,bestLKdiff,0,diffsChild))
+	if startNode==root:
+		rootVect=rootVector(probVect[root],False,False,tree,root)
+		bestLKdiff=appendProbNode(rootVect,diffs,True,oneMutBLen)
+		#TODO
+		if HnZ:
+			bestLKdiff+=getHnZ(nDesc0[root]+1) - getHnZ(nDesc0[root])
+		addChildrenToVisit(root,bestLKdiff,0,diffs)
 	while nodesToVisit:
-		t1,parentLK,failedPasses,diffs=nodesToVisit.pop()
+		t1,parentLK,failedPasses,diffs,LKdiff=nodesToVisit.pop()
 		if not children[t1]: #check if the new leaf is strictly less informative than already placed leaf
 			#TODO do not collapse less informative sequences also in case of HnZ
 			if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate or supportFor0Branches or HnZ:
@@ -6048,11 +7362,11 @@ def findBestParentForNewSample(tree,root,diffs,sample):
 				totalMissedMinors[0]+=1
 
 		if dist[t1] and up[t1]!=None: # try first placing as a descendant of the mid-branch point of the branch above the current node.
-			LKdiff=appendProbNode(probVectTotUp[t1],diffs,True,oneMutBLen)
 			#TODO
 			if HnZ:
 				LKdiff+=getHnZ(2) - getHnZ(1)
 			if LKdiff>=bestLKdiff:
+				profiles.pop(id(diffs),None)
 				shorten(diffs)
 				bestLKdiff=LKdiff
 				bestNode=t1
@@ -6066,20 +7380,12 @@ def findBestParentForNewSample(tree,root,diffs,sample):
 		else:
 			LKdiff=parentLK
 		#keep trying to place at children nodes, unless placement has failed too many times already or the likelihood cost suboptimality is above a certain threshold
-		if strictStopRules:
+		if stopRulesStrict:
 			if failedPasses<=allowedFails and LKdiff>(bestLKdiff-thresholdLogLK): 
-				for c in children[t1]:
-					diffsChild=diffs
-					if mutations[c]:
-						diffsChild=passGenomeListThroughBranch(diffs,mutations[c])
-					nodesToVisit.append((c,LKdiff,failedPasses,diffsChild))
+				addChildrenToVisit(t1,LKdiff,failedPasses,diffs)
 		else:
 			if failedPasses<=allowedFails or LKdiff>(bestLKdiff-thresholdLogLK):
-				for c in children[t1]:
-					diffsChild=diffs
-					if mutations[c]:
-						diffsChild=passGenomeListThroughBranch(diffs,mutations[c])
-					nodesToVisit.append((c,LKdiff,failedPasses,diffsChild))
+				addChildrenToVisit(t1,LKdiff,failedPasses,diffs)
 	#Initial exploration is finished.
 	#Now, for each branch within threshold likelihood distance from the best found, optimize branch lengths.
 	#Use optimized scores to select final best branch
@@ -6172,33 +7478,42 @@ def makeNodeReference(tree,node,oldValue=0):
 			pos+=1
 		else:
 			pos=entry[1]
+	indexNodeMutations(tree,node)
 	#update node's genome lists accordingly
 	probVect[node]=passGenomeListThroughBranch(probVect[node],mutations[node])
 	shorten(probVect[node])
-	if dist[node] and up[node]!=None:
-		probVectTotUp[node]=passGenomeListThroughBranch(probVectTotUp[node],mutations[node])
-		shorten(probVectTotUp[node])
-	probVectUpRight[node]=passGenomeListThroughBranch(probVectUpRight[node],mutations[node])
-	shorten(probVectUpRight[node])
-	probVectUpLeft[node]=passGenomeListThroughBranch(probVectUpLeft[node],mutations[node])
-	shorten(probVectUpLeft[node])
+	#with option --lowMemory, upward genome lists are instead recalculated when needed, using the new mutations.
+	if lowMemory:
+		tree.upwardCache.forget(node)
+	else:
+		if dist[node] and up[node]!=None:
+			probVectTotUp[node]=passGenomeListThroughBranch(probVectTotUp[node],mutations[node])
+			shorten(probVectTotUp[node])
+		probVectUpRight[node]=passGenomeListThroughBranch(probVectUpRight[node],mutations[node])
+		shorten(probVectUpRight[node])
+		probVectUpLeft[node]=passGenomeListThroughBranch(probVectUpLeft[node],mutations[node])
+		shorten(probVectUpLeft[node])
 	#now traverse descendant nodes to update their genome lists and mutation lists
 	nodesToVisit=[children[node][0],children[node][1]]
 	while nodesToVisit:
 		newNode=nodesToVisit.pop()
 		if mutations[newNode]:
 			mutations[newNode]=mergeMutationLists(mutations[node],mutations[newNode],downward=True)
+			indexNodeMutations(tree,newNode)
 		else:
 			probVect[newNode]=passGenomeListThroughBranch(probVect[newNode],mutations[node])
 			shorten(probVect[newNode])
-			if dist[newNode]:
+			if lowMemory:
+				tree.upwardCache.forget(newNode)
+			elif dist[newNode]:
 				probVectTotUp[newNode]=passGenomeListThroughBranch(probVectTotUp[newNode],mutations[node])
 				shorten(probVectTotUp[newNode])
 			if children[newNode]:
-				probVectUpRight[newNode]=passGenomeListThroughBranch(probVectUpRight[newNode],mutations[node])
-				shorten(probVectUpRight[newNode])
-				probVectUpLeft[newNode]=passGenomeListThroughBranch(probVectUpLeft[newNode],mutations[node])
-				shorten(probVectUpLeft[newNode])
+				if not lowMemory:
+					probVectUpRight[newNode]=passGenomeListThroughBranch(probVectUpRight[newNode],mutations[node])
+					shorten(probVectUpRight[newNode])
+					probVectUpLeft[newNode]=passGenomeListThroughBranch(probVectUpLeft[newNode],mutations[node])
+					shorten(probVectUpLeft[newNode])
 				nodesToVisit.append(children[newNode][0])
 				nodesToVisit.append(children[newNode][1])
 
@@ -6314,6 +7629,7 @@ def placeSampleOnTree(tree,node,newPartials,sample,newChildLK, bestUpLength, bes
 		shorten(probVectUpLeft[newRoot])
 		mutations[newRoot]=mutations[node]
 		mutations[node]=[]
+		indexNodeMutations(tree,newRoot)
 		up[node]=newRoot
 		dist[node]=bestLeftLength
 		#TODO 
@@ -6369,6 +7685,7 @@ def placeSampleOnTree(tree,node,newPartials,sample,newChildLK, bestUpLength, bes
 	#use descendantsToPass to update nDesc of parent nodes (up to the next reference met), and decide if and which internal nodes will become references
 	if mutations[node] and (not bestDownLength):
 		mutations[newInternalNode]=mutations[node]
+		indexNodeMutations(tree,newInternalNode)
 		nDesc[newInternalNode]=nDesc[node]
 		if bestAppendingLength:
 			nDesc[newInternalNode]+=1
@@ -6673,6 +7990,7 @@ def placeSubtreeOnTree(tree,node,newPartials,appendedNode,newChildLK,bestBranchL
 		shorten(probVectUpLeft[newRoot])
 		mutations[newRoot]=mutations[node]
 		mutations[node]=[]
+		indexNodeMutations(tree,newRoot)
 		up[node]=newRoot
 		dist[node]=bestLeftLength
 		children[newRoot][0]=node
@@ -6707,6 +8025,7 @@ def placeSubtreeOnTree(tree,node,newPartials,appendedNode,newChildLK,bestBranchL
 	newInternalNode=up[appendedNode]
 	mutations[newInternalNode]=mutations[node]
 	mutations[node]=[]
+	indexNodeMutations(tree,newInternalNode)
 	dirty[newInternalNode]=True
 	replacements[newInternalNode]+=1
 	children[up[node]][child]=newInternalNode
@@ -6866,6 +8185,7 @@ def cutAndPasteNode(tree,node,bestNode,bestBranchLengths,bestLK,passedProbVect):
 	#	calculateNDesc0(tree,t1,checkExisting=True)
 	if mutations[parentNode]:
 		mutations[sibling]=mergeMutationLists(mutations[parentNode],mutations[sibling])
+		indexNodeMutations(tree,sibling)
 	#update likelihood lists after node removal
 	if up[sibling]==None:
 		dist[sibling]=1.0
@@ -6897,7 +8217,8 @@ def cutAndPasteNode(tree,node,bestNode,bestBranchLengths,bestLK,passedProbVect):
 		while up[currentRoot]!=None:
 			currentRoot=up[currentRoot]
 		intermediateTreesFile.write("Topology "+str(topologyChanges[0])+"\n")
-		intermediateTreesFile.write(createNewick(tree,currentRoot,binary=binaryTree,namesInTree=namesInTree)+"\n")
+		createNewick(tree,currentRoot,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,file=intermediateTreesFile)
+		intermediateTreesFile.write("\n")
 		
 	if (writeLKsToFileEveryTheseSteps>0) and (topologyChanges[0]%writeLKsToFileEveryTheseSteps)==0:
 		currentRoot=sibling
@@ -6923,7 +8244,8 @@ def cutAndPasteNode(tree,node,bestNode,bestBranchLengths,bestLK,passedProbVect):
 #TODO accounting for branch length changes affecting nDesc0
 topologyUpdates=[0]
 bLenUpdates=[0]
-def traverseTreeForTopologyUpdate(tree,node,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,thresholdTopologyPlacement=thresholdTopologyPlacement):
+def traverseTreeForTopologyUpdate(tree,node,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,thresholdTopologyPlacement=None):
+	strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement=topologySearchOptions(strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement)
 	up=tree.up
 	children=tree.children
 	probVectUpRight=tree.probVectUpRight
@@ -7081,7 +8403,8 @@ def traverseTreeForTopologyUpdate(tree,node,strictTopologyStopRules=strictTopolo
 #Function to apply the SPR moves identified by the parallelized SPR search (startTopologyUpdatesParallel).
 #Applies changes starting from the last ones in the input list (those with highest LK improvement).
 #Input list contains for each entry 1)pruned node 2) regraft node 3) LK improvement.
-def applySPRMovesParallel(tree,results,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,thresholdTopologyPlacement=thresholdTopologyPlacement):
+def applySPRMovesParallel(tree,results,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,thresholdTopologyPlacement=None):
+	strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement=topologySearchOptions(strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement)
 	if aBayesPlusOn and networkOutput:
 		alternativePlacements=tree.alternativePlacements
 	cumulativeImprovement=0.0
@@ -7095,20 +8418,24 @@ def applySPRMovesParallel(tree,results,strictTopologyStopRules=strictTopologySto
 		cumulativeImprovement+=improvement
 		if newRoot2!=None:
 			newRoot=newRoot2
+		checkpointTraversal(tree,node,cumulativeImprovement,remainingMoves=results)
 	return newRoot, cumulativeImprovement
 
 
 #traverse the tree (here the input "node" will usually be the root), and for each dirty node ancountered, call traverseTreeForTopologyUpdate() 
 # to attempt an SPR move by cutting the subtree rooted at this dirty node and trying to re-append it elsewhere.
 #TODO count how many nodes are re-placed, how many are investigated, etc.
-def startTopologyUpdates(tree,node,checkEachSPR=False,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,thresholdTopologyPlacement=thresholdTopologyPlacement,printEvery=10000):
+def startTopologyUpdates(tree,node,checkEachSPR=False,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,thresholdTopologyPlacement=None,printEvery=10000,nodesToVisit=None):
+	strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement=topologySearchOptions(strictTopologyStopRules,allowedFailsTopology,thresholdLogLKtopology,thresholdTopologyPlacement)
 	up=tree.up
 	children=tree.children
 	dirty=tree.dirty
 	replacements=tree.replacements
 	if aBayesPlusOn and networkOutput:
 		alternativePlacements=tree.alternativePlacements
-	nodesToVisit=[node]
+	#nodesToVisit can be given to continue a traversal interrupted after a checkpoint (see resumeTopologyUpdates())
+	if nodesToVisit==None:
+		nodesToVisit=[node]
 	totalImprovement=0.0
 	newRoot=None
 	numNodes=0
@@ -7157,6 +8484,7 @@ def startTopologyUpdates(tree,node,checkEachSPR=False,strictTopologyStopRules=st
 			numNodes+=1
 			if (numNodes%printEvery)==0:
 				print("Processed topology for "+str(numNodes)+" nodes.")
+			checkpointTraversal(tree,newNode,totalImprovement,nodesToVisit=nodesToVisit)
 		#elif not dirty[newNode]:
 		#	notDirtyNodes+=1
 		#elif replacements[newNode]>maxReplacements:
@@ -8456,471 +9784,93 @@ def variance(numList):
 	return m, var_res
 
 
-print("Calculating distances with sample names", flush=True)
-#don't put samples already in the tree back to the tree again
-distances=distancesFromRefPunishNs(data,samples=data.keys(),samplesInInitialTree=namesInTreeDict,forgetData=True)
-if len(distances)>0:
-	print("Distances from the reference calculated. Average divergence from refererence: "+str(totDivFromRef[0]/len(distances)), flush=True)
-namesInTreeDict.clear()
-
-if rateVariation and (not inputRates):
-	useRateVariation=True
-	siteRates=[1.0]*lRef
-	mutMatrices=[]
-	for i in range(lRef):
-		mutMatrices.append([])
-		for j in range4:
-			mutMatrices[i].append(list(mutMatrixGlobal[j]))
-if not rateVariation:
-	siteRates=None
-
-if inputTree=="": #initialize tree to just the initial root sample
-	#extract root genome among those closest to the reference but not empty
-	firstSample=distances.pop()
-	namesInTree.append(firstSample[1])
-	tree1=Tree()
-	tree1.addNode()
-	tree1.name[-1]=0
-	t1=0
-	tree1.probVect[-1]=probVectTerminalNode(data[firstSample[1]],tree1,t1)
-	data[firstSample[1]]=None
-	numSamples=1
-else:
-	t1=rootIndex1
-	numSamples=len(namesInTree)
-	if numSamples>minNumSamplesForErrorModel or (not largeUpdate):
-		if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
-			usingErrorRate=True
-	print(str(len(namesInTree))+" named samples in the initial tree")
-tree=tree1
-
-if errorRateSiteSpecificFile:
-	#check if file exists
-	if not os.path.isfile(errorRateSiteSpecificFile):
-		print("errorRateSiteSpecific file " + errorRateSiteSpecificFile + " not found, quitting MAPLE tree inference. Use option --errorRateSiteSpecificFile to specify a valid input file.")
-		raise Exception("exit")
-	fileI = open(errorRateSiteSpecificFile, "r")
-	line = fileI.readline()
-	fileI.close()
-	errorRates = [float(errR) for errR in line.split(", ")]
-	if len(errorRates)!=lRef:
-		print("Number of error rates in errorRateSiteSpecific file " + errorRateSiteSpecificFile + " is different from the length of the reference - exiting MAPLE.")
-		raise Exception("exit")
-	errorRateGlobal=sum(errorRates)/lRef
-	updateErrorRates(errorRateGlobal,errorRates=errorRates)
-	errorRateSiteSpecific=True
-elif errorRateFixed:
-	errorRateGlobal=errorRateFixed
-	updateErrorRates(errorRateGlobal)
-elif estimateErrorRate:
-	if errorRateInitial:
-		errorRateGlobal=errorRateInitial
-	else:
-		errorRateGlobal=1.0/lRef
-	updateErrorRates(errorRateGlobal)
-elif estimateSiteSpecificErrorRate:
-	if not inputRates:
-		if errorRateInitial:
-			errorRateGlobal=errorRateInitial
-		else:
-			errorRateGlobal=1.0/lRef
-		errorRates=[errorRateGlobal]*lRef
-		updateErrorRates(errorRateGlobal,errorRates=errorRates)
-	errorRateSiteSpecific=True
-
-# initial EM round to estimate rate variation etc on the initial tree
-if (numSamples>1) and (model!="JC" or ((numSamples>=minNumSamplesForRateVar) and useRateVariation ) or ((numSamples>=minNumSamplesForErrorModel) and usingErrorRate)):
-	start=time()
-	mutMatrixGlobal, siteRatesEst, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
-	print("EM from initial tree terminated, using rate variation "+str(useRateVariation)+", using error rates "+str(usingErrorRate)+".  ")
-	updateMutMatrices(mutMatrixGlobal,siteRates=siteRatesEst)
-	if usingErrorRate:
-		errorRates=errorRatesEst
-		updateErrorRates(errorRateGlobal,errorRates=errorRates)
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("LK after first EM: "+str(newLk))
-	if usingErrorRate and (estimateErrorRate or estimateSiteSpecificErrorRate):
-		oldLK=float("-inf")
-		numEMsteps=0
-		while (newLk-oldLK>1.0) and numEMsteps<20:
-			setAllDirty(tree,t1)
-			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-			reCalculateAllGenomeLists(tree,t1)
-			newLkBranch=calculateTreeLikelihood(tree,t1)
-			print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch))
-			mutMatrixGlobal, siteRates, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
-			updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-			if usingErrorRate:
-				errorRates=errorRatesEst
-				updateErrorRates(errorRateGlobal,errorRates=errorRates)
-			reCalculateAllGenomeLists(tree,t1)
-			oldLK=newLk
-			newLk=calculateTreeLikelihood(tree,t1)
-			print("New LK step "+str(numEMsteps)+": "+str(newLk))
-			numEMsteps+=1
-
-	timeRecalculation=time()-start
-	print("Time to run initial tree EM estimation: "+str(timeRecalculation))
-
-
-#Place input samples to create an initial tree (or extend the input tree).
-timeFinding=0.0
-timePlacing=0.0
-lastUpdateNumSamples=numSamples
-if not doNotPlaceNewSamples:
-	while distances:
-		d=distances.pop()
-		sample=d[1]
-		namesInTree.append(sample)
-		newPartials=probVectTerminalNode(data[sample],None,None)
-		data[sample]=None
-		if (numSamples<minNumSamplesForRateVar or (not useRateVariation)) and ((numSamples%updateSubstMatrixEveryThisSamples)==0):
-			if model!="JC":
-				if updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal):
-					updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-		if (numSamples%50000)==0:
-			print("Sample num "+str(numSamples), flush=True)
-		if (useRateVariation and (numSamples>minNumSamplesForRateVar) and (numSamples>2*lastUpdateNumSamples)):
-			start=time()
-			lastUpdateNumSamples=numSamples
-			if numSamples>minNumSamplesForErrorModel:
-				if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
-					usingErrorRate=True
-			reCalculateAllGenomeLists(tree,t1)
-			mutMatrixGlobal, siteRates, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
-			updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-			if usingErrorRate:
-				errorRates=errorRatesEst
-				updateErrorRates(errorRateGlobal,errorRates=errorRates)
-			reCalculateAllGenomeLists(tree,t1)
-			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-			reCalculateAllGenomeLists(tree,t1)
-			print(" EM to update parameters during initial placement terminated, time taken: "+str(time()-start))
-
-		start=time()
-		bestNode , bestScore, bestBranchLengths, bestPassedVect = findBestParentForNewSample(tree,t1,newPartials,numSamples)
-		timeFinding+=(time()-start)
-		if bestBranchLengths!=None:
-			start=time()
-			newRoot=placeSampleOnTree(tree,bestNode,bestPassedVect,numSamples,bestScore, bestBranchLengths[0], bestBranchLengths[1], bestBranchLengths[2],pseudoMutCounts)
-			if newRoot!=None:
-				t1=newRoot
-			timePlacing+=(time()-start)
-		numSamples+=1
-
-		if (numSamples%saveInitialTreeEvery)==0:
-			newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree)
-			fileName=outputFile+"_initialTree_"+str(numSamples)+"samples.tree"
-			file=open(fileName,"w")
-			file.write(newickString)
-			file.close()
-			print("Partial initial tree written to file "+fileName)
-print("Sample placement completed", flush=True)
-print("Number of minor samples removed from the starting tree: "+str(numMinorsRemoved[0]))
-print("Number of placed samples that have become minor sequences: "+str(numMinorsFound[0]))
-
-if HnZ:
-	#print("Re-calculating the nDesc0")
-	calculateNDesc0(tree,t1) # ,checkExisting=True
-
-if (numChildLKs[0]>0) and (not useFixedThresholdLogLKoptimizationTopology):
-	aveChildLK=sumChildLKs[0]/numChildLKs[0]
-	thresholdLogLKoptimizationTopology=max(thresholdLogLKoptimizationTopology,-0.2*aveChildLK)
-	print("thresholdLogLKoptimizationTopology set to "+str(thresholdLogLKoptimizationTopology))
-
-print("Number of references in the MAT: "+str(numRefs[0]), flush=True)
-
-#After placing all the samples, re-estimate the substitution model and recalculate the likelihoods.
-reCalculateAllGenomeLists(tree,t1,countNodes=True)
-if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("Tree LK before error rates EM: "+str(newLk))
-	usingErrorRate=True
-	mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-	if estimateErrorRate:
-		print("Error rate: "+str(errorRateGlobal))
-	if rateVariation:
-		meanRate, varianceRate = variance(siteRates)
-		for i in range(lRef):
-			if siteRates[i]<0.0:
-				print("negative rate "+str(siteRates[i])+" "+str(i))
-		print("Rate variation variance: "+str(varianceRate))
-	if errorRateSiteSpecific:
-		meanErrorRate, varianceErrorRate = variance(errorRates)
-		for i in range(lRef):
-			if errorRates[i]<0.0:
-				print("negative error rate "+str(errorRates[i])+" "+str(i))
-		print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
-	updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-	if usingErrorRate:
-		updateErrorRates(errorRateGlobal,errorRates=errorRates)
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("Tree LK after first errors EM: "+str(newLk))
-	improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("Tree LK after branch length optimization: "+str(newLk))
-
-
-data.clear()
-
-#put sample names in the tree
-if debugging and inputTree=="":
-	nextLeaves=[t1]
-	while nextLeaves:
-		node=nextLeaves.pop()
-		if not tree.children[node]:
-			tree.name[node]="S"+str(tree.name[node])
-			print(tree.name[node])
-			print(tree.probVect[node])
-			for m in range(len(tree.minorSequences[node])):
-				tree.minorSequences[node][m]="S"+str(tree.minorSequences[node][m])
-		else:
-			for c in tree.children[node]:
-				nextLeaves.append(c)
-
-
-#recalculate all genome lists according to the final substitution model
-if inputTree=="" or largeUpdate or rateVariation or usingErrorRate:
-	start=time()
-	reCalculateAllGenomeLists(tree,t1)
-	
-	#if using error rates, run EM iteratively until convergence in likelihood, otherwise only run one EM step
-	if model!="JC" or rateVariation or estimateErrorRate or estimateSiteSpecificErrorRate:
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK before EM: "+str(newLk))
-		mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-		updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-		if usingErrorRate:
-			updateErrorRates(errorRateGlobal,errorRates=errorRates)
-		reCalculateAllGenomeLists(tree,t1)
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK after EM: "+str(newLk))
-		setAllDirty(tree,t1)
-		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-		reCalculateAllGenomeLists(tree,t1)
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK after branch length optimization: "+str(newLk))
-		if estimateErrorRate or estimateSiteSpecificErrorRate:
-			oldLK=float("-inf")
-			#newLk=calculateTreeLikelihood(tree,t1)
-			#print("EM estimation of error rates. Initial LK after first pass: "+str(newLk))
-			numEMsteps=0
-			while (newLk-oldLK>1.0) and numEMsteps<20:
-				setAllDirty(tree,t1)
-				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-				reCalculateAllGenomeLists(tree,t1)
-				newLkBranch=calculateTreeLikelihood(tree,t1)
-				print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch))
-
-				mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-				updateErrorRates(errorRateGlobal,errorRates=errorRates)
-				reCalculateAllGenomeLists(tree,t1)
-				oldLK=newLk
-				newLk=calculateTreeLikelihood(tree,t1)
-				print("New LK step "+str(numEMsteps)+": "+str(newLk))
-				numEMsteps+=1
-			if rateVariation:
-				meanRate, varianceRate = variance(siteRates)
-				print("Rate variation variance: "+str(varianceRate))
-			if errorRateSiteSpecific:
-				meanErrorRate, varianceErrorRate = variance(errorRates)
-				print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
-			print("Error rate: "+str(errorRateGlobal))
-
-	timeRecalculation=time()-start
-	print("Time to run EM pre-topology estimation: "+str(timeRecalculation))
-
-	print("Number of nodes: "+str(numNodes[0]))
-	print("Rs per node: "+str(float(numNodes[2])/numNodes[0]))
-	print("Os per node: "+str(float(numNodes[4])/numNodes[0]))
-	print("Nucs per node: "+str(float(numNodes[1])/numNodes[0]))
-	print("Ns per node: "+str(float(numNodes[3])/numNodes[0]))
-	print("MAT mutations per node: "+str(float(numNodes[5])/numNodes[0]))
-
-	start=time()
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("Now proper branch length optimization, LK before: "+str(newLk))
-	setAllDirty(tree,t1)
-	improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	subRound=0
-	while subRound<20:
-		if (not improvement):
-			break
-		subRound+=1
-		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("branch length finalization subround "+str(subRound+1)+", number of changes "+str(improvement)+" final LK: "+str(newLk))
-	timeForBranchOptimization=(time()-start)
-	print("Time for updating branch lengths: "+str(timeForBranchOptimization))
-
-#TODO
-if HnZ:
-	#print("Re-calculating the nDesc0")
-	calculateNDesc0(tree,t1,checkExisting=True)
-
-#find best tree root
-if not doNotReroot:
-	print("Looking for possible better root", flush=True)
-	newT1=findBestRoot(tree,t1,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,aBayesPlusOn=aBayesPlus)
-	if newT1!=t1:
-		print("Better root found")
-		t1=newT1
-
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK before EM: "+str(newLk))
-		mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-		if estimateErrorRate:
-			print("Error rate: "+str(errorRateGlobal))
-		if rateVariation:
-			meanRate, varianceRate = variance(siteRates)
-			for i in range(lRef):
-				if siteRates[i]<0.0:
-					print("negative rate "+str(siteRates[i])+" "+str(i))
-			print("Rate variation variance: "+str(varianceRate))
-		if errorRateSiteSpecific:
-			meanErrorRate, varianceErrorRate = variance(errorRates)
-			for i in range(lRef):
-				if errorRates[i]<0.0:
-					print("negative error rate "+str(errorRates[i])+" "+str(i))
-			print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
-		updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-		if usingErrorRate:
-			updateErrorRates(errorRateGlobal,errorRates=errorRates)
-		reCalculateAllGenomeLists(tree,t1)
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK after first errors EM: "+str(newLk))
-		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-		reCalculateAllGenomeLists(tree,t1)
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Tree LK after branch length optimization: "+str(newLk))
-
-		print("Looking a second time for possible better root", flush=True)
-		newT1=findBestRoot(tree,t1,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,aBayesPlusOn=aBayesPlus)
-		if newT1!=t1:
-			print("Better root found again")
-			t1=newT1
-
-
+#number of lines of the tsv file formatted before being passed to the file at once.
+tsvRowsPerBlock=10000
 
-if (writeTreesToFileEveryTheseSteps>0):
-	currentRoot=t1
-	intermediateTreesFile.write("Topology 0\n")
-	intermediateTreesFile.write(createNewick(tree,currentRoot,binary=binaryTree,namesInTree=namesInTree)+"\n")
-if (writeLKsToFileEveryTheseSteps>0):
-	currentRoot=t1
-	totalLK=calculateTreeLikelihood(tree,currentRoot)
-	intermediateLKsFile.write("Topology 0, LK: "+str(totalLK)+"\n")
-
-
-print(str(len(namesInTree))+" named samples in the tree", flush=True)
-internalNodeNamesGiven=False
-giveInternalNodeNames(tree,t1,namesInTree=namesInTree,replaceNames=False)
-internalNodeNamesGiven=True
-print(str(len(namesInTree))+" named nodes in the tree after assigning internal node names", flush=True)
-
-#generate the string corresponding to a line of the tsv file for use in Taxonium.
+#generate, for each feature in featureList, a function formatting the column of the tsv file (for use in Taxonium) of that feature.
+#Each function takes a node and, for lines of samples identical to others, the name of the clade they are collapsed to (identicalTo).
+#The feature arrays are looked up here once, instead of for every line of the file.
 # TODO should I switch off sample collapsing altogether if calculating support also for 0-dist samples?
 # TODO if representative node is 0-dist, then its support is also the support of all represented nodes.
 # TODO if not, can we assume that the support is of the represented nodes is 1? Yes.
 # TODO pass information about the dist, support and Ns of representative nodes below. Include support of represented nodes only if supportFor0Branches is true, otherwise smpty string.
-def tsvForNode(tree,node,name,featureList,namesInTree,identicalTo=""):
+def tsvColumnFormatters(tree,featureList,namesInTree):
 	dist=tree.dist
-	stringList=[name+"\t"]
-	if identicalTo!="":
-		stringList.append(identicalTo)
-	stringList.append("\t")
+	formatters=[]
 	for feat in featureList:
-		if node!=None:
-			if hasattr(tree, feat):
-				feature=getattr(tree, feat)
-				if (feat=="support" or feat=="IQsupport") :
-					if feature[node]!=None:
-					#if feat=="support" : #dist[node]<=effectivelyNon0BLen:
-						if feat=="support":
-							if identicalTo!="":
-								if supportForIdenticalSequences:
-									if dist[node]<=effectivelyNon0BLen:
-										stringList.append(str(feature[node]))
-									else:
-										stringList.append("1.0")
-							else:
-								stringList.append(str(feature[node]))
-						else:
-							stringList.append(str(feature[node]))
-				#use this column to highlight which nodes could be placed (with probability above threshold) on the branch above the current node - used to highlight alternative placements of a given node on the tree.
-				elif feat=="supportTo" and identicalTo=="":
-					for iNode in range(len(feature[node])):
-						stringList.append(namesInTree[tree.name[feature[node][iNode][0]]]+":"+str(feature[node][iNode][1]))
-						if iNode<(len(feature[node])-1):
-							stringList.append(",")
-				# elif feat=="alternativePlacements":
-				# 	for iNode in range(len(feature[node])):
-				# 		stringList.append(namesInTree[tree.name[feature[node][iNode][0]]]+":"+str(feature[node][iNode][1]))
-				# 		if iNode<(len(feature[node])-1):
-				# 			stringList.append(",")
-				elif feat=="mutationsInf" and identicalTo=="":
-					for iNode in range(len(feature[node])):
-						mutation=feature[node][iNode]
-						stringList.append(allelesListExt[mutation[0]]+str(mutation[1])+allelesListExt[mutation[2]]+":"+str(mutation[3]))
-						if iNode<(len(feature[node])-1):
-							stringList.append(",")
-				elif feat=="Ns":
-					if identicalTo=="" or supportFor0Branches:
-						for iNode in range(len(feature[node])):
-							mutation=feature[node][iNode]
-							if type(mutation)==int:
-								stringList.append(str(mutation))
-							else:
-								stringList.append(str(mutation[0])+"-"+str(mutation[1]))
-							if iNode<(len(feature[node])-1):
-								stringList.append(",")
-				elif feat=="errors":
-					for iNode in range(len(feature[node])):
-						mutation=feature[node][iNode]
-						stringList.append(allelesListExt[mutation[0]]+str(mutation[1])+allelesListExt[mutation[2]]+":"+str(mutation[3]))
-						if iNode<(len(feature[node])-1):
-							stringList.append(",")
-				elif feat=="lineage":
-					stringList.append(feature[node])
-				elif feat=="lineages":
-					for lineageName in feature[node].keys():
-						stringList.append(lineageName+":"+str(feature[node][lineageName]))
-						stringList.append(",")
-					stringList.pop()
-				elif feat=="rootSupport" and identicalTo=="":
-					if feature[node]!=None:
-						stringList.append(str(feature[node]))
-			# this column highlights nodes with support below threshold and with number of descendants above threshold
-			elif feat=="supportGroup":
-				if tree.support[node]!=None:
-					if tree.support[node]<0.9:
-						nDescString="nDesc<11_"
-						if identicalTo=="":
-							if tree.nDesc[node]>100000:
-								nDescString="nDesc>100000_"
-							elif tree.nDesc[node]>10000:
-								nDescString="nDesc>10000_"
-							elif tree.nDesc[node]>1000:
-								nDescString="nDesc>1000_"
-							elif tree.nDesc[node]>100:
-								nDescString="nDesc>100_"
-							elif tree.nDesc[node]>10:
-								nDescString="nDesc>10_"
-						if tree.support[node]<0.5:
-							nDescString+="support<0.5"
-						else:
-							nDescString+="support<0.9"
-					else:
-						nDescString=""
-					stringList.append(nDescString)
-		stringList.append("\t")
-	stringList[-1]="\n"
-	#stringList.append("\n")
-	return "".join(stringList)
+		feature=getattr(tree, feat, None)
+		if feature==None and feat!="supportGroup":
+			formatters.append(lambda node,identicalTo: "")
+		elif feat=="support":
+			def formatSupport(node,identicalTo,feature=feature):
+				if feature[node]==None:
+					return ""
+				if identicalTo!="":
+					if supportForIdenticalSequences:
+						if dist[node]<=effectivelyNon0BLen:
+							return str(feature[node])
+						return "1.0"
+					return ""
+				return str(feature[node])
+			formatters.append(formatSupport)
+		elif feat=="IQsupport":
+			formatters.append(lambda node,identicalTo,feature=feature: "" if feature[node]==None else str(feature[node]))
+		#use this column to highlight which nodes could be placed (with probability above threshold) on the branch above the current node - used to highlight alternative placements of a given node on the tree.
+		elif feat=="supportTo":
+			def formatSupportTo(node,identicalTo,feature=feature):
+				if identicalTo!="":
+					return ""
+				return ",".join([namesInTree[tree.name[placement[0]]]+":"+str(placement[1]) for placement in feature[node]])
+			formatters.append(formatSupportTo)
+		elif feat=="mutationsInf" or feat=="errors":
+			def formatMutations(node,identicalTo,feature=feature,onlyForNode=(feat=="mutationsInf")):
+				if onlyForNode and identicalTo!="":
+					return ""
+				return ",".join([allelesListExt[mutation[0]]+str(mutation[1])+allelesListExt[mutation[2]]+":"+str(mutation[3]) for mutation in feature[node]])
+			formatters.append(formatMutations)
+		elif feat=="Ns":
+			def formatNs(node,identicalTo,feature=feature):
+				if identicalTo!="" and not supportFor0Branches:
+					return ""
+				return ",".join([str(mutation) if type(mutation)==int else str(mutation[0])+"-"+str(mutation[1]) for mutation in feature[node]])
+			formatters.append(formatNs)
+		elif feat=="lineage":
+			formatters.append(lambda node,identicalTo,feature=feature: feature[node])
+		elif feat=="lineages":
+			formatters.append(lambda node,identicalTo,feature=feature: ",".join([lineageName+":"+str(feature[node][lineageName]) for lineageName in feature[node].keys()]))
+		elif feat=="rootSupport":
+			formatters.append(lambda node,identicalTo,feature=feature: "" if (identicalTo!="" or feature[node]==None) else str(feature[node]))
+		# this column highlights nodes with support below threshold and with number of descendants above threshold
+		elif feat=="supportGroup":
+			def formatSupportGroup(node,identicalTo,support=tree.support,nDesc=tree.nDesc):
+				if support[node]==None or support[node]>=0.9:
+					return ""
+				nDescString="nDesc<11_"
+				if identicalTo=="":
+					if nDesc[node]>100000:
+						nDescString="nDesc>100000_"
+					elif nDesc[node]>10000:
+						nDescString="nDesc>10000_"
+					elif nDesc[node]>1000:
+						nDescString="nDesc>1000_"
+					elif nDesc[node]>100:
+						nDescString="nDesc>100_"
+					elif nDesc[node]>10:
+						nDescString="nDesc>10_"
+				if support[node]<0.5:
+					return nDescString+"support<0.5"
+				return nDescString+"support<0.9"
+			formatters.append(formatSupportGroup)
+		else:
+			formatters.append(lambda node,identicalTo: "")
+	return formatters
+
+
+#generate the string corresponding to a line of the tsv file, using the column formatters from tsvColumnFormatters(); if node is None the feature columns are left empty.
+def tsvForNode(node,name,formatters,identicalTo=""):
+	if node==None:
+		return name+"\t"+identicalTo+"\t"*len(formatters)+"\n"
+	return "\t".join([name,identicalTo]+[formatter(node,identicalTo) for formatter in formatters])+"\n"
 
 
 #calculate number of descendants for each node.
@@ -8929,8 +9879,7 @@ def calculateNDesc(tree,node):
 	nDesc=tree.nDesc
 	minorSequences=tree.minorSequences
 	nextLeaves=[node]
-	for i in range(len(nDesc)):
-		nDesc[i]=0
+	nDesc[:]=array("i",[0])*len(nDesc)
 	while nextLeaves:
 		nextNode=nextLeaves.pop()
 		if children[nextNode]:
@@ -8999,7 +9948,9 @@ def writeTSVfile(tree,node,file,namesInTree):
 	for feat in featureList:
 		file.write("\t"+featureNames[feat])
 	file.write("\n")
-	#now write to file the features for each node of the tree.
+	formatters=tsvColumnFormatters(tree,featureList,namesInTree)
+	#now write to file the features for each node of the tree, in blocks of tsvRowsPerBlock lines.
+	rows=[]
 	nextNode=node
 	direction=0
 	numLeaves=0
@@ -9012,7 +9963,7 @@ def writeTSVfile(tree,node,file,namesInTree):
 				direction=0
 			else:
 				if aBayesPlusOn or estimateMAT or performLineageAssignment:
-					file.write(tsvForNode(tree,nextNode,namesInTree[name[nextNode]],featureList,namesInTree))
+					rows.append(tsvForNode(nextNode,namesInTree[name[nextNode]],formatters))
 				if up[nextNode]!=None:
 					if children[up[nextNode]][0]==nextNode:
 						direction=1
@@ -9022,51 +9973,31 @@ def writeTSVfile(tree,node,file,namesInTree):
 		else:
 			numLeaves+=(1+len(minorSequences[nextNode]))
 			if len(minorSequences[nextNode])>0:
+				cladeName=namesInTree[name[nextNode]]+"_MinorSeqsClade"
 				if supportForIdenticalSequences or performLineageAssignment:
-					file.write(tsvForNode(tree,nextNode,namesInTree[name[nextNode]],featureList,namesInTree,identicalTo=namesInTree[name[nextNode]]+"_MinorSeqsClade"))
+					minorNode=nextNode
 				else:
-					file.write(tsvForNode(tree,None,namesInTree[name[nextNode]],featureList,namesInTree,identicalTo=namesInTree[name[nextNode]]+"_MinorSeqsClade"))
+					minorNode=None
+				rows.append(tsvForNode(minorNode,namesInTree[name[nextNode]],formatters,identicalTo=cladeName))
 				for s2 in minorSequences[nextNode]:
-					if supportForIdenticalSequences or performLineageAssignment:
-						file.write(tsvForNode(tree,nextNode,namesInTree[s2],featureList,namesInTree,identicalTo=namesInTree[name[nextNode]]+"_MinorSeqsClade"))
-					else:
-						file.write(tsvForNode(tree,None,namesInTree[s2],featureList,namesInTree,identicalTo=namesInTree[name[nextNode]]+"_MinorSeqsClade"))
+					rows.append(tsvForNode(minorNode,namesInTree[s2],formatters,identicalTo=cladeName))
 				if aBayesPlusOn or estimateMAT or performLineageAssignment:
-					#if supportForIdenticalSequences or performLineageAssignment:
-					file.write(tsvForNode(tree,nextNode,namesInTree[name[nextNode]]+"_MinorSeqsClade",featureList,namesInTree))
-					#else:
-					#	file.write(tsvForNode(tree,None,namesInTree[name[nextNode]]+"_MinorSeqsClade",featureList,namesInTree,identicalTo=namesInTree[name[nextNode]]))
+					rows.append(tsvForNode(nextNode,cladeName,formatters))
 			else:
-				file.write(tsvForNode(tree,nextNode,namesInTree[name[nextNode]],featureList,namesInTree))
+				rows.append(tsvForNode(nextNode,namesInTree[name[nextNode]],formatters))
+			if len(rows)>=tsvRowsPerBlock:
+				file.write("".join(rows))
+				rows=[]
 			if up[nextNode]!=None:
 				if children[up[nextNode]][0]==nextNode:
 					direction=1
 				else:
 					direction=2
 			nextNode=up[nextNode]
+	file.write("".join(rows))
 	file.close()
 
 
-#run topology search
-timeTopology=0.0
-threshValues=[]
-threshNums=[]
-threshStricts=[]
-threshPlaces=[]
-if fastTopologyInitialSearch:
-	threshValues.append(thresholdLogLKtopologyInitial)
-	threshNums.append(allowedFailsTopologyInitial)
-	threshStricts.append(strictTopologyStopRulesInitial)
-	threshPlaces.append(thresholdTopologyPlacementInitial)
-if (inputTree=="" or largeUpdate or aBayesPlus):
-	for i in range(numTopologyImprovements):
-		threshValues.append(thresholdLogLKtopology)
-		threshNums.append(allowedFailsTopology)
-		threshStricts.append(strictTopologyStopRules)
-		threshPlaces.append(thresholdTopologyPlacement)
-nRounds=len(threshNums)
-
-
 #Assign a core to each node of the tree, so that parallelization will run search for different nodes in different cores.
 def assignCoreNumbers(tree,root,numCores):
 	children=tree.children
@@ -9138,357 +10069,1030 @@ def countDirtyNodes(tree,root):
 	return numDirty,numNodes
 
 
-if aBayesPlus:
-	tree.support=[None]*len(tree.up)
-	if networkOutput:
-		tree.alternativePlacements=[]
-		for i in range(len(tree.up)):
-			tree.alternativePlacements.append([])
-
-
-#Run rounds of SPR topological improvements
-for nRound in range(nRounds):
-	if aBayesPlus:
-		aBayesPlusOn=True
-	print("Starting topological impromevement traversal number "+str(nRound+1), flush=True)
-	start=time()
-	setAllDirty(tree,t1)
-	
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("Preliminary branch length optimization from LK: "+str(newLk))
-	#TODO
-	if HnZ:
-		#print("Re-calculating the nDesc0")
-		calculateNDesc0(tree,t1,checkExisting=True)
-	improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	print("Branch length optimization, number of changes: "+str(improvement))
-	subRound=0
-	while subRound<20:
-		if (not improvement):
-			break
-		subRound+=1
-		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("branch length finalization subround "+str(subRound+1)+" number of changes "+str(improvement)+" final LK: "+str(newLk), flush=True)
-	timeForBranchOptimization=(time()-start)
-	print("Time for updating branch lengths: "+str(timeForBranchOptimization))
-
-	#TODO
-	if HnZ:
-		#print("Re-calculating the nDesc0")
-		calculateNDesc0(tree,t1,checkExisting=True)
-
-	#now update the topology
-	start=time()
-	setAllDirty(tree,t1)
-	print("Starting tolopogical improvement round "+str(nRound+1)+" with allowed fails "+str(threshNums[nRound])+" and LK threshold "+str(threshValues[nRound]), flush=True)
-	reCalculateAllGenomeLists(tree,t1)
-	preLK=calculateTreeLikelihood(tree,t1)
-	print("Likelihood before SPR moves: "+str(preLK), flush=True)
-
-	if parallelize:
-	#if parallelRounds[nRound]:
-		#assign numbers to nodes so that each core will only investigate re-placement of its own nodes
-		if nRound==0:
-			assignCoreNumbers(tree,t1,numCores)
-		paralleleInputs=[]
-		for i in range(numCores):
-			paralleleInputs.append((tree,t1,i,threshStricts[nRound],threshNums[nRound],threshValues[nRound],threshPlaces[nRound]))
-		if __name__ == "__main__":
-			with Pool() as pool:
-				results = pool.map(startTopologyUpdatesParallel, paralleleInputs)
-		for i in range(numCores-1):
-			results[0].extend(results[i+1])
-		results[0].sort(reverse=False,key=itemgetter(2))
-		totalTimeFindingParent[0]+=time()-start
-		print("Found proposed SPR moves, merged, and sorted.")
-		setAllDirty(tree,t1,dirtiness=False)
-		newRoot, improvement = applySPRMovesParallel(tree,results[0],strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+#Binary checkpoint of the state of an inference (see options --saveCheckpoints and --resumeFrom):
+# a header with a magic string and the format version, followed by the pickled state, i.e. a dictionary with the stage of the inference ("placement" or "topology"),
+# the reference, the tree with its genome lists and MAT, its root, the sample names, the model (a Model object), some counters and the stage-specific progress.
+checkpointMagic=b"MAPLECKP"
+checkpointVersion=1
+checkpointHeader=struct.Struct("<8sI")
+
+#Unpickler that resolves the MAPLE classes in a checkpoint to the ones of this module,
+# so that checkpoints can be exchanged between runs of the script and uses of the maple package.
+class CheckpointUnpickler(pickle.Unpickler):
+	def find_class(self,module,name):
+		if (module=="__main__" or module=="maple.core") and name in ("Tree","Model","NameStore","MutationIndex","UpwardGenomeListCache","UpwardGenomeListStore"):
+			return globals()[name]
+		return pickle.Unpickler.find_class(self,module,name)
+
+#write a checkpoint file; this is first written to a temporary file that is then renamed, so that an interruption while writing does not affect the previous checkpoint.
+def writeCheckpoint(fileName,stage,tree,root,namesInTree,siteRates,progress):
+	savedModel=Model.current()
+	savedModel.siteRates=siteRates
+	state={"stage":stage,"ref":ref,"tree":tree,"root":root,"namesInTree":namesInTree,"model":savedModel,"thresholdLogLKoptimizationTopology":thresholdLogLKoptimizationTopology,
+		"counters":{"numRefs":numRefs,"numMinorsRemoved":numMinorsRemoved,"numMinorsFound":numMinorsFound,"sumChildLKs":sumChildLKs,"numChildLKs":numChildLKs,"totDivFromRef":totDivFromRef,"totalMissedMinors":totalMissedMinors},
+		"progress":progress}
+	tempFileName=fileName+".tmp"
+	file=open(tempFileName,"wb")
+	file.write(checkpointHeader.pack(checkpointMagic,checkpointVersion))
+	pickle.dump(state,file,protocol=pickle.HIGHEST_PROTOCOL)
+	file.close()
+	os.replace(tempFileName,fileName)
+	lastCheckpointTime[0]=time()
+	print("Checkpoint written to file "+fileName, flush=True)
+
+#time of the last checkpoint, and the model site rates and progress of the current traversal of the tree for topology updates (set by main()),
+# used to write checkpoints from within startTopologyUpdates() and applySPRMovesParallel().
+lastCheckpointTime=[0.0]
+traversalCheckpoint=[None]
+
+#write a checkpoint from within a traversal of the tree for topology updates, if option --checkpointEveryMinutes is used and enough time has passed since the last checkpoint.
+#The dirty flags and replacements of the nodes are saved with the tree, so the traversal can be continued with resumeTopologyUpdates():
+# nodesToVisit is the stack of nodes still to be visited by startTopologyUpdates(), and remainingMoves are the SPR moves still to be applied by applySPRMovesParallel().
+def checkpointTraversal(tree,node,improvement,remainingMoves=None,nodesToVisit=None):
+	if checkpointEveryMinutes<=0 or traversalCheckpoint[0]==None or (time()-lastCheckpointTime[0])<60*checkpointEveryMinutes:
+		return
+	up=tree.up
+	root=node
+	while up[root]!=None:
+		root=up[root]
+	siteRates,progress=traversalCheckpoint[0]
+	progress=dict(progress)
+	progress["inTraversal"]=True
+	progress["improvement"]=improvement
+	progress["remainingMoves"]=remainingMoves
+	if nodesToVisit!=None:
+		progress["nodesToVisit"]=list(nodesToVisit)
+	writeCheckpoint(outputFile+"_checkpoint.bin","topology",tree,root,namesInTree,siteRates,progress)
+
+#continue a traversal of the tree for topology updates from a checkpoint written by checkpointTraversal(), from the node following the last one processed.
+def resumeTopologyUpdates(tree,root,progress,strictTopologyStopRules=None,allowedFailsTopology=None,thresholdLogLKtopology=None,thresholdTopologyPlacement=None):
+	if progress["remainingMoves"]!=None:
+		newRoot,improvement=applySPRMovesParallel(tree,progress["remainingMoves"],strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,thresholdTopologyPlacement=thresholdTopologyPlacement)
 	else:
-		newRoot,improvement=startTopologyUpdates(tree,t1,checkEachSPR=debugging,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
-	if newRoot!=None:
-		t1=newRoot
-	timeForUpdatingTopology=(time()-start)
-	print("Time for round "+str(nRound+1)+" traversal of the tree for topology changes: "+str(timeForUpdatingTopology), flush=True)
-	timeTopology+=timeForUpdatingTopology
-	print("LK improvement apparently brought: "+str(improvement))
-	reCalculateAllGenomeLists(tree,t1)
-	postLK=calculateTreeLikelihood(tree,t1)
-	print("Likelihood after SPR moves: "+str(postLK))
-	
-	print("Writing preliminary tree to file: "+outputFile+"_round"+str(nRound+1)+"_preliminary_tree.tree", flush=True)
-	newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=False,networkOutput=False,aBayesPlusOn=False)
-	file=open(outputFile+"_round"+str(nRound+1)+"_preliminary_tree.tree","w")
-	file.write(newickString)
+		newRoot,improvement=startTopologyUpdates(tree,root,checkEachSPR=debugging,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,thresholdTopologyPlacement=thresholdTopologyPlacement,nodesToVisit=progress["nodesToVisit"])
+	return newRoot,improvement+progress["improvement"]
+
+#read a checkpoint file written by writeCheckpoint(), set up the reference, model and counters it contains, and return the state dictionary.
+def readCheckpoint(fileName):
+	global thresholdLogLKoptimizationTopology
+	if not os.path.isfile(fileName):
+		print("Checkpoint file "+fileName+" not found, quitting MAPLE. Use option --resumeFrom to specify a valid checkpoint file.")
+		raise Exception("exit")
+	file=open(fileName,"rb")
+	header=file.read(checkpointHeader.size)
+	if len(header)<checkpointHeader.size or checkpointHeader.unpack(header)[0]!=checkpointMagic:
+		print("File "+fileName+" is not a MAPLE checkpoint file, quitting MAPLE.")
+		raise Exception("exit")
+	version=checkpointHeader.unpack(header)[1]
+	if version!=checkpointVersion:
+		print("Checkpoint file "+fileName+" has format version "+str(version)+" while this version of MAPLE reads version "+str(checkpointVersion)+", quitting MAPLE.")
+		raise Exception("exit")
+	state=CheckpointUnpickler(file).load()
 	file.close()
-	
+	setUpReference(state["ref"])
+	setUpSubstitutionModel()
+	state["model"].use()
+	thresholdLogLKoptimizationTopology=state["thresholdLogLKoptimizationTopology"]
+	counters=state["counters"]
+	numRefs[:]=counters["numRefs"]
+	numMinorsRemoved[:]=counters["numMinorsRemoved"]
+	numMinorsFound[:]=counters["numMinorsFound"]
+	sumChildLKs[:]=counters["sumChildLKs"]
+	numChildLKs[:]=counters["numChildLKs"]
+	totDivFromRef[:]=counters["totDivFromRef"]
+	totalMissedMinors[:]=counters["totalMissedMinors"]
+	print("Resuming inference from checkpoint file "+fileName+" at stage "+state["stage"]+" with "+str(len(state["namesInTree"]))+" samples in the tree.", flush=True)
+	return state
+
+
+#run MAPLE tree inference (or RF distance calculation or lineage assignment) with the given command line arguments.
+def main(argv=None):
+	global ref, namesInTree, intermediateTreesFile, intermediateLKsFile, thresholdLogLKoptimizationTopology, estimateMAT, networkOutput, aBayesPlusOn
+	global mutMatrixGlobal, mutMatrices, useRateVariation, errorRates, errorRateGlobal, usingErrorRate, errorRateSiteSpecific
+	config=Config.fromArgs(argv)
+	setUpConfig(config)
+	lastCheckpointTime[0]=time()
+
+	if writeTreesToFileEveryTheseSteps>0:
+		lineSplit=outputFile.split("/")
+		lineSplit[-1]=""
+		outFolder="/".join(lineSplit)
+		if not os.path.isdir(outFolder):
+			print("Path to output file "+outFolder+" does not exist, quitting MAPLE. Use option --output to specify a valid output file path and output file name.")
+			raise Exception("exit")
+		if os.path.isfile(outputFileName(outputFile+"_intermediateTrees.tree"))  and (not overwrite):
+			print("File "+outputFileName(outputFile+"_intermediateTrees.tree")+" already exists, quitting MAPLE. Use option --overwrite if you want to overwrite previous inference.")
+			raise Exception("exit")
+		intermediateTreesFile=openFile(outputFileName(outputFile+"_intermediateTrees.tree"),"w")
+	if writeLKsToFileEveryTheseSteps>0:
+		lineSplit=outputFile.split("/")
+		lineSplit[-1]=""
+		outFolder="/".join(lineSplit)
+		if not os.path.isdir(outFolder):
+			print("Path to output file "+outFolder+" does not exist, quitting MAPLE. Use option --output to specify a valid output file path and output file name.")
+			raise Exception("exit")
+		if os.path.isfile(outputFile+"_intermediateLKs.txt")  and (not overwrite):
+			print("File "+outputFile+"_intermediateLKs.txt already exists, quitting MAPLE. Use option --overwrite if you want to overwrite previous inference.")
+			raise Exception("exit")
+		intermediateLKsFile=open(outputFile+"_intermediateLKs.txt","w")
 
-	#run improvements only on the nodes that have been affected by some changes in the last round, and so on
-	start=time()
-	subRound=0
-	while subRound<20:
-		print("Topological subround "+str(subRound+1), flush=True)
-		numDirty,numNodes=countDirtyNodes(tree,t1)
-		#if HnZ:
-			#print("Re-calculating the nDesc0")
-			#calculateNDesc0(tree,t1,checkExisting=True)
-		if parallelize and (numDirty>0.1*numNodes):
-			paralleleInputs=[]
-			for i in range(numCores):
-				paralleleInputs.append((tree,t1,i,threshStricts[nRound],threshNums[nRound],threshValues[nRound],threshPlaces[nRound]))
-			if __name__ == "__main__":
-				with Pool() as pool:
-					results = pool.map(startTopologyUpdatesParallel, paralleleInputs)
-			for i in range(numCores-1):
-				results[0].extend(results[i+1])
-			results[0].sort(reverse=False,key=itemgetter(2))
-			totalTimeFindingParent[0]+=time()-start
-			print("Found proposed SPR moves, merged, and sorted.")
-			setAllDirty(tree,t1,dirtiness=False)
-			newRoot, improvement = applySPRMovesParallel(tree,results[0],strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+	if inputRFtrees!="":
+		compareTreesRF()
+		return
+	if performLineageAssignment:
+		assignLineages()
+		return
+	if convertToBinary!="":
+		convertToBinaryAlignment(inputFile,refFile,convertToBinary)
+		return
+
+	if os.path.isfile(outputFileName(outputFile+"_tree.tree"))  and (not overwrite) and resumeFrom=="":
+		print("File "+outputFileName(outputFile+"_tree.tree")+" already exists, quitting MAPLE tree inference. Use option --overwrite if you want to overwirte previous inference.")
+		raise Exception("exit")
+	if not os.path.isfile(inputFile):
+		print("Input file in Maple format "+inputFile+" not found, quitting MAPLE tree inference. Use option --input to specify a valid input file.")
+		raise Exception("exit")
+	if refFile!="" and (not os.path.isfile(refFile)):
+		print("Input reference fasta file "+refFile+" not found, quitting MAPLE tree inference. Use option --reference to specify a valid input reference file.")
+		raise Exception("exit")
+	lineSplit=outputFile.split("/")
+	lineSplit[-1]=""
+	outFolder="/".join(lineSplit)
+	if not os.path.isdir(outFolder):
+		print("Path to output file "+outFolder+" does not exist, quitting MAPLE tree inference. Use option --output to specify a valid output file path and output file name.")
+		raise Exception("exit")
+	checkpoint=None
+	resumingTopology=False
+	if resumeFrom=="":
+		if inputTree!="":
+			if not os.path.isfile(inputTree):
+				print("Input tree in newick format "+inputTree+" not found, quitting MAPLE. Use option --inputTree to specify a valid input newick tree file.")
+				raise Exception("exit")
+			if isMATfile(inputTree):
+				tree1,rootIndex1,namesInTree,refMAT=readMATfile(inputTree,dirtiness=largeUpdate)
+				namesInTreeDict=namesInTree
+				print("Read input binary MAT")
+			else:
+				trees, namesInTree, namesInTreeDict=readNewick(inputTree,dirtiness=largeUpdate,createDict=True)
+				tree1,rootIndex1=trees[0]
+				refMAT=None
+				print("Read input newick tree")
+			makeTreeBinary(tree1,rootIndex1)
+			#TODO
+			if HnZ:
+				calculateNDesc0(tree1,rootIndex1)
 		else:
-			newRoot,improvement=startTopologyUpdates(tree,t1,checkEachSPR=debugging,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
-		if newRoot!=None:
-			t1=newRoot
-		print("LK improvement apparently brought: "+str(improvement), flush=True)
-		if not noSubroundTrees:
-			print("Writing preliminary tree to file: "+outputFile+"_round"+str(nRound+1)+"_subround"+str(subRound+1)+"_preliminary_tree.tree", flush=True)
-			newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=False,networkOutput=False,aBayesPlusOn=False)
-			file=open(outputFile+"_round"+str(nRound+1)+"_subround"+str(subRound+1)+"_preliminary_tree.tree","w")
-			file.write(newickString)
-			file.close()
-		if improvement<thresholdLogLKTopologySubRoundImprovement:
-			break
-		subRound+=1
-	timeForUpdatingTopology=(time()-start)
-	reCalculateAllGenomeLists(tree,t1)
-	postLK=calculateTreeLikelihood(tree,t1)
-	print("Likelihood after SPR subrounds: "+str(postLK), flush=True)
-	print("Time for the subrounds of this traversal of the tree: "+str(timeForUpdatingTopology), flush=True)
-	timeTopology+=timeForUpdatingTopology
-
-	#if estimating error rates, repeating EM after shallow topological search
-	if estimateErrorRate or estimateSiteSpecificErrorRate:
-		oldLK=float("-inf")
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Initial LK before error rates EM: "+str(newLk), flush=True)
-		mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-		updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
-		updateErrorRates(errorRateGlobal,errorRates=errorRates)
-		reCalculateAllGenomeLists(tree,t1)
-		newLk=calculateTreeLikelihood(tree,t1)
-		print("Initial LK after first error rates EM: "+str(newLk))
-		numEMsteps=0
-		while (newLk-oldLK>1.0) and numEMsteps<20:
-			setAllDirty(tree,t1)
-			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-			reCalculateAllGenomeLists(tree,t1)
-			newLkBranch=calculateTreeLikelihood(tree,t1)
-			print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch), flush=True)
+			namesInTree=NameStore()
+			namesInTreeDict=namesInTree
 
-			mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
-			updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+		if refFile=="":
+			ref, data=readConciseAlignment(inputFile,streaming=streamInput) #extractNames=extractNamesFlag
+		else:
+			ref=collectReference(refFile)
+			data=readConciseAlignment(inputFile, extractReference=False, ref=ref,streaming=streamInput) #,extractNames=extractNamesFlag
+		if inputTree!="" and refMAT!=None and refMAT!=ref:
+			print("The reference of the input binary MAT "+inputTree+" is different from the reference of the input alignment.")
+			raise Exception("exit")
+		setUpReference(ref)
+		print("Length of reference genome: "+str(lRef))
+		setUpSubstitutionModel()
+
+		#reading input subst model to be used as initial values for parameter estimation and tree building.
+		if inputRates!="":
+			if not os.path.isfile(inputRates):
+				print("Input rates file "+inputRates+" not found, quitting MAPLE. Use option --inputRates to specify a valid input rates file, identical in format to MAPLE's output file with model parameters.")
+				raise Exception("exit")
+			fileR=openFile(inputRates)
+			for i in range4:
+				line=fileR.readline()
+				linelist=line.split()
+				for j in range4:
+					mutMatrixGlobal[i][j]=float(linelist[j])
+			clearTransitionVectorCache()
+			if rateVariation:
+				siteRates=[]
+				while line!="Site rates:\n":
+					line=fileR.readline()
+				for i in range(lRef):
+					line=fileR.readline()
+					linelist=line.split()
+					siteRates.append(float(linelist[1]))
+				useRateVariation=True
+				mutMatrices=[]
+				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+			if estimateSiteSpecificErrorRate:
+				usingErrorRate=True
+				errorRates=[]
+				while line!="Site error rates:\n":
+					line=fileR.readline()
+				for i in range(lRef):
+					line=fileR.readline()
+					linelist=line.split()
+					errorRates.append(float(linelist[1]))
+				errorRateGlobal=sum(errorRates)/lRef
+				updateErrorRates(errorRateGlobal,errorRates=errorRates)
+			fileR.close()
+			print("Read input rates")
+
+
+		#In case an input tree is given, calculate all genome lists, pseudocounts and rates, and then recalculate genome lists again according to the new rates.
+		if inputTree!="":
+			#samplesAlreadyInTree=reCalculateAllGenomeLists(tree1,countPseudoCounts=True,pseudoMutCounts=pseudoMutCounts,data=data,firstSetUp=True,checkSamplesIntree=True)
+			if not inputRates:
+				reCalculateAllGenomeLists(tree1,rootIndex1,countPseudoCounts=True,pseudoMutCounts=pseudoMutCounts,data=data,names=namesInTree,firstSetUp=True)
+				if (model!="JC" and updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal)):
+					for i in range4:
+						nonMutRates[i]=mutMatrixGlobal[i][i]
+					for i in range(lRef):
+						cumulativeRate[i+1]=cumulativeRate[i]+nonMutRates[refIndeces[i]]
+				reCalculateAllGenomeLists(tree1,rootIndex1)
+			else:
+				reCalculateAllGenomeLists(tree1,rootIndex1,data=data,names=namesInTree,firstSetUp=True)
+			print("Genome list for initial tree and initial pseudocounts calculated.")
+
+
+		print("Calculating distances with sample names", flush=True)
+		#don't put samples already in the tree back to the tree again
+		distances=distancesFromRefPunishNs(data,samples=data.keys(),samplesInInitialTree=namesInTreeDict,forgetData=True)
+		if len(distances)>0:
+			print("Distances from the reference calculated. Average divergence from refererence: "+str(totDivFromRef[0]/len(distances)), flush=True)
+		namesInTreeDict=None
+
+		if rateVariation and (not inputRates):
+			useRateVariation=True
+			siteRates=[1.0]*lRef
+			mutMatrices=[]
+			for i in range(lRef):
+				mutMatrices.append([])
+				for j in range4:
+					mutMatrices[i].append(list(mutMatrixGlobal[j]))
+		if not rateVariation:
+			siteRates=None
+
+		if inputTree=="": #initialize tree to just the initial root sample
+			#extract root genome among those closest to the reference but not empty
+			firstSample=distances.pop()
+			namesInTree.append(firstSample[1])
+			tree1=Tree()
+			tree1.addNode()
+			tree1.name[-1]=0
+			t1=0
+			tree1.probVect[-1]=probVectTerminalNode(data[firstSample[1]],tree1,t1)
+			data[firstSample[1]]=None
+			numSamples=1
+		else:
+			t1=rootIndex1
+			numSamples=len(namesInTree)
+			if numSamples>minNumSamplesForErrorModel or (not largeUpdate):
+				if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
+					usingErrorRate=True
+			print(str(len(namesInTree))+" named samples in the initial tree")
+		tree=tree1
+
+		if errorRateSiteSpecificFile:
+			#check if file exists
+			if not os.path.isfile(errorRateSiteSpecificFile):
+				print("errorRateSiteSpecific file " + errorRateSiteSpecificFile + " not found, quitting MAPLE tree inference. Use option --errorRateSiteSpecificFile to specify a valid input file.")
+				raise Exception("exit")
+			fileI = openFile(errorRateSiteSpecificFile, "r")
+			line = fileI.readline()
+			fileI.close()
+			errorRates = [float(errR) for errR in line.split(", ")]
+			if len(errorRates)!=lRef:
+				print("Number of error rates in errorRateSiteSpecific file " + errorRateSiteSpecificFile + " is different from the length of the reference - exiting MAPLE.")
+				raise Exception("exit")
+			errorRateGlobal=sum(errorRates)/lRef
 			updateErrorRates(errorRateGlobal,errorRates=errorRates)
+			errorRateSiteSpecific=True
+		elif errorRateFixed:
+			errorRateGlobal=errorRateFixed
+			updateErrorRates(errorRateGlobal)
+		elif estimateErrorRate:
+			if errorRateInitial:
+				errorRateGlobal=errorRateInitial
+			else:
+				errorRateGlobal=1.0/lRef
+			updateErrorRates(errorRateGlobal)
+		elif estimateSiteSpecificErrorRate:
+			if not inputRates:
+				if errorRateInitial:
+					errorRateGlobal=errorRateInitial
+				else:
+					errorRateGlobal=1.0/lRef
+				errorRates=[errorRateGlobal]*lRef
+				updateErrorRates(errorRateGlobal,errorRates=errorRates)
+			errorRateSiteSpecific=True
+
+		# initial EM round to estimate rate variation etc on the initial tree
+		if (numSamples>1) and (model!="JC" or ((numSamples>=minNumSamplesForRateVar) and useRateVariation ) or ((numSamples>=minNumSamplesForErrorModel) and usingErrorRate)):
+			start=time()
+			mutMatrixGlobal, siteRatesEst, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
+			print("EM from initial tree terminated, using rate variation "+str(useRateVariation)+", using error rates "+str(usingErrorRate)+".  ")
+			updateMutMatrices(mutMatrixGlobal,siteRates=siteRatesEst)
+			if usingErrorRate:
+				errorRates=errorRatesEst
+				updateErrorRates(errorRateGlobal,errorRates=errorRates)
 			reCalculateAllGenomeLists(tree,t1)
-			oldLK=newLk
 			newLk=calculateTreeLikelihood(tree,t1)
-			print("New LK step "+str(numEMsteps)+": "+str(newLk))
-			numEMsteps+=1
-		if rateVariation:
-			meanRate, varianceRate = variance(siteRates)
-			print("Rate variation variance: "+str(varianceRate))
-		if errorRateSiteSpecific:
-			meanErrorRate, varianceErrorRate = variance(errorRates)
-			print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
-		print("Error rate: "+str(errorRateGlobal), flush=True)
-
-
-	# update just branch lengths
-	start=time()
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	setAllDirty(tree,t1)
-	print(" branch length optimization starting from LK "+str(newLk), flush=True)
-	improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	print("Branch length optimization round 1, number of changes: "+str(improvement))
-	subRound=0
-	while subRound<20:
-		if (not improvement):
-			break
-		subRound+=1
-		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
-	reCalculateAllGenomeLists(tree,t1)
-	newLk=calculateTreeLikelihood(tree,t1)
-	print("branch length finalization subround "+str(subRound+1)+" number of changes "+str(improvement)+" final LK: "+str(newLk))
-	timeForBranchOptimization=(time()-start)
-	print("Time for updating branch lengths: "+str(timeForBranchOptimization), flush=True)
-
-	#writing to output the substitution model (possibly with rate variation and error rates)
-	if nRound<(nRounds-1):
-		fileNameAdd="_round"+str(nRound+1)
+			print("LK after first EM: "+str(newLk))
+			if usingErrorRate and (estimateErrorRate or estimateSiteSpecificErrorRate):
+				oldLK=float("-inf")
+				numEMsteps=0
+				while (newLk-oldLK>1.0) and numEMsteps<20:
+					setAllDirty(tree,t1)
+					improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+					reCalculateAllGenomeLists(tree,t1)
+					newLkBranch=calculateTreeLikelihood(tree,t1)
+					print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch))
+					mutMatrixGlobal, siteRates, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
+					updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+					if usingErrorRate:
+						errorRates=errorRatesEst
+						updateErrorRates(errorRateGlobal,errorRates=errorRates)
+					reCalculateAllGenomeLists(tree,t1)
+					oldLK=newLk
+					newLk=calculateTreeLikelihood(tree,t1)
+					print("New LK step "+str(numEMsteps)+": "+str(newLk))
+					numEMsteps+=1
+
+			timeRecalculation=time()-start
+			print("Time to run initial tree EM estimation: "+str(timeRecalculation))
 	else:
-		fileNameAdd=""
-	fileName=outputFile+fileNameAdd+"_subs.txt"
-	file=open(fileName,"w")
-	for i in range4:
-		for j in range4:
-			file.write(str(mutMatrixGlobal[i][j])+"\t")
-		file.write("\n")
-	if rateVariation:
-		file.write("\n\n"+"Site rates:\n")
-		for i in range(lRef):
-			file.write(str(i+1)+"\t"+str(siteRates[i])+"\n")
-	if estimateSiteSpecificErrorRate:
-		file.write("\n\n"+"Site error rates:\n")
-		for i in range(lRef):
-			file.write(str(i+1)+"\t"+str(errorRates[i])+"\n")
-	elif estimateErrorRate:
-		file.write("\n\n"+"Error rate: "+str(errorRateGlobal)+"\n")
-	file.close()
-	print("Current Substitution matrix:")
-	print(mutMatrixGlobal)
-	print("All substitution rates and error probabilities written to file "+fileName)
-
-	#calculate total likelihood
-	totalLK=calculateTreeLikelihood(tree,t1)
-	print("totalLK round "+str(nRound+1)+": "+str(totalLK), flush=True)
-	fileName=outputFile+fileNameAdd+"_LK.txt"
-	file=open(fileName,"w")
-	print("totalLK written to file "+fileName)
-	file.write(str(totalLK)+"\n")
-	file.close()
-
-	if estimateErrors:
-		print("Estimating errors in input alignment round "+str(nRound+1), flush=True)
-		fileName=outputFile+fileNameAdd+"_estimatedErrors.txt"
-		file=open(fileName,"w")
-		calculateErrorProbabilities(tree,t1,file,minErrorProb,namesInTree)
-		file.close()
-		print("Errors estimated, written to file "+fileName)
+		#resume from a checkpoint: the tree with its genome lists and the model parameters are restored instead of being calculated again
+		checkpoint=readCheckpoint(resumeFrom)
+		progress=checkpoint["progress"]
+		tree=checkpoint["tree"]
+		t1=checkpoint["root"]
+		namesInTree=checkpoint["namesInTree"]
+		siteRates=checkpoint["model"].siteRates
+		if checkpoint["stage"]=="placement":
+			#the samples still to be placed are read again from the input alignment
+			if refFile=="":
+				inputRef, data=readConciseAlignment(inputFile,streaming=streamInput)
+				if inputRef!=ref:
+					print("The reference of input file "+inputFile+" is different from the one of the checkpoint, quitting MAPLE.")
+					raise Exception("exit")
+			else:
+				data=readConciseAlignment(inputFile, extractReference=False, ref=ref,streaming=streamInput)
+			distances=progress["distances"]
+			numSamples=progress["numSamples"]
+		else:
+			resumingTopology=True
+			data={}
+			distances=[]
+			numSamples=len(namesInTree)
+
+	#Place input samples to create an initial tree (or extend the input tree).
+	timeFinding=0.0
+	timePlacing=0.0
+	lastUpdateNumSamples=numSamples
+	if checkpoint!=None:
+		timeFinding=progress["timeFinding"]
+		timePlacing=progress["timePlacing"]
+		lastUpdateNumSamples=progress["lastUpdateNumSamples"]
+	if not doNotPlaceNewSamples:
+		while distances:
+			d=distances.pop()
+			sample=d[1]
+			namesInTree.append(sample)
+			newPartials=probVectTerminalNode(data[sample],None,None)
+			data[sample]=None
+			if (numSamples<minNumSamplesForRateVar or (not useRateVariation)) and ((numSamples%updateSubstMatrixEveryThisSamples)==0):
+				if model!="JC":
+					if updateSubMatrix(pseudoMutCounts,model,mutMatrixGlobal):
+						updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+			if (numSamples%50000)==0:
+				print("Sample num "+str(numSamples), flush=True)
+			if (useRateVariation and (numSamples>minNumSamplesForRateVar) and (numSamples>2*lastUpdateNumSamples)):
+				start=time()
+				lastUpdateNumSamples=numSamples
+				if numSamples>minNumSamplesForErrorModel:
+					if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
+						usingErrorRate=True
+				reCalculateAllGenomeLists(tree,t1)
+				mutMatrixGlobal, siteRates, errorRateGlobal, errorRatesEst = expectationMaximizationCalculationRates(tree,t1)
+				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+				if usingErrorRate:
+					errorRates=errorRatesEst
+					updateErrorRates(errorRateGlobal,errorRates=errorRates)
+				reCalculateAllGenomeLists(tree,t1)
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				reCalculateAllGenomeLists(tree,t1)
+				print(" EM to update parameters during initial placement terminated, time taken: "+str(time()-start))
 
-	if estimateMAT:
-		expectationMaximizationCalculationRates(tree,t1,trackMutations=True)
+			start=time()
+			bestNode , bestScore, bestBranchLengths, bestPassedVect = findBestParentForNewSample(tree,t1,newPartials,numSamples)
+			timeFinding+=(time()-start)
+			if bestBranchLengths!=None:
+				start=time()
+				newRoot=placeSampleOnTree(tree,bestNode,bestPassedVect,numSamples,bestScore, bestBranchLengths[0], bestBranchLengths[1], bestBranchLengths[2],pseudoMutCounts)
+				if newRoot!=None:
+					t1=newRoot
+				timePlacing+=(time()-start)
+				#with --debugging, check that the genome lists updated after the placement (including those in the --lowMemory cache) are correct
+				if debugging:
+					reCalculateAllGenomeLists(tree,t1, checkExistingAreCorrect=True)
+			numSamples+=1
+
+			if (numSamples%saveInitialTreeEvery)==0:
+				fileName=outputFileName(outputFile+"_initialTree_"+str(numSamples)+"samples.tree")
+				file=openFile(fileName,"w")
+				createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,file=file)
+				file.close()
+				print("Partial initial tree written to file "+fileName)
+				if saveCheckpoints:
+					writeCheckpoint(outputFile+"_checkpoint.bin","placement",tree,t1,namesInTree,siteRates,{"distances":distances,"numSamples":numSamples,"lastUpdateNumSamples":lastUpdateNumSamples,"timeFinding":timeFinding,"timePlacing":timePlacing})
+	#when resuming the topological search from a checkpoint, the tree and the model have already been finalized after the placement
+	if not resumingTopology:
+		print("Sample placement completed", flush=True)
+		print("Number of minor samples removed from the starting tree: "+str(numMinorsRemoved[0]))
+		print("Number of placed samples that have become minor sequences: "+str(numMinorsFound[0]))
 
-	newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn)
+		if HnZ:
+			#print("Re-calculating the nDesc0")
+			calculateNDesc0(tree,t1) # ,checkExisting=True
 
-	if aBayesPlus or estimateMAT:
-		fileName=outputFile+fileNameAdd+"_nexusTree.tree"
-		file=open(fileName,"w")
-		file.write("#NEXUS\nbegin taxa;\n	dimensions ntax="+str(len(namesInTree))+";\n	taxlabels\n")
-		for name in namesInTree:
-			file.write("	"+name+"\n")
-		file.write(";\nend;\n\nbegin trees;\n	tree TREE1 = [&R] ")
-		file.write(newickString)
-		file.write("\nend;\n")
-		file.close()
-		file=open(outputFile+fileNameAdd+"_metaData.tsv","w")
-		writeTSVfile(tree,t1,file,namesInTree)
-		file.close()
-		print("Nexus tree written to file "+fileName, flush=True)
-		newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=False,networkOutput=False,aBayesPlusOn=False)
+		if (numChildLKs[0]>0) and (not useFixedThresholdLogLKoptimizationTopology):
+			aveChildLK=sumChildLKs[0]/numChildLKs[0]
+			thresholdLogLKoptimizationTopology=max(thresholdLogLKoptimizationTopology,-0.2*aveChildLK)
+			print("thresholdLogLKoptimizationTopology set to "+str(thresholdLogLKoptimizationTopology))
 
-	fileName=outputFile+fileNameAdd+"_tree.tree"
-	file=open(fileName,"w")
-	file.write(newickString)
-	file.close()
-	
-	print("Tree written to file "+fileName, flush=True)
+		print("Number of references in the MAT: "+str(numRefs[0]), flush=True)
 
+		#After placing all the samples, re-estimate the substitution model and recalculate the likelihoods.
+		reCalculateAllGenomeLists(tree,t1,countNodes=True)
+		if errorRateSiteSpecificFile or errorRateFixed or estimateErrorRate or estimateSiteSpecificErrorRate:
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Tree LK before error rates EM: "+str(newLk))
+			usingErrorRate=True
+			mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+			if estimateErrorRate:
+				print("Error rate: "+str(errorRateGlobal))
+			if rateVariation:
+				meanRate, varianceRate = variance(siteRates)
+				for i in range(lRef):
+					if siteRates[i]<0.0:
+						print("negative rate "+str(siteRates[i])+" "+str(i))
+				print("Rate variation variance: "+str(varianceRate))
+			if errorRateSiteSpecific:
+				meanErrorRate, varianceErrorRate = variance(errorRates)
+				for i in range(lRef):
+					if errorRates[i]<0.0:
+						print("negative error rate "+str(errorRates[i])+" "+str(i))
+				print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
+			updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+			if usingErrorRate:
+				updateErrorRates(errorRateGlobal,errorRates=errorRates)
+			reCalculateAllGenomeLists(tree,t1)
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Tree LK after first errors EM: "+str(newLk))
+			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+			reCalculateAllGenomeLists(tree,t1)
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Tree LK after branch length optimization: "+str(newLk))
+
+
+		data.clear()
+
+		#put sample names in the tree
+		if debugging and inputTree=="":
+			nextLeaves=[t1]
+			while nextLeaves:
+				node=nextLeaves.pop()
+				if not tree.children[node]:
+					tree.name[node]="S"+str(tree.name[node])
+					print(tree.name[node])
+					print(tree.probVect[node])
+					for m in range(len(tree.minorSequences[node])):
+						tree.minorSequences[node][m]="S"+str(tree.minorSequences[node][m])
+				else:
+					for c in tree.children[node]:
+						nextLeaves.append(c)
 
-#If no rounds were run, still output estimates
-if nRounds==0:
-	#writing to output the substitution model (possibly with rate variation and error rates)
-	fileNameAdd=""
-	fileName=outputFile+fileNameAdd+"_subs.txt"
-	file=open(fileName,"w")
-	for i in range4:
-		for j in range4:
-			file.write(str(mutMatrixGlobal[i][j])+"\t")
-		file.write("\n")
-	if rateVariation:
-		file.write("\n\n"+"Site rates:\n")
-		for i in range(lRef):
-			file.write(str(i+1)+"\t"+str(siteRates[i])+"\n")
-	if estimateSiteSpecificErrorRate:
-		file.write("\n\n"+"Site error rates:\n")
-		for i in range(lRef):
-			file.write(str(i+1)+"\t"+str(errorRates[i])+"\n")
-	elif estimateErrorRate:
-		file.write("\n\n"+"Error rate: "+str(errorRateGlobal)+"\n")
-	file.close()
-	print("Substitution matrix:")
-	print(mutMatrixGlobal)
-	print("All substitution rates and error probabilities written to file "+fileName)
-
-	#calculate total likelihood
-	totalLK=calculateTreeLikelihood(tree,t1)
-	print("totalLK: "+str(totalLK))
-	fileName=outputFile+fileNameAdd+"_LK.txt"
-	file=open(fileName,"w")
-	print("totalLK written to file "+fileName)
-	file.write(str(totalLK)+"\n")
-	file.close()
 
-	if estimateErrors:
-		print("Estimating errors in input alignment")
-		fileName=outputFile+fileNameAdd+"_estimatedErrors.txt"
-		file=open(fileName,"w")
-		calculateErrorProbabilities(tree,t1,file,minErrorProb,namesInTree)
-		file.close()
-		print("Errors estimated, written to file "+fileName)
+		#recalculate all genome lists according to the final substitution model
+		if inputTree=="" or largeUpdate or rateVariation or usingErrorRate:
+			start=time()
+			reCalculateAllGenomeLists(tree,t1)
+	
+			#if using error rates, run EM iteratively until convergence in likelihood, otherwise only run one EM step
+			if model!="JC" or rateVariation or estimateErrorRate or estimateSiteSpecificErrorRate:
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK before EM: "+str(newLk))
+				mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+				if usingErrorRate:
+					updateErrorRates(errorRateGlobal,errorRates=errorRates)
+				reCalculateAllGenomeLists(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK after EM: "+str(newLk))
+				setAllDirty(tree,t1)
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				reCalculateAllGenomeLists(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK after branch length optimization: "+str(newLk))
+				if estimateErrorRate or estimateSiteSpecificErrorRate:
+					oldLK=float("-inf")
+					#newLk=calculateTreeLikelihood(tree,t1)
+					#print("EM estimation of error rates. Initial LK after first pass: "+str(newLk))
+					numEMsteps=0
+					while (newLk-oldLK>1.0) and numEMsteps<20:
+						setAllDirty(tree,t1)
+						improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+						reCalculateAllGenomeLists(tree,t1)
+						newLkBranch=calculateTreeLikelihood(tree,t1)
+						print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch))
+
+						mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+						updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+						updateErrorRates(errorRateGlobal,errorRates=errorRates)
+						reCalculateAllGenomeLists(tree,t1)
+						oldLK=newLk
+						newLk=calculateTreeLikelihood(tree,t1)
+						print("New LK step "+str(numEMsteps)+": "+str(newLk))
+						numEMsteps+=1
+					if rateVariation:
+						meanRate, varianceRate = variance(siteRates)
+						print("Rate variation variance: "+str(varianceRate))
+					if errorRateSiteSpecific:
+						meanErrorRate, varianceErrorRate = variance(errorRates)
+						print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
+					print("Error rate: "+str(errorRateGlobal))
+
+			timeRecalculation=time()-start
+			print("Time to run EM pre-topology estimation: "+str(timeRecalculation))
+
+			print("Number of nodes: "+str(numNodes[0]))
+			print("Rs per node: "+str(float(numNodes[2])/numNodes[0]))
+			print("Os per node: "+str(float(numNodes[4])/numNodes[0]))
+			print("Nucs per node: "+str(float(numNodes[1])/numNodes[0]))
+			print("Ns per node: "+str(float(numNodes[3])/numNodes[0]))
+			print("MAT mutations per node: "+str(float(numNodes[5])/numNodes[0]))
 
+			start=time()
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Now proper branch length optimization, LK before: "+str(newLk))
+			setAllDirty(tree,t1)
+			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+			subRound=0
+			while subRound<20:
+				if (not improvement):
+					break
+				subRound+=1
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("branch length finalization subround "+str(subRound+1)+", number of changes "+str(improvement)+" final LK: "+str(newLk))
+			timeForBranchOptimization=(time()-start)
+			print("Time for updating branch lengths: "+str(timeForBranchOptimization))
 
-	if estimateMAT:
-		expectationMaximizationCalculationRates(tree,t1,trackMutations=True)
+		#TODO
+		if HnZ:
+			#print("Re-calculating the nDesc0")
+			calculateNDesc0(tree,t1,checkExisting=True)
 
-	newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree)
+		#find best tree root
+		if not doNotReroot:
+			print("Looking for possible better root", flush=True)
+			newT1=findBestRoot(tree,t1,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,aBayesPlusOn=aBayesPlus)
+			if newT1!=t1:
+				print("Better root found")
+				t1=newT1
 
-	if aBayesPlus or estimateMAT:
-		fileName=outputFile+fileNameAdd+"_nexusTree.tree"
-		file=open(fileName,"w")
-		file.write("#NEXUS\nbegin taxa;\n	dimensions ntax="+str(len(namesInTree))+";\n	taxlabels\n")
-		for name in namesInTree:
-			file.write("	"+name+"\n")
-		file.write(";\nend;\n\nbegin trees;\n	tree TREE1 = [&R] ")
-		file.write(newickString)
-		file.write("\nend;\n")
-		file.close()
-		file=open(outputFile+fileNameAdd+"_metaData.tsv","w")
-		writeTSVfile(tree,t1,file,namesInTree)
-		file.close()
-		print("Nexus tree written to file "+fileName)
-		aBayesPlusOn=False
-		networkOutput=False
-		estimateMAT=False
-		newickString=createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree)
-
-	fileName=outputFile+fileNameAdd+"_tree.tree"
-	file=open(fileName,"w")
-	file.write(newickString)
-	file.close()
-	print("Tree written to file "+fileName)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK before EM: "+str(newLk))
+				mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+				if estimateErrorRate:
+					print("Error rate: "+str(errorRateGlobal))
+				if rateVariation:
+					meanRate, varianceRate = variance(siteRates)
+					for i in range(lRef):
+						if siteRates[i]<0.0:
+							print("negative rate "+str(siteRates[i])+" "+str(i))
+					print("Rate variation variance: "+str(varianceRate))
+				if errorRateSiteSpecific:
+					meanErrorRate, varianceErrorRate = variance(errorRates)
+					for i in range(lRef):
+						if errorRates[i]<0.0:
+							print("negative error rate "+str(errorRates[i])+" "+str(i))
+					print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
+				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+				if usingErrorRate:
+					updateErrorRates(errorRateGlobal,errorRates=errorRates)
+				reCalculateAllGenomeLists(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK after first errors EM: "+str(newLk))
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				reCalculateAllGenomeLists(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Tree LK after branch length optimization: "+str(newLk))
+
+				print("Looking a second time for possible better root", flush=True)
+				newT1=findBestRoot(tree,t1,strictTopologyStopRules=strictTopologyStopRules,allowedFailsTopology=allowedFailsTopology,thresholdLogLKtopology=thresholdLogLKtopology,aBayesPlusOn=aBayesPlus)
+				if newT1!=t1:
+					print("Better root found again")
+					t1=newT1
+
+
+
+		if (writeTreesToFileEveryTheseSteps>0):
+			currentRoot=t1
+			intermediateTreesFile.write("Topology 0\n")
+			createNewick(tree,currentRoot,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,file=intermediateTreesFile)
+			intermediateTreesFile.write("\n")
+		if (writeLKsToFileEveryTheseSteps>0):
+			currentRoot=t1
+			totalLK=calculateTreeLikelihood(tree,currentRoot)
+			intermediateLKsFile.write("Topology 0, LK: "+str(totalLK)+"\n")
+
+
+		print(str(len(namesInTree))+" named samples in the tree", flush=True)
+		internalNodeNamesGiven=False
+		giveInternalNodeNames(tree,t1,namesInTree=namesInTree,replaceNames=False)
+		internalNodeNamesGiven=True
+		print(str(len(namesInTree))+" named nodes in the tree after assigning internal node names", flush=True)
+
+
+	#run topology search
+	timeTopology=0.0
+	if resumingTopology:
+		timeTopology=progress["timeTopology"]
+	threshValues=[]
+	threshNums=[]
+	threshStricts=[]
+	threshPlaces=[]
+	if fastTopologyInitialSearch:
+		threshValues.append(thresholdLogLKtopologyInitial)
+		threshNums.append(allowedFailsTopologyInitial)
+		threshStricts.append(strictTopologyStopRulesInitial)
+		threshPlaces.append(thresholdTopologyPlacementInitial)
+	if (inputTree=="" or largeUpdate or aBayesPlus):
+		for i in range(numTopologyImprovements):
+			threshValues.append(thresholdLogLKtopology)
+			threshNums.append(allowedFailsTopology)
+			threshStricts.append(strictTopologyStopRules)
+			threshPlaces.append(thresholdTopologyPlacement)
+	nRounds=len(threshNums)
+
+
+	if aBayesPlus and (not resumingTopology):
+		tree.support=[None]*len(tree.up)
+		if networkOutput:
+			tree.alternativePlacements=[]
+			for i in range(len(tree.up)):
+				tree.alternativePlacements.append([])
+
+
+	#Run rounds of SPR topological improvements
+	firstRound=0
+	if resumingTopology:
+		firstRound=progress["nRound"]
+	for nRound in range(firstRound,nRounds):
+		if aBayesPlus:
+			aBayesPlusOn=True
+		#when resuming from a checkpoint taken during the subrounds, the first part of the round is skipped;
+		# when resuming from a checkpoint taken during a traversal of the tree, that traversal is continued.
+		resumingSubRounds=(resumingTopology and nRound==firstRound and progress["subRound"]!=None)
+		resumingTraversal=(resumingTopology and nRound==firstRound and progress["inTraversal"])
+		roundProgress={"nRound":nRound,"subRound":None,"inTraversal":False,"improvement":0.0,"remainingMoves":None,"nodesToVisit":None,"timeTopology":timeTopology,"timeFinding":timeFinding,"timePlacing":timePlacing,"lastUpdateNumSamples":lastUpdateNumSamples}
+		if saveCheckpoints and (not (resumingTopology and nRound==firstRound)):
+			writeCheckpoint(outputFile+"_checkpoint.bin","topology",tree,t1,namesInTree,siteRates,roundProgress)
+		if not resumingSubRounds:
+			if not resumingTraversal:
+				print("Starting topological impromevement traversal number "+str(nRound+1), flush=True)
+				start=time()
+				setAllDirty(tree,t1)
+	
+				reCalculateAllGenomeLists(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("Preliminary branch length optimization from LK: "+str(newLk))
+				#TODO
+				if HnZ:
+					#print("Re-calculating the nDesc0")
+					calculateNDesc0(tree,t1,checkExisting=True)
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				print("Branch length optimization, number of changes: "+str(improvement))
+				subRound=0
+				while subRound<20:
+					if (not improvement):
+						break
+					subRound+=1
+					improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("branch length finalization subround "+str(subRound+1)+" number of changes "+str(improvement)+" final LK: "+str(newLk), flush=True)
+				timeForBranchOptimization=(time()-start)
+				print("Time for updating branch lengths: "+str(timeForBranchOptimization))
 
+				#TODO
+				if HnZ:
+					#print("Re-calculating the nDesc0")
+					calculateNDesc0(tree,t1,checkExisting=True)
 
+				#now update the topology
+				start=time()
+				setAllDirty(tree,t1)
+				print("Starting tolopogical improvement round "+str(nRound+1)+" with allowed fails "+str(threshNums[nRound])+" and LK threshold "+str(threshValues[nRound]), flush=True)
+				reCalculateAllGenomeLists(tree,t1)
+				preLK=calculateTreeLikelihood(tree,t1)
+				print("Likelihood before SPR moves: "+str(preLK), flush=True)
+
+			traversalCheckpoint[0]=(siteRates,roundProgress)
+			if resumingTraversal:
+				start=time()
+				newRoot,improvement=resumeTopologyUpdates(tree,t1,progress,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			elif parallelize:
+			#if parallelRounds[nRound]:
+				#assign numbers to nodes so that each core will only investigate re-placement of its own nodes
+				if nRound==0:
+					assignCoreNumbers(tree,t1,numCores)
+				paralleleInputs=[]
+				for i in range(numCores):
+					paralleleInputs.append((tree,t1,i,threshStricts[nRound],threshNums[nRound],threshValues[nRound],threshPlaces[nRound]))
+				with Pool() as pool:
+					results = pool.map(startTopologyUpdatesParallel, paralleleInputs)
+				for i in range(numCores-1):
+					results[0].extend(results[i+1])
+				results[0].sort(reverse=False,key=itemgetter(2))
+				totalTimeFindingParent[0]+=time()-start
+				print("Found proposed SPR moves, merged, and sorted.")
+				setAllDirty(tree,t1,dirtiness=False)
+				newRoot, improvement = applySPRMovesParallel(tree,results[0],strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			else:
+				newRoot,improvement=startTopologyUpdates(tree,t1,checkEachSPR=debugging,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			if newRoot!=None:
+				t1=newRoot
+			timeForUpdatingTopology=(time()-start)
+			print("Time for round "+str(nRound+1)+" traversal of the tree for topology changes: "+str(timeForUpdatingTopology), flush=True)
+			timeTopology+=timeForUpdatingTopology
+			print("LK improvement apparently brought: "+str(improvement))
+			reCalculateAllGenomeLists(tree,t1)
+			postLK=calculateTreeLikelihood(tree,t1)
+			print("Likelihood after SPR moves: "+str(postLK))
+	
+			fileName=outputFileName(outputFile+"_round"+str(nRound+1)+"_preliminary_tree.tree")
+			print("Writing preliminary tree to file: "+fileName, flush=True)
+			file=openFile(fileName,"w")
+			createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=False,networkOutput=False,aBayesPlusOn=False,file=file)
+			file.close()
+	
 
-print("Number of final references in the MAT: "+str(numRefs[0]), flush=True)
-print("Time spent finding placement nodes: "+str(timeFinding))
-print("Time spent placing samples on the tree: "+str(timePlacing))
-print("Time spent in total updating the topology and branch lengths: "+str(timeTopology))
-print("Of which looking for placements for better topologies: "+str(totalTimeFindingParent[0]))
 
-exit()
+		#run improvements only on the nodes that have been affected by some changes in the last round, and so on
+		start=time()
+		subRound=0
+		if resumingSubRounds:
+			subRound=progress["subRound"]
+		while subRound<20:
+			subRoundProgress=dict(roundProgress,subRound=subRound,timeTopology=timeTopology)
+			if saveCheckpoints and (not (resumingSubRounds and subRound==progress["subRound"])):
+				writeCheckpoint(outputFile+"_checkpoint.bin","topology",tree,t1,namesInTree,siteRates,subRoundProgress)
+			print("Topological subround "+str(subRound+1), flush=True)
+			numDirty,numTotNodes=countDirtyNodes(tree,t1)
+			#if HnZ:
+				#print("Re-calculating the nDesc0")
+				#calculateNDesc0(tree,t1,checkExisting=True)
+			traversalCheckpoint[0]=(siteRates,subRoundProgress)
+			if resumingTraversal and resumingSubRounds and subRound==progress["subRound"]:
+				newRoot,improvement=resumeTopologyUpdates(tree,t1,progress,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			elif parallelize and (numDirty>0.1*numTotNodes):
+				paralleleInputs=[]
+				for i in range(numCores):
+					paralleleInputs.append((tree,t1,i,threshStricts[nRound],threshNums[nRound],threshValues[nRound],threshPlaces[nRound]))
+				with Pool() as pool:
+					results = pool.map(startTopologyUpdatesParallel, paralleleInputs)
+				for i in range(numCores-1):
+					results[0].extend(results[i+1])
+				results[0].sort(reverse=False,key=itemgetter(2))
+				totalTimeFindingParent[0]+=time()-start
+				print("Found proposed SPR moves, merged, and sorted.")
+				setAllDirty(tree,t1,dirtiness=False)
+				newRoot, improvement = applySPRMovesParallel(tree,results[0],strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			else:
+				newRoot,improvement=startTopologyUpdates(tree,t1,checkEachSPR=debugging,strictTopologyStopRules=threshStricts[nRound],allowedFailsTopology=threshNums[nRound],thresholdLogLKtopology=threshValues[nRound],thresholdTopologyPlacement=threshPlaces[nRound])
+			if newRoot!=None:
+				t1=newRoot
+			print("LK improvement apparently brought: "+str(improvement), flush=True)
+			if not noSubroundTrees:
+				fileName=outputFileName(outputFile+"_round"+str(nRound+1)+"_subround"+str(subRound+1)+"_preliminary_tree.tree")
+				print("Writing preliminary tree to file: "+fileName, flush=True)
+				file=openFile(fileName,"w")
+				createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=False,networkOutput=False,aBayesPlusOn=False,file=file)
+				file.close()
+			if improvement<thresholdLogLKTopologySubRoundImprovement:
+				break
+			subRound+=1
+		timeForUpdatingTopology=(time()-start)
+		reCalculateAllGenomeLists(tree,t1)
+		postLK=calculateTreeLikelihood(tree,t1)
+		print("Likelihood after SPR subrounds: "+str(postLK), flush=True)
+		print("Time for the subrounds of this traversal of the tree: "+str(timeForUpdatingTopology), flush=True)
+		timeTopology+=timeForUpdatingTopology
 
+		#if estimating error rates, repeating EM after shallow topological search
+		if estimateErrorRate or estimateSiteSpecificErrorRate:
+			oldLK=float("-inf")
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Initial LK before error rates EM: "+str(newLk), flush=True)
+			mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+			updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+			updateErrorRates(errorRateGlobal,errorRates=errorRates)
+			reCalculateAllGenomeLists(tree,t1)
+			newLk=calculateTreeLikelihood(tree,t1)
+			print("Initial LK after first error rates EM: "+str(newLk))
+			numEMsteps=0
+			while (newLk-oldLK>1.0) and numEMsteps<20:
+				setAllDirty(tree,t1)
+				improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+				reCalculateAllGenomeLists(tree,t1)
+				newLkBranch=calculateTreeLikelihood(tree,t1)
+				print("Updated "+str(improvement)+" branch lengths leading to LK "+str(newLkBranch), flush=True)
 
+				mutMatrixGlobal, siteRates, errorRateGlobal, errorRates = expectationMaximizationCalculationRates(tree,t1)
+				updateMutMatrices(mutMatrixGlobal,siteRates=siteRates)
+				updateErrorRates(errorRateGlobal,errorRates=errorRates)
+				reCalculateAllGenomeLists(tree,t1)
+				oldLK=newLk
+				newLk=calculateTreeLikelihood(tree,t1)
+				print("New LK step "+str(numEMsteps)+": "+str(newLk))
+				numEMsteps+=1
+			if rateVariation:
+				meanRate, varianceRate = variance(siteRates)
+				print("Rate variation variance: "+str(varianceRate))
+			if errorRateSiteSpecific:
+				meanErrorRate, varianceErrorRate = variance(errorRates)
+				print("Error rate variation, mean: "+str(meanErrorRate)+" , variance: "+str(varianceErrorRate))
+			print("Error rate: "+str(errorRateGlobal), flush=True)
 
 
+		# update just branch lengths
+		start=time()
+		reCalculateAllGenomeLists(tree,t1)
+		newLk=calculateTreeLikelihood(tree,t1)
+		setAllDirty(tree,t1)
+		print(" branch length optimization starting from LK "+str(newLk), flush=True)
+		improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+		print("Branch length optimization round 1, number of changes: "+str(improvement))
+		subRound=0
+		while subRound<20:
+			if (not improvement):
+				break
+			subRound+=1
+			improvement=traverseTreeToOptimizeBranchLengths(tree,t1)
+		reCalculateAllGenomeLists(tree,t1)
+		newLk=calculateTreeLikelihood(tree,t1)
+		print("branch length finalization subround "+str(subRound+1)+" number of changes "+str(improvement)+" final LK: "+str(newLk))
+		timeForBranchOptimization=(time()-start)
+		print("Time for updating branch lengths: "+str(timeForBranchOptimization), flush=True)
 
+		#writing to output the substitution model (possibly with rate variation and error rates)
+		if nRound<(nRounds-1):
+			fileNameAdd="_round"+str(nRound+1)
+		else:
+			fileNameAdd=""
+		fileName=outputFile+fileNameAdd+"_subs.txt"
+		file=open(fileName,"w")
+		for i in range4:
+			for j in range4:
+				file.write(str(mutMatrixGlobal[i][j])+"\t")
+			file.write("\n")
+		if rateVariation:
+			file.write("\n\n"+"Site rates:\n")
+			for i in range(lRef):
+				file.write(str(i+1)+"\t"+str(siteRates[i])+"\n")
+		if estimateSiteSpecificErrorRate:
+			file.write("\n\n"+"Site error rates:\n")
+			for i in range(lRef):
+				file.write(str(i+1)+"\t"+str(errorRates[i])+"\n")
+		elif estimateErrorRate:
+			file.write("\n\n"+"Error rate: "+str(errorRateGlobal)+"\n")
+		file.close()
+		print("Current Substitution matrix:")
+		print(mutMatrixGlobal)
+		print("All substitution rates and error probabilities written to file "+fileName)
+
+		#calculate total likelihood
+		totalLK=calculateTreeLikelihood(tree,t1)
+		print("totalLK round "+str(nRound+1)+": "+str(totalLK), flush=True)
+		fileName=outputFile+fileNameAdd+"_LK.txt"
+		file=open(fileName,"w")
+		print("totalLK written to file "+fileName)
+		file.write(str(totalLK)+"\n")
+		file.close()
 
+		if estimateErrors:
+			print("Estimating errors in input alignment round "+str(nRound+1), flush=True)
+			fileName=outputFileName(outputFile+fileNameAdd+"_estimatedErrors.txt")
+			file=openFile(fileName,"w")
+			calculateErrorProbabilities(tree,t1,file,minErrorProb,namesInTree)
+			file.close()
+			print("Errors estimated, written to file "+fileName)
+
+		if estimateMAT:
+			expectationMaximizationCalculationRates(tree,t1,trackMutations=True)
+
+		treeName=outputFileName(outputFile+fileNameAdd+"_tree.tree")
+		treeFile=BackgroundFileWriter(openFile(treeName,"w"))
+		if aBayesPlus or estimateMAT:
+			#the nexus tree and the plain newick tree are written within the same tree traversal
+			fileName=outputFileName(outputFile+fileNameAdd+"_nexusTree.tree")
+			file=BackgroundFileWriter(openFile(fileName,"w"))
+			file.write("#NEXUS\nbegin taxa;\n	dimensions ntax="+str(len(namesInTree))+";\n	taxlabels\n")
+			file.write("".join(["	"+name+"\n" for name in namesInTree]))
+			file.write(";\nend;\n\nbegin trees;\n	tree TREE1 = [&R] ")
+			createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,file=file,plainFile=treeFile)
+			file.write("\nend;\n")
+			file.close()
+			file=BackgroundFileWriter(openFile(outputFileName(outputFile+fileNameAdd+"_metaData.tsv"),"w"))
+			writeTSVfile(tree,t1,file,namesInTree)
+			file.close()
+			print("Nexus tree written to file "+fileName, flush=True)
+		else:
+			createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,aBayesPlusOn=aBayesPlusOn,file=treeFile)
+		treeFile.close()
+		if writeMAT:
+			writeMATfile(outputFileName(outputFile+fileNameAdd+"_tree.mat"),tree,t1,namesInTree)
+	
+		print("Tree written to file "+treeName, flush=True)
 
 
+	#If no rounds were run, still output estimates
+	if nRounds==0:
+		#writing to output the substitution model (possibly with rate variation and error rates)
+		fileNameAdd=""
+		fileName=outputFile+fileNameAdd+"_subs.txt"
+		file=open(fileName,"w")
+		for i in range4:
+			for j in range4:
+				file.write(str(mutMatrixGlobal[i][j])+"\t")
+			file.write("\n")
+		if rateVariation:
+			file.write("\n\n"+"Site rates:\n")
+			for i in range(lRef):
+				file.write(str(i+1)+"\t"+str(siteRates[i])+"\n")
+		if estimateSiteSpecificErrorRate:
+			file.write("\n\n"+"Site error rates:\n")
+			for i in range(lRef):
+				file.write(str(i+1)+"\t"+str(errorRates[i])+"\n")
+		elif estimateErrorRate:
+			file.write("\n\n"+"Error rate: "+str(errorRateGlobal)+"\n")
+		file.close()
+		print("Substitution matrix:")
+		print(mutMatrixGlobal)
+		print("All substitution rates and error probabilities written to file "+fileName)
+
+		#calculate total likelihood
+		totalLK=calculateTreeLikelihood(tree,t1)
+		print("totalLK: "+str(totalLK))
+		fileName=outputFile+fileNameAdd+"_LK.txt"
+		file=open(fileName,"w")
+		print("totalLK written to file "+fileName)
+		file.write(str(totalLK)+"\n")
+		file.close()
 
+		if estimateErrors:
+			print("Estimating errors in input alignment")
+			fileName=outputFileName(outputFile+fileNameAdd+"_estimatedErrors.txt")
+			file=openFile(fileName,"w")
+			calculateErrorProbabilities(tree,t1,file,minErrorProb,namesInTree)
+			file.close()
+			print("Errors estimated, written to file "+fileName)
+
+
+		if estimateMAT:
+			expectationMaximizationCalculationRates(tree,t1,trackMutations=True)
+
+		treeName=outputFileName(outputFile+fileNameAdd+"_tree.tree")
+		treeFile=BackgroundFileWriter(openFile(treeName,"w"))
+		if aBayesPlus or estimateMAT:
+			#the nexus tree and the plain newick tree are written within the same tree traversal
+			fileName=outputFileName(outputFile+fileNameAdd+"_nexusTree.tree")
+			file=BackgroundFileWriter(openFile(fileName,"w"))
+			file.write("#NEXUS\nbegin taxa;\n	dimensions ntax="+str(len(namesInTree))+";\n	taxlabels\n")
+			file.write("".join(["	"+name+"\n" for name in namesInTree]))
+			file.write(";\nend;\n\nbegin trees;\n	tree TREE1 = [&R] ")
+			createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,file=file,plainFile=treeFile)
+			file.write("\nend;\n")
+			file.close()
+			file=BackgroundFileWriter(openFile(outputFileName(outputFile+fileNameAdd+"_metaData.tsv"),"w"))
+			writeTSVfile(tree,t1,file,namesInTree)
+			file.close()
+			print("Nexus tree written to file "+fileName)
+		else:
+			createNewick(tree,t1,binary=binaryTree,namesInTree=namesInTree,estimateMAT=estimateMAT,networkOutput=networkOutput,file=treeFile)
+		treeFile.close()
+		if writeMAT:
+			writeMATfile(outputFileName(outputFile+fileNameAdd+"_tree.mat"),tree,t1,namesInTree)
+		print("Tree written to file "+treeName)
 
 
 
+	print("Number of final references in the MAT: "+str(numRefs[0]), flush=True)
+	print("Time spent finding placement nodes: "+str(timeFinding))
+	print("Time spent placing samples on the tree: "+str(timePlacing))
+	print("Time spent in total updating the topology and branch lengths: "+str(timeTopology))
+	print("Of which looking for placements for better topologies: "+str(totalTimeFindingParent[0]))
+	if lowMemory:
+		print("Upward genome lists cache hits: "+str(tree.upwardCache.hits)+" misses: "+str(tree.upwardCache.misses))
 
 
+if __name__ == "__main__":
+	main()
@@ -4,8 +4,23 @@ from os import path
 import argparse
 import time
 
+import numpy as np
+
+# Compressed files (.gz and .zst) are opened with the same function as in MAPLE
+from maple.io import openFile as open_file, isCompressedFile as is_compressed
+
 # Translate a fasta alignment into a MAPLE format file.
 
+N_CODE = ord('n')
+GAP_CODE = ord('-')
+# Characters counted when building a consensus sequence (ties are resolved in this order),
+# and the column of each character code in the count matrix (-1 for characters that are not counted)
+CONSENSUS_CHARACTERS = 'acgt-n'
+CONSENSUS_COLUMNS = np.full(256, -1, dtype=np.int64)
+for column, character in enumerate(CONSENSUS_CHARACTERS):
+    CONSENSUS_COLUMNS[ord(character)] = column
+
+
 class Sequence:
     '''A sequence parsed from a FASTA file.
 
@@ -20,159 +35,270 @@ class Sequence:
         self.sequence = sequence
 
 
-def parse_fasta(file_path: str) -> list:
-    '''Parse a fasta file and return a list of Sequence objects. '''
-    sequences = []
+def iter_fasta(file_path: str, start: int = 0, end: int = None):
+    '''Parse a fasta file one record at a time, yielding lower-case Sequence objects.
+
+    If start and end are given, only the records starting within this byte range of the file are parsed
+    (start needs to be the beginning of a record, see fasta_chunks); this requires an uncompressed file.
+    '''
     current_label = None
-    current_sequence = ""
-    with open(file_path, 'r') as file:
+    current_lines = []
+    position = start
+    with open_file(file_path, 'rb') as file:
+        if start > 0:
+            file.seek(start)
         for line in file:
-            line = line.strip()
             # Check if the line is a label
-            if line.startswith('>'):
+            if line.startswith(b'>'):
+                if end is not None and position >= end:
+                    break
                 # Flush previous label
                 if current_label is not None:
-                    sequences.append(Sequence(current_label, current_sequence))
+                    yield Sequence(current_label, "".join(current_lines).lower())
 
                 # Start a new label and reset sequence
-                current_label = line[1:]  # Remove the '>'
-                current_sequence = ""
+                current_label = line.decode().strip()[1:]  # Remove the '>'
+                current_lines = []
             else:
-                # Append the sequence lines
-                current_sequence += line
+                # Collect the sequence lines, joined once the record is complete
+                current_lines.append(line.decode('ascii').strip())
+            position += len(line)
 
         # Save the last label and sequence
         if current_label is not None:
-            sequences.append(Sequence(current_label, current_sequence.lower()))
-        
-        return sequences
+            yield Sequence(current_label, "".join(current_lines).lower())
+
+
+def fasta_chunks(file_path: str, n_chunks: int) -> list:
+    '''Split a fasta file into about n_chunks byte ranges (start, end), each starting at the beginning of a record. '''
+    size = path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, 'rb') as file:
+        for k in range(1, n_chunks):
+            # Move to the first record starting after the approximate chunk boundary
+            file.seek(max(size * k // n_chunks, boundaries[-1]))
+            position = file.tell()
+            if position > 0:
+                file.seek(position - 1)
+                position += len(file.readline()) - 1
+            line = file.readline()
+            while line and not line.startswith(b'>'):
+                position += len(line)
+                line = file.readline()
+            if position > boundaries[-1] and position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return [(boundaries[k], boundaries[k + 1]) for k in range(len(boundaries) - 1)]
+
+
+def parse_fasta(file_path: str) -> list:
+    '''Parse a fasta file and return a list of Sequence objects. '''
+    return list(iter_fasta(file_path))
+
 
-def generate_consensus(sequences: list) -> str:
-    '''Generate a consensus sequence from a list of sequences. '''
-    # Get the length of the sequences
-    seq_length = len(sequences[0].sequence)
+def generate_consensus(sequences) -> str:
+    '''Generate a consensus sequence from an iterable of sequences (for example iter_fasta), reading them one at a time.
 
+    The number of a, c, g, t, - and n at each position is accumulated in a (length x 6) count matrix,
+    and the consensus takes the most common of them at each position.
+    '''
+    counts = None
     for s in sequences:
-        if len(s.sequence) != seq_length:
+        seq = as_array(s.sequence)
+        if counts is None:
+            # Get the length of the sequences
+            seq_length = len(seq)
+            counts = np.zeros((seq_length, len(CONSENSUS_CHARACTERS)), dtype=np.int64)
+            positions = np.arange(seq_length)
+        elif len(seq) != seq_length:
             raise ValueError("All sequences must be the same length.")
-    
-    consensus = ""
-    for i in range(seq_length):
-        # Get the nucleotides at position i
-        nucleotides = [s.sequence[i] for s in sequences]
-        # Count the number of each nucleotide
-        counts = {n: nucleotides.count(n) for n in 'acgt-n'}
-        # Get the most common nucleotide
-        consensus += max(counts, key=counts.get)
-    
+        # Count the nucleotides of this sequence, ignoring other characters
+        columns = CONSENSUS_COLUMNS[seq]
+        counted = columns >= 0
+        counts[positions[counted], columns[counted]] += 1
+    if counts is None:
+        raise ValueError("No sequences to build a consensus from.")
+
+    consensus = np.frombuffer(CONSENSUS_CHARACTERS.encode('ascii'), dtype=np.uint8)[counts.argmax(axis=1)].tobytes().decode('ascii')
     print(f"Consensus sequence: {consensus}")
     return consensus
 
+
+def as_array(sequence: str) -> np.ndarray:
+    '''View a (lower-case, ASCII) sequence as a uint8 array. '''
+    return np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+
+
+def find_runs(mask: np.ndarray):
+    '''Return the 0-based start positions and the lengths of the runs of True values in a boolean mask. '''
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return starts, ends - starts
+
+
+def maple_entries(sequence: str, reference: np.ndarray) -> list:
+    '''Return the MAPLE format lines describing how an aligned sequence differs from the reference (as a uint8 array).
+
+    Runs of n and of - are written as a single entry with their start and length,
+    other characters different from the reference as an entry with their position.
+    '''
+    seq = as_array(sequence)
+    n_mask = seq == N_CODE
+    gap_mask = seq == GAP_CODE
+    mutation_positions = np.flatnonzero((seq != reference) & ~n_mask & ~gap_mask)
+    n_starts, n_lengths = find_runs(n_mask)
+    gap_starts, gap_lengths = find_runs(gap_mask)
+
+    positions = np.concatenate((mutation_positions, n_starts, gap_starts))
+    lines = [f"{sequence[i]}\t{i + 1}\n" for i in mutation_positions.tolist()]
+    lines += [f"n\t{i + 1}\t{l}\n" for i, l in zip(n_starts.tolist(), n_lengths.tolist())]
+    lines += [f"-\t{i + 1}\t{l}\n" for i, l in zip(gap_starts.tolist(), gap_lengths.tolist())]
+    return [lines[i] for i in np.argsort(positions, kind='stable').tolist()]
+
+
+def read_maple_index(file_path: str) -> tuple:
+    '''Read the reference and the set of sample names of an existing MAPLE file, parsing only its header lines. '''
+    reference_lines = []
+    names = set()
+    with open_file(file_path, 'rb') as file:
+        # The reference is the first record of the file
+        file.readline()
+        for line in file:
+            if line.startswith(b'>'):
+                names.add(line.decode().strip()[1:])
+                break
+            reference_lines.append(line.decode('ascii').strip())
+        for line in file:
+            if line.startswith(b'>'):
+                names.add(line.decode().strip()[1:])
+    return "".join(reference_lines).lower(), names
+
+
+def convert_chunk(chunk: tuple) -> tuple:
+    '''Convert the records in a byte range of the input fasta (as given by fasta_chunks) into MAPLE format text.
+
+    Used in the process pool of the --threads mode, where the input file name, the reference and the names to skip
+    are set by init_worker. Returns the text and the name of a sequence with wrong length, if any.
+    '''
+    lines = []
+    for s in iter_fasta(worker_input, chunk[0], chunk[1]):
+        if s.name in worker_skip_names:
+            continue
+        if len(worker_reference) != len(s.sequence):
+            return "", s.name
+        lines.append(f">{s.name}\n")
+        lines.extend(maple_entries(s.sequence, worker_reference))
+    return "".join(lines), None
+
+
+def init_worker(input_path: str, reference: np.ndarray, skip_names: set):
+    global worker_input, worker_reference, worker_skip_names
+    worker_input = input_path
+    worker_reference = reference
+    worker_skip_names = skip_names
+
+
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Translate a fasta alignment into a MAPLE format file.')
     parser.add_argument('--input', type=str, help='The input fasta file.')
     parser.add_argument('--reference', type=str, help='The reference fasta file.')
     parser.add_argument("--output", type=str, help="The output MAPLE file.")
+    parser.add_argument("--threads", type=int, default=1, help="Number of processes used to convert the sequences.")
+    parser.add_argument("--append", action="store_true", help="Append the input sequences to the existing MAPLE file given with --output, skipping those whose name is already in it. The reference of the existing file is used.")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Approximate size (in MB) of the chunks of the input fasta processed at once by each process with --threads.")
     args = parser.parse_args()
 
-    import time
+    if args.threads < 1:
+        print(f"ERROR: --threads must be at least 1 (got {args.threads}).")
+        sys.exit(1)
+    if args.chunk_size < 1:
+        print(f"ERROR: --chunk_size must be at least 1 MB (got {args.chunk_size}).")
+        sys.exit(1)
+
     start_time = time.time()
 
     if not path.exists(args.input):
         print(f"ERROR: Input file {args.input} not found.")
         sys.exit(1)
-    
+
     if args.reference:
         if not path.exists(args.reference):
             print(f"ERROR: Reference file {args.reference} not found.")
             sys.exit(1)
-    else:
+    elif not args.append:
         print("No reference file provided. Consensus sequence will be used as reference.")
-    
-    reference = None
-    sequences = parse_fasta(args.input)
-    if args.reference:
-        reference = parse_fasta(args.reference)[0].sequence
-    else:
-        reference = generate_consensus(sequences)
-    # Check if the reference sequence length matches the input sequences
-    for s in sequences:
-        if len(reference) != len(s.sequence):
-            print(f"ERROR: Reference sequence length does not match the input sequence {s.name}.")
+
+    skip_names = set()
+    if args.append:
+        if not path.exists(args.output):
+            print(f"ERROR: MAPLE file {args.output} to append to not found.")
             sys.exit(1)
-    # Write the output MAPLE file
-    with open(args.output, 'w') as file:
-        file.write(f">reference\n{reference.lower()}\n")
-
-        for s in sequences:
-            file.write(f">{s.name}\n")
-            diff = ""
-            for i in range(len(s.sequence)):
-                if s.sequence[i] == 'n' or s.sequence[i] == '-':
-                    diff += s.sequence[i]
-                elif s.sequence[i] != reference[i]:
-                    diff += s.sequence[i]
-                else:
-                    diff += "0"
-            
-            
-            last_n_or_gap = None
-            last_index = -1
-            for i in range(len(diff)):
-                if diff[i] == 'n':
-                    if last_n_or_gap != 'n':
-                        # Flush the last gap
-                        if last_n_or_gap == '-':
-                            file.write(f"-\t{last_index}\t{i - last_index + 1}\n")
-                        last_n_or_gap = 'n'
-                        last_index = i + 1
-                    else:
-                        continue
-                elif diff[i] == '-':
-                    if last_n_or_gap != '-':
-                        # Flush the last n
-                        if last_n_or_gap == 'n':
-                            file.write(f"n\t{last_index}\t{i - last_index + 1}\n")
-                        last_n_or_gap = '-'
-                        last_index = i + 1
-                    else:
-                        continue
-                elif diff[i] != '0':
-                    # Flush the last gap or n
-                    if last_n_or_gap == 'n':
-                        file.write(f"n\t{last_index}\t{i - last_index + 1}\n")
-                    elif last_n_or_gap == '-':
-                        file.write(f"n\t{last_index}\t{i - last_index + 1}\n")
-
-                    last_n_or_gap = None
-                    last_index = -1
-
-                    file.write(f"{diff[i].lower()}\t{i + 1}\n")
-                else:
-                    # Flush the last gap or n
-                    if last_n_or_gap == 'n':
-                        file.write(f"n\t{last_index}\t{i - last_index + 1}\n")
-                    elif last_n_or_gap == '-':
-                        file.write(f"n\t{last_index}\t{i - last_index + 1}\n")
-
-                    last_n_or_gap = None
-                    last_index = -1
-                
-            # Flush the last gap or n
-            if last_n_or_gap == 'n':
-                file.write(f"n {last_index} {i - last_index + 1}\n")
-            elif last_n_or_gap == '-':
-                file.write(f"n {last_index} {i - last_index + 1}\n")
-
-            last_n_or_gap = None
-            last_index = -1
-    
-    print("Time - %s seconds" % (time.time() - start_time))
+        reference, skip_names = read_maple_index(args.output)
+        if args.reference and next(iter_fasta(args.reference)).sequence != reference:
+            print(f"ERROR: Reference sequence does not match the reference of the existing MAPLE file {args.output}.")
+            sys.exit(1)
+        print(f"Appending to MAPLE file with {len(skip_names)} sequences; input sequences with the same names will be skipped.")
+    elif args.reference:
+        reference = next(iter_fasta(args.reference)).sequence
+    else:
+        reference = generate_consensus(iter_fasta(args.input))
+    reference_array = as_array(reference)
 
-            
+    if args.threads > 1 and is_compressed(args.input):
+        print("Compressed input files cannot be split into chunks for --threads, so a single process will be used.")
+        args.threads = 1
 
-                    
-    
+    # Write the output MAPLE file, reading the input sequences one at a time. A new file is written under a temporary name
+    # and only replaces the output once all sequences are converted; with --append the new entries are added in place
+    # (as a new compressed member for compressed files) and the file is truncated back to its original size on error.
+    # Either way, an error (e.g. a sequence of the wrong length) does not leave a partially written or appended file.
+    if args.append:
+        temp_output = args.output
+        original_size = path.getsize(args.output)
+    else:
+        temp_output = path.join(path.dirname(args.output), f".tmp.{path.basename(args.output)}")
+    try:
+        with open_file(temp_output, 'a' if args.append else 'w') as file:
+            if args.append:
+                # Make sure the new entries start on a new line (the existing content of a compressed file is assumed
+                # to end with a newline)
+                if not is_compressed(args.output) and original_size > 0:
+                    with open(args.output, 'rb') as existing:
+                        existing.seek(-1, os.SEEK_END)
+                        if existing.read(1) != b'\n':
+                            file.write("\n")
+            else:
+                file.write(f">reference\n{reference}\n")
 
-        
+            if args.threads > 1:
+                # Chunks are converted in parallel and written in input order as they complete
+                from multiprocessing import Pool
+                n_chunks = max(4 * args.threads, path.getsize(args.input) // (args.chunk_size * 1024 * 1024))
+                with Pool(args.threads, initializer=init_worker, initargs=(args.input, reference_array, skip_names)) as pool:
+                    for text, wrong_name in pool.imap(convert_chunk, fasta_chunks(args.input, n_chunks)):
+                        if wrong_name is not None:
+                            print(f"ERROR: Reference sequence length does not match the input sequence {wrong_name}.")
+                            sys.exit(1)
+                        file.write(text)
+            else:
+                for s in iter_fasta(args.input):
+                    if s.name in skip_names:
+                        continue
+                    # Check if the reference sequence length matches the input sequence
+                    if len(reference) != len(s.sequence):
+                        print(f"ERROR: Reference sequence length does not match the input sequence {s.name}.")
+                        sys.exit(1)
+                    file.write(f">{s.name}\n")
+                    file.writelines(maple_entries(s.sequence, reference_array))
+    except BaseException:
+        if args.append:
+            os.truncate(args.output, original_size)
+        elif path.exists(temp_output):
+            os.remove(temp_output)
+        raise
+    if not args.append:
+        os.replace(temp_output, args.output)
+
+    print("Time - %s seconds" % (time.time() - start_time))
@@ -0,0 +1,35 @@
+#Importable interface to MAPLE.
+#The inference code lives in MAPLEv0.6.11.py, which can still be run as a script exactly as before;
+# here it is loaded as module maple.core (see core.py) without running any inference, so that its functions can be reused from Python, e.g.:
+#	import maple
+#	maple.setUpConfig(maple.Config(input="alignment.maple",output="results/MAPLE"))
+#	ref, data = maple.readConciseAlignment("alignment.maple")
+#	maple.setUpReference(ref)
+#	maple.setUpSubstitutionModel()
+#or a whole inference can be run with maple.main(["--input","alignment.maple","--output","results/MAPLE"]).
+#setUpConfig() and setUpReference() set module-level state of maple.core, so only one configuration can be in use per process.
+#maple.core is only loaded when one of the names below is first used, so that importing maple.io (the compressed file functions
+# shared with createMapleFile.py) does not load the inference code.
+_coreNames=(
+	"Config", "Model", "Tree", "NameStore", "setUpConfig", "setUpReference", "setUpSubstitutionModel", "main",
+	"readConciseAlignment", "ConciseAlignmentIndex", "collectReference", "readNewick", "readNexus", "makeTreeBinary",
+	"writeBinaryAlignment", "readBinaryAlignment", "BinaryAlignment", "writeMATfile", "readMATfile", "isMATfile",
+	"probVectTerminalNode", "mergeVectors", "appendProbNode", "appendProbNodeToCandidates", "getPartialVec", "shorten", "simplify",
+	"UpwardGenomeListCache", "UpwardGenomeListStore",
+	"findBestParentForNewSample", "placeSampleOnTree", "distancesFromRefPunishNs",
+	"reCalculateAllGenomeLists", "calculateTreeLikelihood", "expectationMaximizationCalculationRates", "calculateErrorProbabilities",
+	"updateSubMatrix", "updateMutMatrices", "updateErrorRates", "traverseTreeToOptimizeBranchLengths",
+	"findBestParentTopology", "findBestRoot", "startTopologyUpdates", "startTopologyUpdatesParallel", "applySPRMovesParallel",
+	"createNewick", "writeTSVfile", "tsvColumnFormatters", "writeTaxaNames", "giveInternalNodeNames", "openFile", "BackgroundFileWriter",
+)
+
+def __getattr__(name):
+	if name=="core" or name in _coreNames:
+		import maple.core
+		if name=="core":
+			return maple.core
+		return getattr(maple.core,name)
+	raise AttributeError("module 'maple' has no attribute "+repr(name))
+
+def __dir__():
+	return sorted(list(globals())+list(_coreNames)+["core"])
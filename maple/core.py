@@ -0,0 +1,7 @@
+#The inference code of MAPLEv0.6.11.py, run in the namespace of this module: the script can still be run exactly as before,
+# while here it is loaded as module maple.core without running any inference (its main() is only called when run as a script).
+import os.path
+
+_scriptFile=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"MAPLEv0.6.11.py")
+with open(_scriptFile) as _file:
+	exec(compile(_file.read(),_scriptFile,"exec"))
@@ -0,0 +1,37 @@
+#Compressed files: input and output files with extension .gz (gzip) or .zst (zstandard, which requires the zstandard Python module)
+# are decompressed and compressed on the fly. Output compression levels favour speed over compression ratio.
+#Shared by MAPLEv0.6.11.py and createMapleFile.py; importing this module does not load the inference code.
+import gzip
+import io
+
+gzipCompressLevel=3
+zstdCompressLevel=3
+
+#open a file in mode "r", "w", "a", "rb", "wb" or "ab", (de)compressing it according to its extension.
+#Appending to a compressed file adds a new compressed member (gzip) or frame (zstandard) at its end.
+def openFile(fileName,mode="r"):
+	if fileName.endswith(".gz"):
+		if not ("b" in mode):
+			mode+="t"
+		if mode[0]=="r":
+			return gzip.open(fileName,mode)
+		return gzip.open(fileName,mode,compresslevel=gzipCompressLevel)
+	if fileName.endswith(".zst"):
+		try:
+			import zstandard
+		except ImportError:
+			print("Reading or writing zstandard-compressed file "+fileName+" requires Python module zstandard (pip install zstandard).")
+			raise Exception("exit")
+		if mode[0]=="r":
+			stream=zstandard.ZstdDecompressor().stream_reader(open(fileName,"rb"),read_across_frames=True)
+		else:
+			stream=zstandard.ZstdCompressor(level=zstdCompressLevel).stream_writer(open(fileName,mode[0]+"b"))
+		if "b" in mode:
+			if mode[0]=="r":
+				return io.BufferedReader(stream)
+			return stream
+		return io.TextIOWrapper(stream)
+	return open(fileName,mode)
+
+def isCompressedFile(fileName):
+	return fileName.endswith(".gz") or fileName.endswith(".zst")